@@ -4,5 +4,6 @@ logging.getLogger(__name__).addHandler(logging.NullHandler())
 logging.getLogger(__name__).setLevel(logging.WARNING)
 
 from .authority import LocalFileAuthority, find_authority, RemoteDeploymentAuthority
+from .snapshot import SnapshotAuthority, write_snapshot
 from .toolinterface import Datatool
 
@@ -0,0 +1,205 @@
+# coding: utf-8
+
+"""Awaitable access to a Datatool, for services running an asyncio event loop.
+
+Everything that touches the filesystem (loading the authority and index,
+finding datasets and checking their file instances) is run in a bounded
+pool of threads, so that the event loop is never blocked on it. Identical
+lookups made while one is already in flight wait for that one, rather than
+repeating the work. Changes are applied one at a time, in the order they
+were made, by a single writer task, and written out as each succeeds.
+
+    datatool = await AsyncDatatool.load()
+    filenames = await datatool.files("sampleset")
+    set_id = await datatool.create_set("newset")
+    await datatool.close()
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import logging
+logger = logging.getLogger(__name__)
+
+from .toolinterface import Datatool
+
+class AsyncDatatool(object):
+  """Wraps a Datatool, running its work in a pool of worker threads.
+
+  Use AsyncDatatool.load() to load one from within the event loop."""
+  def __init__(self, datatool, workers=4, executor=None):
+    self._datatool = datatool
+    self._executor = executor or ThreadPoolExecutor(max(1, workers))
+    self._inflight = {}
+    self._queue = None
+    self._writer = None
+
+  @classmethod
+  async def load(cls, remote=None, lazy=False, processes=None, workers=4):
+    """Load the authority and index without blocking the event loop"""
+    loop = asyncio.get_event_loop()
+    executor = ThreadPoolExecutor(max(1, workers))
+    try:
+      datatool = await loop.run_in_executor(executor,
+        functools.partial(Datatool, remote=remote, lazy=lazy, processes=processes))
+    except BaseException:
+      executor.shutdown(wait=False)
+      raise
+    return cls(datatool, executor=executor)
+
+  @property
+  def datatool(self):
+    return self._datatool
+
+  def _run(self, func, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+  async def _coalesce(self, key, func, *args, **kwargs):
+    """Run a lookup, or wait for the identical one already in flight"""
+    future = self._inflight.get(key)
+    if future is None:
+      future = self._run(func, *args, **kwargs)
+      self._inflight[key] = future
+      def _finished(done):
+        if self._inflight.get(key) is done:
+          del self._inflight[key]
+      future.add_done_callback(_finished)
+    # Don't let one caller giving up cancel the lookup for everyone else
+    return await asyncio.shield(future)
+
+  async def refresh(self):
+    """Apply anything appended to the authority and index since loading"""
+    await self._run(self._datatool.refresh)
+    self._inflight.clear()
+
+  async def get_dataset(self, name_or_id, stage=False):
+    """Retrieves a particular dataset, as Datatool.get_dataset.
+
+    Iterating the DatasetInterface checks the file instances on disk, so use
+    files() to get the filenames from within the event loop."""
+    return await self._coalesce(("dataset", name_or_id.lower(), stage),
+                                self._datatool.get_dataset, name_or_id, stage=stage)
+
+  async def get_file(self, name_or_id):
+    """Retrieves the single file from a named dataset"""
+    return await self._coalesce(("file", name_or_id.lower()), self._datatool.get_file, name_or_id)
+
+  def _files(self, name_or_id, tags):
+    dataset = self._datatool.get_dataset(name_or_id)
+    with self._datatool._lock:
+      if tags:
+        return dataset.filter(tags).all
+      return list(dataset)
+
+  async def files(self, name_or_id, tags=None):
+    """The filenames of the readable instances of a dataset's files, narrowed by tags"""
+    tags = tuple(tags or ())
+    return await self._coalesce(("files", name_or_id.lower(), tags), self._files, name_or_id, tags)
+
+  def _search(self, tags):
+    with self._datatool._lock:
+      authority = self._datatool._authority
+      return [authority.fetch_dataset(x) for x in authority.search(tags)]
+
+  async def search(self, tags):
+    """The datasets with all of the tags"""
+    return await self._coalesce(("search", frozenset(tags)), self._search, tags)
+
+  async def resolve(self, names_or_ids, tags=None, require_readable=False):
+    """Resolve the files of many datasets at once, as Datatool.resolve"""
+    key = ("resolve", tuple(names_or_ids), tuple(tags or ()), require_readable)
+    return await self._coalesce(key, self._datatool.resolve, names_or_ids,
+                                tags=tags, require_readable=require_readable)
+
+  async def _write_loop(self):
+    while True:
+      item = await self._queue.get()
+      if item is None:
+        break
+      func, args, future = item
+      if future.cancelled():
+        continue
+      try:
+        result = await self._run(self._apply_write, func, *args)
+      except Exception as e:
+        if not future.cancelled():
+          future.set_exception(e)
+      else:
+        if not future.cancelled():
+          future.set_result(result)
+      # Lookups started before the change shouldn't be joined after it
+      self._inflight.clear()
+
+  def _apply_write(self, func, *args):
+    index, authority = self._datatool._index, self._datatool._authority
+    with self._datatool._lock:
+      # A failed change mustn't leave anything behind for the next write
+      commands = len(authority._commands)
+      if index is not None:
+        entries = (dict(index._data), dict(index._names), list(index._pending))
+      try:
+        result = func(authority, *args)
+      except Exception:
+        del authority._commands[commands:]
+        if index is not None:
+          index._data, index._names, index._pending = entries
+        raise
+      if index is not None:
+        index.write()
+      authority.write()
+      return result
+
+  def _submit(self, func, *args):
+    """Queue a change to the authority, and wait for it to be written"""
+    if self._writer is None:
+      self._queue = asyncio.Queue()
+      self._writer = asyncio.ensure_future(self._write_loop())
+    future = asyncio.get_event_loop().create_future()
+    self._queue.put_nowait((func, args, future))
+    return future
+
+  async def create_set(self, name=None):
+    """Create a (optionally named) data set and return the id"""
+    return await self._submit(lambda authority: authority.create_set(name=name))
+
+  async def create_view(self, definition, name=None):
+    """Create a virtual set from other sets and return the id"""
+    return await self._submit(lambda authority: authority.create_view(definition, name=name))
+
+  async def delete_set(self, set_id):
+    return await self._submit(lambda authority: authority.delete_set(set_id))
+
+  async def rename_set(self, set_id, new_name):
+    return await self._submit(lambda authority: authority.rename_set(set_id, new_name))
+
+  def _add_files(self, authority, set_id, filenames):
+    entries = self._datatool._index.add_files(filenames)
+    authority.add_files(set_id, entries)
+    authority.apply_index_entries(entries)
+
+  async def add_files(self, set_id, filenames):
+    """Index the files, and add them to a data set"""
+    return await self._submit(self._add_files, set_id, list(filenames))
+
+  async def add_tags(self, ids, tags):
+    """Add tags to sets or files"""
+    return await self._submit(lambda authority: authority.add_tags_many(ids, tags))
+
+  async def remove_tags(self, ids, tags):
+    """Remove tags from sets or files"""
+    return await self._submit(lambda authority: authority.remove_tags_many(ids, tags))
+
+  async def close(self):
+    """Finish any queued changes, and stop the workers"""
+    if self._writer is not None:
+      self._queue.put_nowait(None)
+      await self._writer
+      self._writer = None
+    self._executor.shutdown(wait=False)
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *args):
+    await self.close()
@@ -4,28 +4,48 @@
 
 import os
 import re
+import bisect
+import itertools
+import collections
 import json
+import shutil
+import datetime
 import dateutil.parser
 import logging
+from concurrent.futures import ProcessPoolExecutor
 logger = logging.getLogger(__name__)
 
+import six
 from six.moves import StringIO
 
 from .handlers import handler_for, CreateSetCommand, CreateFileCommand, \
-                      SetPropertyCommand, AddFilesToSetCommand, \
-                      AddTagsCommand, RemoveTagsCommand, RmFilesFromSetCommand, \
-                      DeleteSetCommand
+                      CreateFilesCommand, SetPropertyCommand, AddFilesToSetCommand, \
+                      AddTagsCommand, RemoveTagsCommand, AddTagsManyCommand, \
+                      RemoveTagsManyCommand, RmFilesFromSetCommand, DeleteSetCommand, \
+                      CreateViewCommand
 from .datafile import DataFile, FileInstance
-from .dataset import Dataset
-from .util import first
+from .dataset import Dataset, VirtualDataset
+from .remote import RemoteLogCache, is_remote
+from .offsets import OffsetIndex
+from .verify import verify_datasets
+from .digest import DigestTree, dataset_digest
+from .segments import SegmentManifest, SEGMENT_SIZE, seal, segment_log, write_checkpoint
+from .util import first, lock_file, open_locked, read_lines, ordered_map, LogReader
 
 # Look for a non-blank line
 reLineHeader = re.compile(r'^\s*([^\s]+)\s+(\w+)\s+(.*)$')
 
+_decoder = json.JSONDecoder()
+
+# The size of each piece of the log decoded by a worker, when parsing in parallel
+PARSE_CHUNK_SIZE = 16*1024*1024
+
 def find_authority():
   """Looks in standard and environmental locations for the data index."""
   locs = [os.environ.get("DATA_AUTHORITY"), "~/.data.authority"]
   for loc in [os.path.expanduser(x) for x in locs if x]:
+    if is_remote(loc):
+      return loc
     if os.path.isfile(loc):
       return loc
     elif os.path.isdir(loc):
@@ -35,36 +55,152 @@ def find_authority():
   return None
 
 
+def _decode_line(line):
+  """Decode an authority line into a (date, command, data) record, or None"""
+  line_data = reLineHeader.match(line)
+  if not line_data:
+    return None
+  command_date, command, raw_data = line_data.groups()
+  data, dlen = _decoder.raw_decode(raw_data)
+  if not isinstance(data, dict):
+    data = {'data': data}
+  return command_date, command, data
+
+def _command_for(record):
+  command_date, command, data = record
+  cmd = handler_for(command).from_data(data)
+  cmd.timestamp = command_date
+  return cmd
+
 def parse_authority(indexfile):
   """Read an index file stream and returns the command history"""
-  decoder = json.JSONDecoder()
   for num, line in enumerate(indexfile, 1):
     if line.isspace() or line.startswith('#'):
       continue
-    line_data = reLineHeader.match(line)
-    if not line_data:
-      raise IndexFileError("Could not read index line {}".format(num))
-    command_date, command, raw_data = line_data.groups()
-    # Parse the command
-    data, dlen = decoder.raw_decode(raw_data)
-    if not isinstance(data, dict):
-      data = {'data': data}
-    #logger.debug ("Date: {}, Command: {}, Data: {}".format(command_date, command, data))
-    #data['date'] = command_date
-    command = handler_for(command)
-    cmd = command.from_data(data)
-    cmd.timestamp = command_date
-    yield cmd
+    record = _decode_line(line)
+    if record is None:
+      raise AuthorityFileError("Could not read authority line {}".format(num))
+    yield _command_for(record)
+
+def _decode_range(task):
+  """Decode a byte range of an authority file, in a worker process"""
+  filename, start, end = task
+  records = []
+  for line in read_lines(filename, start, end):
+    if line.isspace() or line.startswith('#'):
+      continue
+    record = _decode_line(line)
+    if record is None:
+      raise AuthorityFileError("Could not read authority line in bytes {}-{}".format(start, end))
+    records.append(record)
+  return records
+
+def parse_authority_parallel(reader, processes, chunk_size=None):
+  """Parse everything unread by a LogReader, decoding chunks in a process pool.
+
+  The file is split into line-aligned chunks (and whole sealed segments)
+  that are decoded in parallel, but the commands are still yielded in file
+  order."""
+  tasks = reader.chunks(chunk_size or PARSE_CHUNK_SIZE)
+  for records in ordered_map(_decode_range, tasks, processes, executor=ProcessPoolExecutor):
+    for record in records:
+      yield _command_for(record)
+
+def format_command(command):
+  """Format a command as a single authority file line"""
+  return "{} {} {}\n".format(command.timestamp.isoformat(), command.command, json.dumps(command.to_data()))
+
+def _authority_state(data):
+  """A comparable summary of everything held in an AuthorityData"""
+  return (
+    {x.id: (x.attrs, sorted(x.tags), [y.id for y in x.files]) for x in data.datasets.values()},
+    {x.id: (x.attrs, sorted(x.tags)) for x in data.files.values()})
 
 class AuthorityFileError(IOError):
   pass
 
+def _create_files(entries):
+  """A command creating files, as a single createfiles line if there are several"""
+  if len(entries) == 1:
+    return CreateFileCommand(entries[0])
+  return CreateFilesCommand(entries)
+
+def _command_key(command):
+  """A key identifying a command in any authority, independent of set ordering"""
+  data = {x: sorted(y) if isinstance(y, list) and all(isinstance(z, six.string_types) for z in y) else y
+          for x, y in command.to_data().items()}
+  return (command.timestamp.isoformat(), command.command, json.dumps(data, sort_keys=True))
+
+def _entry_state(entry):
+  """A comparable summary of a set or file, to tell whether a command changed it"""
+  if entry is None:
+    return None
+  files = None
+  if isinstance(entry, Dataset) and not isinstance(entry, VirtualDataset):
+    files = [x.id for x in entry.files]
+  return (dict(entry.attrs), set(entry.tags), files)
+
+def _tag_items(ids, tags, remove=False):
+  """A command changing the tags of items, as a single line if there are several"""
+  if len(ids) == 1:
+    return (RemoveTagsCommand if remove else AddTagsCommand)(ids[0], tags)
+  return (RemoveTagsManyCommand if remove else AddTagsManyCommand)(ids, tags)
+
+def open_authority(location, lazy=False, processes=None):
+  """Open the authority at a filename or remote URL.
+
+  Local authorities can be opened lazily, to only load the sets used, or
+  parsed in a pool of processes."""
+  if is_remote(location):
+    return CachedRemoteAuthority(location)
+  if lazy and SegmentManifest.exists(location):
+    logger.info("Segmented authority {} can't be loaded lazily; loading in full".format(location))
+  elif lazy:
+    return LazyFileAuthority(location)
+  return LocalFileAuthority(location, processes=processes)
+
 class AuthorityData(object):
   """The data object, holding the current state of the index"""
   def __init__(self):
     self.datasets = {}
     self.files = {}
     self.entries = {}
+    self.file_tags_version = 0
+    self._versions = collections.Counter()
+    self._views = set()
+    self._tree = None
+    self._changed = set()
+
+  def apply(self, command):
+    """Apply a command, noting what it changed for virtual sets and digests"""
+    command.apply(self)
+    targets = [str(x) for x in command.targets()]
+    self._versions.update(targets)
+    if any(x in self.files for x in targets):
+      self.file_tags_version += 1
+    if self._tree is not None:
+      self._changed.update(targets)
+
+  def version(self, id):
+    """The number of commands applied to an entry, to tell when it changes"""
+    return self._versions[id]
+
+  def digests(self):
+    """The DigestTree over all datasets.
+
+    It is built on first use, and afterwards only the digests of the sets
+    changed by commands applied since are recalculated."""
+    if self._tree is None:
+      self._tree = DigestTree()
+      self._changed = set(self.datasets)
+    # Virtual sets can change without any command targeting them
+    for set_id in self._changed | self._views:
+      if set_id in self.datasets:
+        self._tree[set_id] = dataset_digest(self.datasets[set_id])
+      else:
+        self._tree.discard(set_id)
+    self._changed = set()
+    return self._tree
 
   def __getitem__(self, id):
     return self.entries[id]
@@ -76,6 +212,8 @@ class AuthorityData(object):
       self.files[key] = value
     elif isinstance(value, Dataset):
       self.datasets[key] = value
+      if isinstance(value, VirtualDataset):
+        self._views.add(key)
     else:
       raise KeyError("Instance not recognised")
 
@@ -85,6 +223,7 @@ class AuthorityData(object):
       del self.datasets[key]
     if key in self.files:
       del self.files[key]
+    self._views.discard(key)
 
   def values(self):
     return self.entries.values()
@@ -108,7 +247,7 @@ class Authority(object):
   def _apply_command(self, command):
     logger.debug("Applying {}".format(str(command)))
     self._commands.append(command)
-    command.apply(self._data)
+    self._data.apply(command)
     return command
 
   def create_set(self, name=None):
@@ -130,13 +269,44 @@ class Authority(object):
     assert not new_name in [x.name for x in self._data.datasets.values()]
     self._apply_command(SetPropertyCommand(set_id, "name", new_name))
 
+  def create_view(self, definition, name=None):
+    """Create a virtual set from other sets, and return the id.
+
+    See VirtualDataset for the definitions. Its files are not copied into
+    the authority, but worked out from the other sets as needed."""
+    if not definition.get("op") in VirtualDataset.operations:
+      raise AuthorityFileError("Unknown virtual set operation {}".format(definition.get("op")))
+    for base_id in definition["sets"]:
+      if not base_id in self._data.datasets:
+        raise AuthorityFileError("No set {} to base a virtual set on".format(base_id))
+    if name:
+      if name in [x.name for x in self._data.datasets.values()]:
+        raise AuthorityFileError("Dataset named {} already exists".format(name))
+    cmd = self._apply_command(CreateViewCommand(None, definition))
+    if name:
+      self._apply_command(SetPropertyCommand(cmd.id, "name", name))
+    return cmd.id
+
+  def _check_not_view(self, set_id):
+    if isinstance(self._data.datasets.get(set_id), VirtualDataset):
+      raise AuthorityFileError("Cannot change the files of virtual set {}".format(set_id))
+
   def add_files(self, set_id, file_entries):
+    self._check_not_view(set_id)
+    self._create_files(file_entries)
+    self._apply_command(AddFilesToSetCommand(set_id, [x.hashsum for x in file_entries]))
+
+  def _create_files(self, file_entries):
+    """Create any of the files not already known, in a single command"""
+    new = collections.OrderedDict()
     for f in file_entries:
       if not f.hashsum in self._data.files:
-        self._apply_command(CreateFileCommand(f))
-    self._apply_command(AddFilesToSetCommand(set_id, [x.hashsum for x in file_entries]))
+        new.setdefault(f.hashsum, f)
+    if new:
+      self._apply_command(_create_files(list(new.values())))
 
   def remove_files(self, set_id, file_hashes):
+    self._check_not_view(set_id)
     self._apply_command(RmFilesFromSetCommand(set_id, file_hashes))
 
   def add_tags(self, set_id, tags):
@@ -147,6 +317,18 @@ class Authority(object):
     if not self._data[set_id].tags.isdisjoint(tags):
       self._apply_command(RemoveTagsCommand(set_id, tags))
 
+  def add_tags_many(self, ids, tags):
+    """Add tags to many sets or files at once, in a single command"""
+    ids = [x for x in collections.OrderedDict.fromkeys(ids) if not self._data[x].tags.issuperset(tags)]
+    if ids:
+      self._apply_command(_tag_items(ids, tags))
+
+  def remove_tags_many(self, ids, tags):
+    """Remove tags from many sets or files at once, in a single command"""
+    ids = [x for x in collections.OrderedDict.fromkeys(ids) if not self._data[x].tags.isdisjoint(tags)]
+    if ids:
+      self._apply_command(_tag_items(ids, tags, remove=True))
+
   def fetch_dataset(self, name_or_id):
     """Retrieve a single dataset from either the name, or a shortened (or complete) hash"""
     results = [y for x, y in self._data.datasets.items() if x.lower().startswith(name_or_id.lower())
@@ -154,6 +336,27 @@ class Authority(object):
     assert len(results) <= 1
     return first(results)
 
+  def fetch_datasets(self, names_or_ids):
+    """Retrieve many datasets at once, as fetch_dataset. Missing sets are None."""
+    by_id = sorted((x.lower(), y) for x, y in self._data.datasets.items())
+    keys = [x for x, _ in by_id]
+    by_name = {}
+    for dataset in self._data.datasets.values():
+      if dataset.name:
+        by_name.setdefault(dataset.name.lower(), []).append(dataset)
+    results = []
+    for name_or_id in names_or_ids:
+      key = name_or_id.lower()
+      matches = by_name.get(key, [])[:]
+      position = bisect.bisect_left(keys, key)
+      while position < len(keys) and keys[position].startswith(key):
+        if not by_id[position][1] in matches:
+          matches.append(by_id[position][1])
+        position += 1
+      assert len(matches) <= 1
+      results.append(first(matches))
+    return results
+
   def __getitem__(self, id):
     return self._data.datasets[id]
 
@@ -166,14 +369,156 @@ class Authority(object):
   def apply_index(self, index):
     """Applies an index set to the authority, temporarily merging the data"""
     self.index = index
-    for f in index._data.values():
-      if not f.hashsum in self._data.files:
-        self._apply_command(CreateFileCommand(f))
+    self.apply_index_entries(index._data.values())
+
+  def apply_index_entries(self, entries):
+    """Merge individual index entries into the authority"""
+    entries = list(entries)
+    self._create_files(entries)
+    for f in entries:
       self._data.files[f.hashsum].instances.append(f)
 
+  def refresh(self):
+    """Apply any changes made to the authority since it was loaded.
+
+    Returns True if the authority had to be reloaded from scratch, in which
+    case any index needs to be applied again."""
+    return False
+
   def get_file(self, fileid):
     return self._data.files[fileid]
 
+  def verify(self, names_or_ids, full=False, workers=None, bandwidth=None, state=None):
+    """Check the instances of the files in datasets against their records.
+
+    Yields a Mismatch for every instance that is missing, or differs in
+    size, timestamp or (if full) hash. See verify.verify_datasets."""
+    return verify_datasets(self, names_or_ids, full=full, workers=workers,
+                           bandwidth=bandwidth, state=state)
+
+  def digests(self):
+    """The DigestTree over the authority's datasets (see digest.py)"""
+    return self._data.digests()
+
+  def sync(self, other):
+    """Apply the commands of another authority that this one is missing.
+
+    The digest trees of the two authorities are walked together from the
+    root, only descending into the branches that differ, to find the sets
+    that differ. The other authority's commands on those sets, and on the
+    files in them, that are not already here are then applied in the same
+    order, keeping their timestamps, including deletions and removals.
+    Files unknown here are created first. Sets deleted here are not brought
+    back, and commands that change nothing here (such as the other
+    authority's history rewritten by compacting) are not kept. Returns the
+    commands applied, which are written as usual."""
+    differing = self.digests().differing(other.digests())
+    if not differing:
+      return []
+    wanted = set(differing)
+    for set_id in differing:
+      if set_id in other._data.datasets:
+        wanted.update(x.id for x in other._data.datasets[set_id].files)
+    have = set(_command_key(x) for x in self._commands)
+    deleted = set(x.id for x in self._commands if type(x) is DeleteSetCommand)
+    missing = []
+    for command in other._commands:
+      if isinstance(command, (CreateFileCommand, CreateFilesCommand)):
+        continue
+      ids = set(str(x) for x in command.targets() + command.requires())
+      if wanted.isdisjoint(str(x) for x in command.targets()) or _command_key(command) in have:
+        continue
+      if not deleted.isdisjoint(ids):
+        logger.info("Not syncing {}, as it was deleted here".format(command))
+        continue
+      missing.append(command)
+    self._check_sync_names(missing)
+
+    # Files referenced by the missing commands need to exist first
+    start = len(self._commands)
+    referenced = set(str(y) for x in missing for y in x.targets() + x.requires())
+    self._create_files([other._data.files[x].entry or FileInstance(hashsum=x, size=other._data.files[x].size)
+                        for x in sorted(referenced) if x in other._data.files and not x in self._data.files])
+    for command in missing:
+      if type(command) in (CreateSetCommand, CreateViewCommand):
+        if command.id in self._data.entries:
+          continue
+      elif not all(str(x) in self._data.entries for x in command.targets() + command.requires()):
+        logger.info("Not syncing {}, as its target has been deleted".format(command))
+        continue
+      before = [_entry_state(self._data.get(str(x))) for x in command.targets()]
+      self._apply_command(command)
+      if [_entry_state(self._data.get(str(x))) for x in command.targets()] == before:
+        # It changed nothing here, so doesn't need to be written
+        self._commands.pop()
+    return self._commands[start:]
+
+  def _check_sync_names(self, commands):
+    """Refuse to sync commands that would give two sets the same name"""
+    names = {x: y.name for x, y in self._data.datasets.items() if y.name}
+    for command in commands:
+      if type(command) is DeleteSetCommand:
+        names.pop(command.id, None)
+      elif isinstance(command, SetPropertyCommand) and command.property == "name":
+        names[command.id] = command.value
+    counts = collections.Counter(names.values())
+    duplicates = sorted(x for x, count in counts.items() if count > 1)
+    if duplicates:
+      raise AuthorityFileError("Syncing would give more than one dataset the name {}".format(", ".join(duplicates)))
+
+  def compacted_commands(self):
+    """Return the minimal command sequence reproducing the current state.
+
+    File and set creation keep their original timestamps; the commands
+    restoring their state are stamped with the time of the last command."""
+    if not self._commands:
+      return []
+    latest = self._commands[-1].timestamp
+    created_files = []
+    seen_files = set()
+    created_sets = []
+    for command in self._commands:
+      if isinstance(command, (CreateFileCommand, CreateFilesCommand)):
+        for entry in command.entries:
+          if not entry.hashsum in seen_files and entry.hashsum in self._data.files:
+            seen_files.add(entry.hashsum)
+            created_files.append((command.timestamp, entry))
+      elif type(command) in (CreateSetCommand, CreateViewCommand) and command.id in self._data.datasets:
+        created_sets.append(command)
+
+    def _stamped(command, timestamp=latest):
+      command.timestamp = timestamp
+      return command
+
+    # Files created at the same time are created together, and files
+    # sharing the same tags are tagged together
+    commands = []
+    tagged = collections.OrderedDict()
+    for timestamp, created in itertools.groupby(created_files, key=lambda x: x[0]):
+      entries = [x for _, x in created]
+      commands.append(_stamped(_create_files(entries), timestamp))
+      for entry in entries:
+        datafile = self._data.files[entry.hashsum]
+        for name, value in sorted(datafile.attrs.items()):
+          commands.append(_stamped(SetPropertyCommand(datafile.id, name, value)))
+        if datafile.tags:
+          tagged.setdefault(tuple(sorted(datafile.tags)), []).append(datafile.id)
+    for tags, ids in tagged.items():
+      commands.append(_stamped(_tag_items(ids, tags)))
+    for created in created_sets:
+      dataset = self._data.datasets[created.id]
+      if isinstance(dataset, VirtualDataset):
+        commands.append(_stamped(CreateViewCommand(dataset.id, dataset.definition), created.timestamp))
+      else:
+        commands.append(_stamped(CreateSetCommand(dataset.id), created.timestamp))
+      for name, value in sorted(dataset.attrs.items()):
+        commands.append(_stamped(SetPropertyCommand(dataset.id, name, value)))
+      if dataset.files and not isinstance(dataset, VirtualDataset):
+        commands.append(_stamped(AddFilesToSetCommand(dataset.id, [x.id for x in dataset.files])))
+      if dataset.tags:
+        commands.append(_stamped(AddTagsCommand(dataset.id, sorted(dataset.tags))))
+    return commands
+
 class StringAuthority(object):
   def __init__(self, stringdata):
     super(StringAuthority,self).__init__()
@@ -185,16 +530,51 @@ class StringAuthority(object):
 
 
 class LocalFileAuthority(Authority):
-  def __init__(self, filename):
+  """An authority read from, and appended to, a local file.
+
+  If processes is given, a large file is decoded in a pool of that many
+  processes when it is loaded (see parse_authority_parallel). The file may
+  be stored as compressed segments (see segments.py), in which case loading
+  starts from the latest checkpoint."""
+  def __init__(self, filename, processes=None):
     super(LocalFileAuthority,self).__init__()
     self.filename = filename
-    with open(filename) as index_stream:
-      self._process_commands(parse_authority(index_stream))
+    self._reader = LogReader(filename, checkpoints=True)
+    if processes and self._reader.size() > PARSE_CHUNK_SIZE:
+      self._process_commands(parse_authority_parallel(self._reader, processes))
+    else:
+      self._process_commands(parse_authority(self._reader.lines(partial=True)))
     self._commandindex = len(self._commands)
 
+  def _read_appended(self):
+    """Apply commands appended to the file by others, keeping unwritten ones pending"""
+    pending = self._commands[self._commandindex:]
+    del self._commands[self._commandindex:]
+    reloaded = self._reader.replaced()
+    if reloaded:
+      logger.info("Authority file {} was replaced; reloading".format(self.filename))
+      self._data = AuthorityData()
+      self._commands = []
+      self._reader.reset()
+    self._process_commands(parse_authority(self._reader.lines()))
+    self._commandindex = len(self._commands)
+    if reloaded:
+      for command in pending:
+        self._apply_command(command)
+    else:
+      self._commands.extend(pending)
+    return reloaded
+
+  def refresh(self):
+    return self._read_appended()
+
   def write(self):
     """Writes any changes"""
-    with open(self.filename, "a") as stream:
+    if self._commandindex == len(self._commands):
+      return
+    with open_locked(self.filename) as stream:
+      # Catch up with anything other writers appended, so we don't read our own lines back
+      self._read_appended()
       # Get the last byte and make sure it is a return. Otherwise, push one out
       try:
         stream.seek(-1,os.SEEK_END)
@@ -206,11 +586,275 @@ class LocalFileAuthority(Authority):
 
       stream.seek(0,os.SEEK_END)
       # Now dump all the commands that are unprocessed
+      stream.flush()
+      stats = os.fstat(stream.fileno())
+      # Keep the offsets sidecar up to date, if there is one for this file
+      offsets = None
+      if OffsetIndex.exists(self.filename):
+        offsets = OffsetIndex(self.filename)
+        if not offsets.matches(stats.st_ino):
+          offsets = None
+      start = position = self._reader.base + stats.st_size
       for command in self._commands[self._commandindex:]:
-        line = "{} {} {}\n".format(command.timestamp.isoformat(), command.command, json.dumps(command.to_data()))
+        line = format_command(command)
         logger.debug("Writing: " + line.strip())
         stream.write(line)
+        length = len(line.encode("utf-8"))
+        if offsets:
+          offsets.record(position, length, command)
+        position += length
       self._commandindex = len(self._commands)
+      stream.flush()
+      if offsets:
+        offsets.span(start, position)
+        offsets.flush()
+      self._reader.mark(position, stats.st_ino)
+      seal(stream, self._reader.manifest)
+
+  def segment(self, segment_size=SEGMENT_SIZE, codec="gzip"):
+    """Store the authority as compressed segments from now on (see segments.py)"""
+    self.write()
+    with open_locked(self.filename) as stream:
+      segment_log(stream, self._reader.manifest, segment_size, codec)
+      # Only lazy loading uses the offsets sidecar, and it can't read segments
+      if OffsetIndex.exists(self.filename):
+        os.unlink(OffsetIndex(self.filename).filename)
+
+  def compact(self, archive=False):
+    """Rewrite the authority file as the minimal command sequence for its state.
+
+    The rewrite is atomic, and refuses to run if another process is writing
+    to the authority. If archive is set, the full history is kept alongside
+    in a timestamped archive file, whose name is returned.
+
+    A segmented authority is instead checkpointed: the head is sealed, and
+    the compacted history of every segment written as a checkpoint, for
+    loading to start from. The full history stays in the segments."""
+    self.write()
+    if SegmentManifest.exists(self.filename):
+      return self._checkpoint()
+    with open(self.filename, "r+") as stream:
+      try:
+        lock_file(stream, blocking=False)
+      except (IOError, OSError):
+        raise AuthorityFileError("Authority {} is being written by another process".format(self.filename))
+      # Re-read under the lock, so that anything appended since loading is kept
+      current = Authority()
+      current._process_commands(parse_authority(stream))
+      commands = current.compacted_commands()
+
+      temp_name = "{}.compact{}".format(self.filename, os.getpid())
+      with open(temp_name, "w") as output:
+        for command in commands:
+          output.write(format_command(command))
+        output.flush()
+        os.fsync(output.fileno())
+        compacted = os.fstat(output.fileno())
+      check = Authority()
+      with open(temp_name) as output:
+        check._process_commands(parse_authority(output))
+      if _authority_state(check._data) != _authority_state(current._data):
+        os.unlink(temp_name)
+        raise AuthorityFileError("Compacted authority does not reproduce {}".format(self.filename))
+
+      archive_name = None
+      if archive:
+        archive_name = "{}.archive-{}".format(self.filename, datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%S"))
+        try:
+          os.link(self.filename, archive_name)
+        except OSError:
+          shutil.copy2(self.filename, archive_name)
+      os.rename(temp_name, self.filename)
+      # Any offsets sidecar now describes the old file
+      if OffsetIndex.exists(self.filename):
+        os.unlink(OffsetIndex(self.filename).filename)
+    logger.info("Compacted {} from {} to {} commands".format(self.filename, len(current._commands), len(commands)))
+    self._data = check._data
+    self._commands = check._commands
+    self._commandindex = len(self._commands)
+    self._reader.mark(compacted.st_size, compacted.st_ino)
+    return archive_name
+
+  def _checkpoint(self):
+    try:
+      stream = open_locked(self.filename, blocking=False)
+    except (IOError, OSError):
+      raise AuthorityFileError("Authority {} is being written by another process".format(self.filename))
+    with stream:
+      # Re-read under the lock, so that anything appended since loading is kept
+      reader = LogReader(self.filename, checkpoints=True)
+      current = Authority()
+      current._process_commands(parse_authority(reader.lines(partial=True)))
+      commands = current.compacted_commands()
+      data = "".join(format_command(x) for x in commands)
+      check = Authority()
+      check._process_commands(parse_authority(data.splitlines(True)))
+      if _authority_state(check._data) != _authority_state(current._data):
+        raise AuthorityFileError("Compacted authority does not reproduce {}".format(self.filename))
+      seal(stream, reader.manifest, force=True)
+      write_checkpoint(reader.manifest, data.encode("utf-8"))
+    logger.info("Checkpointed {} as {} commands".format(self.filename, len(commands)))
+    self._data = check._data
+    self._commands = check._commands
+    self._commandindex = len(self._commands)
+    self._reader = reader
+    return None
+
+class LazyFileAuthority(LocalFileAuthority):
+  def __init__(self, filename):
+    """A read-only local authority that only loads the sets and files used.
+
+    The offsets sidecar (built or extended here if needed) says which log
+    lines affect each entry, so looking up a set reads just the lines for
+    that set and its files, rather than the whole authority."""
+    super(LocalFileAuthority, self).__init__()
+    if SegmentManifest.exists(filename):
+      raise AuthorityFileError("Segmented authority {} can't be loaded lazily".format(filename))
+    self.filename = filename
+    self.index = None
+    self.staged = None
+    self._reader = LogReader(filename)
+    self._offsets = OffsetIndex(filename)
+    self._loaded = set()
+    self._applied = set()
+    self._index_log()
+
+  def _index_log(self):
+    """Load the sidecar, and record anything in the log it doesn't cover"""
+    stats = os.stat(self.filename)
+    self._offsets.load(stats.st_ino)
+    self._reader.mark(stats.st_size, stats.st_ino)
+    for start, end in self._offsets.gaps(stats.st_size):
+      self._index_lines(start, end)
+    self._offsets.flush()
+
+  def _index_lines(self, start, end=None):
+    """Record the commands in a range of the log in the sidecar, and return them.
+
+    With no end, reads to the last complete line and continues from there
+    on refresh."""
+    reader = LogReader(self.filename)
+    reader.mark(start, None)
+    commands = []
+    for offset, length, line in reader.lines_with_offsets():
+      if end is not None and offset >= end:
+        break
+      for command in parse_authority([line]):
+        self._offsets.record(offset, length, command)
+        commands.append(command)
+    self._offsets.span(start, reader.offset if end is None else end)
+    if end is None:
+      self._reader = reader
+    return commands
+
+  def _load(self, ids, reload=False):
+    """Replay the log lines for some entries, and anything they depend on.
+
+    Entries that are already loaded are skipped, unless reload is set, in
+    which case any of their lines not yet applied are replayed. Lines that
+    change many entries at once (e.g. createfiles) are only applied to the
+    entries being loaded, so that they don't pull the others in too."""
+    queue = [str(x) for x in ids]
+    if not reload:
+      queue = [x for x in queue if not x in self._loaded]
+    seen = set()
+    commands = {}
+    wanted = collections.defaultdict(set)
+    with open(self.filename, "rb") as stream:
+      while queue:
+        entry = queue.pop()
+        if entry in seen:
+          continue
+        seen.add(entry)
+        self._loaded.add(entry)
+        for offset, length in self._offsets.offsets.get(entry, []):
+          if (offset, entry) in self._applied:
+            continue
+          wanted[offset].add(entry)
+          if offset in commands:
+            continue
+          stream.seek(offset)
+          for command in parse_authority([stream.read(length).decode("utf-8")]):
+            commands[offset] = command
+            queue.extend(str(x) for x in command.requires() if not str(x) in self._loaded)
+    for offset in sorted(commands):
+      command = commands[offset].for_targets(wanted[offset])
+      logger.debug("Applying {}".format(str(command)))
+      self._data.apply(command)
+      self._commands.append(command)
+      self._applied.update((offset, x) for x in wanted[offset])
+    self._commandindex = len(self._commands)
+    self._attach_instances(x for x in seen if x in self._data.files)
+
+  def _attach_instances(self, file_ids):
+    # Staged copies (see staging.apply_staged) go last, to be preferred
+    indexes = [x for x in [self.index, self.staged] if x is not None]
+    for file_id in file_ids:
+      instances = self._data.files[file_id].instances
+      for index in indexes:
+        entry = index._data.get(file_id)
+        if entry is not None and not entry in instances:
+          instances.append(entry)
+
+  def _candidates(self, name_or_id):
+    key = name_or_id.lower()
+    names = self._offsets.names
+    return [x for x in self._offsets.sets if x.lower().startswith(key)
+                                          or (names.get(x) or "").lower() == key]
+
+  def fetch_dataset(self, name_or_id):
+    self._load(self._candidates(name_or_id))
+    return super(LazyFileAuthority, self).fetch_dataset(name_or_id)
+
+  def fetch_datasets(self, names_or_ids):
+    self._load(itertools.chain(*[self._candidates(x) for x in names_or_ids]))
+    return super(LazyFileAuthority, self).fetch_datasets(names_or_ids)
+
+  def __getitem__(self, id):
+    self._load([id])
+    return super(LazyFileAuthority, self).__getitem__(id)
+
+  def search(self, tags):
+    self._load(self._offsets.sets)
+    return super(LazyFileAuthority, self).search(tags)
+
+  def digests(self):
+    self._load(self._offsets.sets)
+    return super(LazyFileAuthority, self).digests()
+
+  def get_file(self, fileid):
+    self._load([fileid])
+    return super(LazyFileAuthority, self).get_file(fileid)
+
+  def apply_index(self, index):
+    self.index = index
+    self._attach_instances(list(self._data.files))
+
+  def apply_index_entries(self, entries):
+    self._attach_instances([x.hashsum for x in entries if x.hashsum in self._data.files])
+
+  def _read_appended(self):
+    if self._reader.replaced():
+      logger.info("Authority file {} was replaced; reloading".format(self.filename))
+      loaded = self._loaded
+      self._data = AuthorityData()
+      self._commands = []
+      self._loaded = set()
+      self._applied = set()
+      self._index_log()
+      self._load(loaded)
+      return True
+    # Writers record their lines in the sidecar, so only index what they haven't
+    self._index_log()
+    self._load(self._loaded, reload=True)
+    return False
+
+  def write(self):
+    if self._commandindex != len(self._commands):
+      raise AuthorityFileError("Lazily loaded authority {} is read-only".format(self.filename))
+
+  def compact(self, archive=False):
+    raise AuthorityFileError("Lazily loaded authorities cannot be compacted")
 
 class RemoteDeploymentAuthority(Authority):
   def __init__(self, filename):
@@ -236,3 +880,41 @@ class RemoteDeploymentAuthority(Authority):
       self._data.files[fileinstance.hashsum].instances.append(fileinstance)
 
 
+
+class CachedRemoteAuthority(Authority):
+  def __init__(self, url, cache_dir=None):
+    """A read-only authority at a http(s):// or file:// URL.
+
+    A local copy is cached, and updates only fetch and apply the commands
+    appended to the remote since the last fetch."""
+    super(CachedRemoteAuthority, self).__init__()
+    self.url = url
+    self._cache = RemoteLogCache(url, cache_dir)
+    self._offset = 0
+    self.refresh()
+
+  def refresh(self):
+    """Fetch and apply anything appended to the remote authority"""
+    replaced, length = self._cache.sync()
+    reloaded = replaced and self._offset > 0
+    if replaced and self._offset:
+      logger.info("Remote authority {} was rewritten; reloading".format(self.url))
+      self._data = AuthorityData()
+      self._commands = []
+    if replaced:
+      self._offset = 0
+    self._process_commands(parse_authority(read_lines(self._cache.filename, self._offset, length)))
+    self._offset = length
+    self._commandindex = len(self._commands)
+    return reloaded
+
+  def apply_index(self, index):
+    """Attach index instances for the files this authority knows about"""
+    self.index = index
+    for f in index._data.values():
+      if f.hashsum in self._data.files:
+        self._data.files[f.hashsum].instances.append(f)
+
+  def write(self):
+    if self._commandindex != len(self._commands):
+      raise AuthorityFileError("Remote authority {} is read-only".format(self.url))
@@ -5,7 +5,10 @@ import uuid
 import hashlib
 import glob
 
-from .util import first
+from .util import first, ordered_map
+
+class MissingDatafileError(IOError):
+  pass
 
 def hashfile(filename):
   hasher = hashlib.sha1()
@@ -16,6 +19,10 @@ def hashfile(filename):
       data = ofile.read(4096)
   return hasher.hexdigest()
 
+def hash_files(filenames, workers=None):
+  """Hash files in a pool of threads, yielding (filename, hash) in order"""
+  return ordered_map(lambda x: (x, hashfile(x)), filenames, workers)
+
 class _FileIndexStore(object):
   path = None
   entries = None
@@ -31,9 +38,12 @@ class _FileIndexStore(object):
 
 
 class DataFile(object):
-  def __init__(self, _id, instances=None):
+  def __init__(self, _id, instances=None, size=None, entry=None):
     self.id = _id
     self.instances = instances or []
+    self.size = size
+    # The instance the file was created from in the authority, if known
+    self.entry = entry
     self.tags = set()
     self.attrs = {}
 
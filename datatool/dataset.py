@@ -3,6 +3,7 @@
 import os
 import uuid
 import hashlib
+import itertools
 
 class Dataset(object):
   def __init__(self, setid=None):
@@ -27,3 +28,76 @@ class Dataset(object):
     return "<Dataset {}:{} files, [{}]>".format(self.id, len(self.files), ",".join(self.tags))
 
 
+
+class VirtualDataset(Dataset):
+  """A dataset defined in terms of other sets, rather than a list of files.
+
+  The definition is either a base set narrowed to the files carrying all of
+  a list of tags:
+
+    {"op": "filter", "sets": [base_id], "tags": [tag, ...]}
+
+  or a union, intersection or difference of other sets (each possibly
+  virtual itself), in order:
+
+    {"op": "union"|"intersection"|"difference", "sets": [id, ...]}
+
+  The files are only worked out when asked for, and kept until any of the
+  base sets (or, for a filter, the tags of any file) change."""
+  operations = ("filter", "union", "intersection", "difference")
+
+  def __init__(self, setid, definition, data):
+    # Not Dataset.__init__, as files can't be assigned
+    self.id = setid
+    self.tags = set()
+    self.attrs = {}
+    self.definition = definition
+    self._data = data
+    self._cache = (None, [])
+
+  @property
+  def bases(self):
+    return [str(x) for x in self.definition["sets"]]
+
+  def version(self):
+    """A key that changes whenever anything this set is evaluated from does"""
+    versions = []
+    for base_id in self.bases:
+      base = self._data.datasets.get(base_id)
+      if isinstance(base, VirtualDataset):
+        versions.append(base.version())
+      else:
+        versions.append((base_id, base is not None, self._data.version(base_id)))
+    if self.definition["op"] == "filter":
+      versions.append(self._data.file_tags_version)
+    return tuple(versions)
+
+  def _evaluate(self):
+    op = self.definition["op"]
+    bases = [self._data.datasets.get(x) for x in self.bases]
+    members = [x.files if x is not None else [] for x in bases]
+    if op == "filter":
+      tags = set(x.lower() for x in self.definition["tags"])
+      return [x for x in members[0] if tags.issubset(y.lower() for y in x.tags)]
+    if op == "union":
+      seen = set()
+      files = []
+      for datafile in itertools.chain(*members):
+        if not datafile.id in seen:
+          seen.add(datafile.id)
+          files.append(datafile)
+      return files
+    others = [set(y.id for y in x) for x in members[1:]]
+    if op == "intersection":
+      return [x for x in members[0] if all(x.id in y for y in others)]
+    return [x for x in members[0] if not any(x.id in y for y in others)]
+
+  @property
+  def files(self):
+    version = self.version()
+    if self._cache[0] != version:
+      self._cache = (version, self._evaluate())
+    return self._cache[1]
+
+  def __repr__(self):
+    return "<VirtualDataset {}:{} of {}>".format(self.id, self.definition["op"], ",".join(self.bases))
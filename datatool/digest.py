@@ -0,0 +1,100 @@
+# coding: utf-8
+
+"""Content digests of datasets, and a Merkle tree over them.
+
+Each dataset has a digest over its sorted member hashes, tags and
+attributes. The DigestTree buckets the dataset digests by the first few
+characters of the set id, and each node's digest covers its children, so
+two authorities can be compared from the root down, only descending into
+the branches that differ. Finding the datasets that differ then takes
+O(changes * log n) digest comparisons, rather than comparing every set.
+"""
+
+import json
+import hashlib
+import collections
+
+EMPTY_DIGEST = hashlib.sha1(b"").hexdigest()
+
+def dataset_digest(dataset):
+  """The digest of a dataset's members, tags and attributes"""
+  content = [sorted(x.id for x in dataset.files), sorted(dataset.tags), dataset.attrs]
+  return hashlib.sha1(json.dumps(content, sort_keys=True).encode("utf-8")).hexdigest()
+
+class DigestTree(object):
+  """A Merkle tree of dataset digests, bucketed by set id prefix"""
+  def __init__(self, depth=3):
+    self.depth = depth
+    self._leaves = collections.defaultdict(dict)
+    self._children = collections.defaultdict(set)
+    self._nodes = {}
+
+  def __len__(self):
+    return sum(len(x) for x in self._leaves.values())
+
+  def _bucket(self, set_id):
+    return set_id.lower()[:self.depth]
+
+  def _invalidate(self, bucket):
+    for length in range(len(bucket) + 1):
+      self._nodes.pop(bucket[:length], None)
+
+  def __setitem__(self, set_id, digest):
+    bucket = self._bucket(set_id)
+    if self._leaves[bucket].get(set_id) == digest:
+      return
+    self._leaves[bucket][set_id] = digest
+    for length in range(len(bucket)):
+      self._children[bucket[:length]].add(bucket[:length+1])
+    self._invalidate(bucket)
+
+  def discard(self, set_id):
+    bucket = self._bucket(set_id)
+    if not set_id in self._leaves.get(bucket, {}):
+      return
+    del self._leaves[bucket][set_id]
+    if not self._leaves[bucket]:
+      del self._leaves[bucket]
+      # Prune any branches left empty
+      for length in reversed(range(len(bucket))):
+        node, child = bucket[:length], bucket[:length+1]
+        if self._children.get(child) or child in self._leaves:
+          break
+        self._children[node].discard(child)
+    self._invalidate(bucket)
+
+  def children(self, prefix=""):
+    """Map each child of a node to its digest. The children of a bucket are set ids."""
+    if prefix in self._leaves:
+      return dict(self._leaves[prefix])
+    return {x: self.digest(x) for x in self._children.get(prefix, ())}
+
+  def digest(self, prefix=""):
+    """The digest of a node, covering everything below it"""
+    if not prefix in self._nodes:
+      children = self.children(prefix)
+      if not children:
+        return EMPTY_DIGEST
+      content = "".join("{} {}\n".format(x, y) for x, y in sorted(children.items()))
+      self._nodes[prefix] = hashlib.sha1(content.encode("utf-8")).hexdigest()
+    return self._nodes[prefix]
+
+  def differing(self, other):
+    """The ids of the datasets whose digests differ, including any only one tree has.
+
+    Only digest() and children() of the other tree are used, and only for
+    the nodes on the branches that differ."""
+    results = []
+    stack = [""]
+    while stack:
+      prefix = stack.pop()
+      if self.digest(prefix) == other.digest(prefix):
+        continue
+      mine, theirs = self.children(prefix), other.children(prefix)
+      changed = [x for x in set(mine) | set(theirs) if mine.get(x) != theirs.get(x)]
+      if len(prefix) == self.depth:
+        results.extend(changed)
+      else:
+        # Only the children that differ need their digests compared again
+        stack.extend(changed)
+    return sorted(results)
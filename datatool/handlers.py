@@ -9,7 +9,7 @@ import dateutil.parser
 
 import six
 
-from .dataset import Dataset
+from .dataset import Dataset, VirtualDataset
 from .datafile import DataFile, FileInstance
 
 _HANDLERS = {}
@@ -48,6 +48,18 @@ class Command(object):
   def timestamp(self, value):
       self._timestamp = value
 
+  def targets(self):
+    """The ids of the entries whose state this command changes"""
+    return [self.id]
+
+  def requires(self):
+    """The ids of other entries that must exist for this command to apply"""
+    return []
+
+  def for_targets(self, ids):
+    """The command, changing only the targets in ids"""
+    return self
+
 @handles("createset")
 class CreateSetCommand(Command):
   def __init__(self, cid=None):
@@ -64,6 +76,25 @@ class CreateSetCommand(Command):
   def __str__(self):
     return "[Create Set {}]".format(self.id)
 
+@handles("createview")
+class CreateViewCommand(Command):
+  def __init__(self, cid, definition):
+    super(CreateViewCommand, self).__init__()
+    self.id = cid or uuid.uuid4().hex
+    self.definition = definition
+  @classmethod
+  def from_data(cls, data):
+    return cls(data["id"], data["definition"])
+  def to_data(self):
+    return {"id": self.id, "definition": self.definition}
+  def requires(self):
+    return [str(x) for x in self.definition["sets"]]
+  def apply(self, index):
+    assert not self.id in index.datasets
+    index[self.id] = VirtualDataset(self.id, self.definition, index)
+  def __str__(self):
+    return "[Create View {} ({} of {})]".format(self.id, self.definition["op"], ", ".join(self.requires()))
+
 @handles("deleteset")
 class DeleteSetCommand(CreateSetCommand):
   def __init__(self, cid):
@@ -85,11 +116,37 @@ class CreateFileCommand(Command):
   @classmethod
   def from_data(cls, data):
     return cls(FileInstance.from_data(data))
+  @property
+  def entries(self):
+    return [self.entry]
   def apply(self, index):
-    index[self.id] = DataFile(self.id)
+    index[self.id] = DataFile(self.id, size=self.entry.size, entry=self.entry)
   def __str__(self):
     return "[Create file {}]".format(self.id)
 
+@handles("createfiles")
+class CreateFilesCommand(Command):
+  """Create many files in a single command"""
+  def __init__(self, entries):
+    super(CreateFilesCommand, self).__init__()
+    self.entries = [FileInstance(filename=x.filename,hashsum=x.hashsum,size=x.size,timestamp=x.timestamp) for x in entries]
+  def to_data(self):
+    return {"files": [x.to_data() for x in self.entries]}
+  @classmethod
+  def from_data(cls, data):
+    return cls([FileInstance.from_data(x) for x in data["files"]])
+  def targets(self):
+    return [str(x.hashsum) for x in self.entries]
+  def for_targets(self, ids):
+    command = CreateFilesCommand([x for x in self.entries if str(x.hashsum) in ids])
+    command.timestamp = self.timestamp
+    return command
+  def apply(self, index):
+    for entry in self.entries:
+      index[entry.hashsum] = DataFile(str(entry.hashsum), size=entry.size, entry=entry)
+  def __str__(self):
+    return "[Create {} files]".format(len(self.entries))
+
 @handles("addfilestoset")
 class AddFilesToSetCommand(Command):
   def __init__(self, dataset, files):
@@ -101,6 +158,10 @@ class AddFilesToSetCommand(Command):
     return cls(data.get("set"), data.get("files"))
   def to_data(self):
     return {"files": self.files, "set": self.dataset}
+  def targets(self):
+    return [self.dataset]
+  def requires(self):
+    return [str(x) for x in self.files]
   def apply(self, authority):
     dataset = authority.datasets[self.dataset]
     files = [authority.files[str(x)] for x in self.files if not authority.files[x] in dataset.files]
@@ -119,6 +180,8 @@ class RmFilesFromSetCommand(Command):
     return cls(data.get("set"), data.get("files"))
   def to_data(self):
     return {"files": self.files, "set": self.dataset}
+  def targets(self):
+    return [self.dataset]
   def apply(self, authority):
     dataset = authority.datasets[self.dataset]
     dataset.files = [x for x in dataset.files if not x.id in self.files]
@@ -137,6 +200,8 @@ class AddTagsCommand(Command):
     return cls(data["id"], data["tags"])
   def to_data(self):
     return {"id": self.objId, "tags": list(self.tags)}
+  def targets(self):
+    return [self.objId]
   def apply(self, authority):
     tagee = authority[self.objId]
     tagee.tags = tagee.tags.union(self.tags)
@@ -152,6 +217,41 @@ class RemoveTagsCommand(AddTagsCommand):
   def __str__(self):
     return "[Remove tags {{{}}} from item {}]".format(", ".join(self.tags), self.objId)
 
+@handles("addtagsmany")
+class AddTagsManyCommand(Command):
+  """Add the same tags to many items in a single command"""
+  def __init__(self, ids, tags):
+    super(AddTagsManyCommand, self).__init__()
+    self.ids = [str(x) for x in ids]
+    self.tags = set(tags)
+  @classmethod
+  def from_data(cls, data):
+    return cls(data["ids"], data["tags"])
+  def to_data(self):
+    return {"ids": self.ids, "tags": sorted(self.tags)}
+  def targets(self):
+    return self.ids
+  def for_targets(self, ids):
+    command = type(self)([x for x in self.ids if x in ids], self.tags)
+    command.timestamp = self.timestamp
+    return command
+  def apply(self, authority):
+    for objId in self.ids:
+      tagee = authority[objId]
+      tagee.tags = tagee.tags.union(self.tags)
+  def __str__(self):
+    return "[Add tags {{{}}} to {} items]".format(", ".join(self.tags), len(self.ids))
+
+@handles("removetagsmany")
+class RemoveTagsManyCommand(AddTagsManyCommand):
+  """Remove the same tags from many items in a single command"""
+  def apply(self, authority):
+    for objId in self.ids:
+      tagee = authority[objId]
+      tagee.tags = tagee.tags.difference(self.tags)
+  def __str__(self):
+    return "[Remove tags {{{}}} from {} items]".format(", ".join(self.tags), len(self.ids))
+
 @handles("setproperty")
 class SetPropertyCommand(Command):
   def __init__(self, _id, property, value):
@@ -0,0 +1,44 @@
+# coding: utf-8
+
+"""Identify which datasets files on disk belong to"""
+
+import collections
+import logging
+logger = logging.getLogger(__name__)
+
+from .datafile import hashfile
+from .util import ordered_map
+
+Identification = collections.namedtuple("Identification", ["filename", "size", "hashsum", "known", "datasets"])
+
+class Identifier(object):
+  """Looks up files against the authority by content.
+
+  Files are only hashed if their size matches some known file, and files
+  indexed with an unchanged size and mtime reuse their indexed hash."""
+  def __init__(self, authority, index):
+    self._index = index
+    self._datasets = collections.defaultdict(list)
+    for dataset in authority._data.datasets.values():
+      for datafile in dataset.files:
+        self._datasets[datafile.id].append(dataset)
+    self._known = set(authority._data.files)
+    self._sizes = set()
+    for datafile in authority._data.files.values():
+      self._sizes.update(x.size for x in datafile.instances)
+      self._sizes.add(datafile.size)
+    self._sizes.update(x.size for x in index._data.values())
+    self._sizes.discard(None)
+
+  def _identify(self, candidate):
+    size = candidate.stats.st_size
+    if not size in self._sizes:
+      return Identification(candidate.filename, size, None, False, [])
+    entry = self._index._current_entry(candidate.filename, candidate.stats)
+    hashsum = entry.hashsum if entry is not None else hashfile(candidate.filename)
+    return Identification(candidate.filename, size, hashsum, hashsum in self._known,
+                          self._datasets.get(hashsum, []))
+
+  def identify(self, candidates, workers=None):
+    """Yield an Identification for each candidate file, in order"""
+    return ordered_map(self._identify, candidates, workers)
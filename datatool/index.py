@@ -8,6 +8,7 @@ import json
 import dateutil.parser
 import logging
 import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 from six.moves import StringIO
 
@@ -17,10 +18,14 @@ logger = logging.getLogger(__name__)
 from tqdm import tqdm
 
 from .datafile import hashfile, FileInstance
-from .util import first
+from .segments import SEGMENT_SIZE, seal, segment_log
+from .util import first, open_locked, read_lines, ordered_map, LogReader
 
 reLineHeader = re.compile(r'^\s*([^\s]+)\s+(\w+)\s+([^\s]+)\s+(\w+)\s+(.*)$')
 
+# The size of each piece of the index split by a worker, when parsing in parallel
+PARSE_CHUNK_SIZE = 16*1024*1024
+
 IndexEntry = namedtuple("IndexEntry", ["date", "hashsum", "timestamp", "size", "filename"])
 
 def entry_for_file(filename):
@@ -29,6 +34,10 @@ def entry_for_file(filename):
   sha = hashfile(filename)
   return IndexEntry(datetime.datetime.utcnow(), sha, timestamp, size, filename)
 
+def format_entry(entry, date):
+  """Format an index entry as a line of the index file"""
+  return " ".join([str(x) for x in [date, entry.hashsum, entry.timestamp, entry.size, entry.filename]]) + "\n"
+
 class IndexFileError(IOError):
   pass
 
@@ -42,15 +51,37 @@ def find_index():
 
 def parse_index(indexfile):
   """Read an index file stream and returns the entry history"""
-  decoder = json.JSONDecoder()
   for num, line in enumerate(indexfile, 1):
     if line.isspace() or line.startswith('#'):
       continue
     line_data = reLineHeader.match(line)
     if not line_data:
       raise IndexFileError("Could not read index line {}".format(num))
-    date, hashsum, timestamp, size, filename = line_data.groups()
-    yield (date, FileInstance(hashsum=hashsum,timestamp=timestamp,size=size,filename=filename))
+    yield _entry_for(line_data.groups())
+
+def _entry_for(record):
+  date, hashsum, timestamp, size, filename = record
+  return (date, FileInstance(hashsum=hashsum,timestamp=timestamp,size=size,filename=filename))
+
+def _decode_range(task):
+  """Split the lines in a byte range of an index file, in a worker process"""
+  filename, start, end = task
+  records = []
+  for line in read_lines(filename, start, end):
+    if line.isspace() or line.startswith('#'):
+      continue
+    line_data = reLineHeader.match(line)
+    if not line_data:
+      raise IndexFileError("Could not read index line in bytes {}-{}".format(start, end))
+    records.append(line_data.groups())
+  return records
+
+def parse_index_parallel(reader, processes, chunk_size=None):
+  """Parse everything unread by a LogReader, splitting chunks in a process pool"""
+  tasks = reader.chunks(chunk_size or PARSE_CHUNK_SIZE)
+  for records in ordered_map(_decode_range, tasks, processes, executor=ProcessPoolExecutor):
+    for record in records:
+      yield _entry_for(record)
 
 class Index(object):
   def __init__(self):
@@ -65,12 +96,20 @@ class Index(object):
       self._names[entry.filename] = entry
       self._pending.append(entry)
 
-  def _update_if_required(self, filename):
-    assert filename in self._names
-    entry = self._names[filename]
-    fileData = os.stat(filename)
+  def _current_entry(self, filename, fileData):
+    """Return the entry for a file, if it is indexed and unchanged since"""
+    entry = self._names.get(filename)
+    if entry is None:
+      return None
     size, timestamp = (fileData.st_size, fileData.st_mtime)
     if size != entry.size or str(timestamp) != str(entry.timestamp):
+      return None
+    return entry
+
+  def _update_if_required(self, filename):
+    assert filename in self._names
+    entry = self._current_entry(filename, os.stat(filename))
+    if entry is None:
       logger.info("File {} appears to have changed, re-indexing".format(filename))
       entry = FileInstance.from_file(filename)
       self._process_entries([entry])
@@ -99,17 +138,41 @@ class Index(object):
 
 
 class LocalFileIndex(Index):
-  def __init__(self, filename):
+  """An index read from, and appended to, a local file.
+
+  If processes is given, a large file is split into entries in a pool of
+  that many processes when it is loaded (see parse_index_parallel). The
+  file may be stored as compressed segments (see segments.py)."""
+  def __init__(self, filename, processes=None):
     super(LocalFileIndex,self).__init__()
     self._filename = filename
+    self._reader = LogReader(filename)
     logger.debug("Loading index file entries...")
-    with open(filename) as index_stream:
-      self._process_entries([y for x,y in parse_index(index_stream)])
+    if processes and self._reader.size() > PARSE_CHUNK_SIZE:
+      entries = parse_index_parallel(self._reader, processes)
+    else:
+      entries = parse_index(self._reader.lines(partial=True))
+    self._process_entries([y for x,y in entries])
     logger.debug("done.")
     self._pending = []
 
+  def refresh(self):
+    """Read entries appended to the index since it was loaded, and return them"""
+    # Entries read from others are already in the file, so mustn't be written again
+    pending = list(self._pending)
+    if self._reader.replaced():
+      self._reader.reset()
+    entries = [y for x,y in parse_index(self._reader.lines())]
+    self._process_entries(entries)
+    self._pending = pending
+    return entries
+
   def write(self):
-    with open(self._filename, 'a') as stream:
+    if not self._pending:
+      return
+    with open_locked(self._filename) as stream:
+      # Catch up with other writers first, so that we don't read our own entries back
+      self.refresh()
       # Get the last byte and make sure it is a return. Otherwise, push one out
       try:
         stream.seek(-1,os.SEEK_END)
@@ -123,7 +186,17 @@ class LocalFileIndex(Index):
       # Now dump all the pending entries
       date = datetime.datetime.utcnow().isoformat()
       for entry in self._pending:
-        line = " ".join([str(x) for x in [date, entry.hashsum, entry.timestamp, entry.size, entry.filename]]) + "\n"
+        line = format_entry(entry, date)
         logger.debug("Writing: " + line.strip())
         stream.write(line)
       self._pending = []
+      stream.flush()
+      stats = os.fstat(stream.fileno())
+      self._reader.mark(self._reader.base + stats.st_size, stats.st_ino)
+      seal(stream, self._reader.manifest)
+
+  def segment(self, segment_size=SEGMENT_SIZE, codec="gzip"):
+    """Store the index as compressed segments from now on (see segments.py)"""
+    self.write()
+    with open_locked(self._filename) as stream:
+      segment_log(stream, self._reader.manifest, segment_size, codec)
@@ -0,0 +1,113 @@
+# coding: utf-8
+
+"""Streaming, parallel ingest of files and directory trees.
+
+Ingest runs as a pipeline: a walker lists files (recursing into directories
+with os.scandir), a stat filter drops files already indexed and unchanged,
+a pool of threads hashes the rest, and the results are committed to the
+index (and optionally a dataset in the authority) in batches. Each batch is
+written before the next starts, so an interrupted ingest can simply be run
+again; everything already committed is skipped without being rehashed.
+"""
+
+import os
+import fnmatch
+import logging
+logger = logging.getLogger(__name__)
+
+from tqdm import tqdm
+
+from .datafile import FileInstance, hashfile
+from .util import ordered_map
+
+class _Candidate(object):
+  """A file found by the walker, with its stat result"""
+  def __init__(self, filename, stats):
+    self.filename = filename
+    self.stats = stats
+
+def _matches(path, patterns):
+  name = os.path.basename(path)
+  return any(fnmatch.fnmatch(name, x) or fnmatch.fnmatch(path, x) for x in patterns)
+
+def _included(path, include, exclude):
+  if exclude and _matches(path, exclude):
+    return False
+  return not include or _matches(path, include)
+
+def walk_files(paths, recursive=False, include=None, exclude=None):
+  """Yield the files, with their stat results, from a list of files and directories.
+
+  Directories are only descended into if recursive is set. The include and
+  exclude patterns are matched against both the name and the full path of
+  each file found in a directory; exclude patterns also prune directories.
+  Explicitly named files are always included."""
+  for path in paths:
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+      yield _Candidate(path, os.stat(path))
+      continue
+    if not recursive:
+      logger.warning("Skipping directory {} (use --recursive to descend)".format(path))
+      continue
+    stack = [path]
+    while stack:
+      current = stack.pop()
+      try:
+        entries = sorted(os.scandir(current), key=lambda x: x.name)
+      except OSError as e:
+        logger.warning("Could not read directory {}: {}".format(current, e))
+        continue
+      subdirs = []
+      for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+          if not (exclude and _matches(entry.path, exclude)):
+            subdirs.append(entry.path)
+        elif entry.is_file() and _included(entry.path, include, exclude):
+          yield _Candidate(entry.path, entry.stat())
+      stack.extend(reversed(subdirs))
+
+def _batches(items, size):
+  batch = []
+  for item in items:
+    batch.append(item)
+    if len(batch) >= size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+def ingest(index, candidates, authority=None, set_id=None, batch_size=1000, workers=None):
+  """Index a stream of candidate files, optionally adding them to a set.
+
+  Returns the number of files ingested."""
+  existing = set()
+  if authority is not None:
+    existing = set(x.id for x in authority[set_id].files)
+
+  def _entry_for(candidate):
+    # Anything the index already has, unchanged, is not rehashed
+    entry = index._current_entry(candidate.filename, candidate.stats)
+    if entry is not None:
+      return entry, False
+    return FileInstance(candidate.filename, hashsum=hashfile(candidate.filename),
+                        size=candidate.stats.st_size, timestamp=candidate.stats.st_mtime), True
+
+  count = 0
+  progress = tqdm(unit="files", leave=False)
+  try:
+    for batch in _batches(ordered_map(_entry_for, candidates, workers), batch_size):
+      index._process_entries([x for x, new in batch if new])
+      index.write()
+      if authority is not None:
+        to_add = [x for x, _ in batch if not x.hashsum in existing]
+        if to_add:
+          authority.add_files(set_id, to_add)
+          authority.write()
+          existing.update(x.hashsum for x in to_add)
+      count += len(batch)
+      progress.update(len(batch))
+      logger.debug("Committed batch of {} files ({} total)".format(len(batch), count))
+  finally:
+    progress.close()
+  return count
@@ -3,18 +3,25 @@
 """Manage data sets and locations.
 
 Usage:
-  data [options] set create [--name=<name>] <file> [<file>...]
-  data [options] set addfiles <name-or-id> <file> [<file>...]
+  data [options] set create [--name=<name>] [-r] [--include=<pattern>...] [--exclude=<pattern>...] <file> [<file>...]
+  data [options] set addfiles [-r] [--include=<pattern>...] [--exclude=<pattern>...] <name-or-id> <file> [<file>...]
   data [options] set rmfiles <name-or-id> <file-or-hash> [<file-or-hash>...]
   data [options] set delete <name-or-id>
   data [options] set rename <name-or-id> <name>
+  data [options] set view [--name=<name>] <name-or-id> <tag> [<tag>...]
+  data [options] set combine [--name=<name>] (--union | --intersection | --difference) <set>...
   data [options] tag [-d] (<name-or-id-or-file>) <tag> [<tag>...]
   data [options] tag [-d] --tag=<tag> [--tag=<tag>...] <name-or-id-or-file>...
-  data [options] index <file> [<file>...]
-  data [options] files [--wildcard] <name-or-id> [<tag> [<tag>...]]
+  data [options] index [-r] [--include=<pattern>...] [--exclude=<pattern>...] <file> [<file>...]
+  data [options] files [--wildcard] [--stage] <name-or-id> [<tag> [<tag>...]]
   data [options] search <tag> [<tag>...]
-  data [options] identify <file> [<file>...]
+  data [options] identify [-r] [--include=<pattern>...] [--exclude=<pattern>...] <file> [<file>...]
   data [options] sets [--all]
+  data [options] snapshot <output>
+  data [options] compact [--archive]
+  data [options] segment [--segment-size=<size>] [--codec=<codec>]
+  data [options] verify [--full] [--bandwidth=<rate>] [--state=<file>] <set>...
+  data [options] sync <other-authority>
 
 Options:
   --authority=<auth>  Use a specific data authority
@@ -23,26 +30,62 @@ Options:
   -t, --tag=<tag>     Explicitly specify tags when adding to multiple items
   -d, --delete        Remove given tags from a dataset instead of adding
   -1                  Output only one (filename, set) per line. For parsing.
+                      Lines are written as they are found
+  --format=<fmt>      Output files and sets as text, tsv or jsonl, written
+                      as they are found [default: text]
   -w, --wildcard      Attempt to output filenames as wildcards
+  --stage             Copy the files into the local staging cache first
   -a, --all           Show all entries, even empty ones
+  -r, --recursive     Descend into directories given in place of files
+  --include=<pattern> Only take files matching a pattern from directories
+  --exclude=<pattern> Skip files and directories matching a pattern
+  -j, --jobs=<n>      Number of files to hash in parallel
+  --batch=<n>         Number of files to commit at a time [default: 1000]
+  -p, --processes=<n> Parse large authority and index files in parallel
+  --archive           Keep the full history in an archive file when compacting
+  --segment-size=<size>  Seal the uncompressed head of the authority and index
+                      into a new segment at this size [default: 64M]
+  --codec=<codec>     Compress segments with gzip or zstd [default: gzip]
+  --union             Combine sets into a set of the files in any of them
+  --intersection      Combine sets into a set of the files in all of them
+  --difference        Combine sets into the files of the first not in the rest
+  --full              Verify file hashes, as well as sizes and timestamps
+  --bandwidth=<rate>  Limit hashing to a read rate, in bytes/s e.g. 200M
+  --state=<file>      Checkpoint verification to a file, resuming from it
 
 Commands:
   set           Manipulate and create data sets
   set create    Create a new data set, optionally named, with a file list
-  set addfiles  Add a set of files to a dataset
+  set addfiles  Add a set of files to a dataset. Also resumes an interrupted
+                set create, as already committed files are skipped
   set rmfiles   Remove files from a dataset
   set delete    Remove a dataset.
   set rename    Name, or rename, a dataset
+  set view      Create a virtual set of the files in a set with all the tags
+  set combine   Create a virtual set combining other sets. Virtual sets follow
+                changes to the sets they are made from
   tag           Add a tag (or list of tags) to a dataset, or a file, or several
   index         Explicitly add a set of files to the index
   files         Retrieve the file list for a specific data set
   search        Find a list of dataset names matching a list of tags
   identify      Find any datasets containing any given files
   sets          List all non-empty data sets
+  compact       Rewrite the authority as the minimal history for its state.
+                Checkpoints a segmented authority instead
+  segment       Store the authority and index as compressed segments, with
+                only the latest lines kept uncompressed
+  snapshot      Export the authority to a binary, memory-mappable snapshot
+  verify        Check the files of data sets against their recorded size,
+                timestamp and hash. Writes a JSON line for each mismatch
+  sync          Bring the authority up to date with another (a file or URL),
+                appending only the changes to the sets that differ
 """
 
 from __future__ import print_function
 import itertools
+import json
+import time
+import errno
 import glob
 import sys, os
 import logging
@@ -52,8 +95,12 @@ logging.basicConfig(level=logging.INFO, stream=sys.stderr)
 from docopt import docopt
 
 from .index import find_index, LocalFileIndex
-from .authority import find_authority, LocalFileAuthority
-from .util import first, get_wildcards
+from .authority import find_authority, open_authority, LocalFileAuthority
+from .snapshot import write_snapshot
+from .ingest import walk_files, ingest
+from .identify import Identifier
+from .staging import StagingCache, apply_staged
+from .util import first, get_wildcards, parse_size
 from .datafile import FileInstance
 
 class ArgumentError(RuntimeError):
@@ -86,6 +133,66 @@ def print_sets(sets):
       "(no read)" if not dataSet.can_read() else " "*9, str(len(dataSet.files)).rjust(lenlen),
       tagMessage))
 
+def _file_rows(dataset, tagfilter):
+  """Yield (name, message, tags, datafile) for each file in a set, as it is resolved"""
+  for datafile in dataset.files:
+    # Check that this file contains all the tags passed in
+    if not tagfilter.issubset(set(x.lower() for x in datafile.tags)):
+      continue
+    # Find the last instance that exists
+    valid = datafile.get_valid_instance()
+    if valid:
+      yield (valid.filename, "", datafile.tags, datafile)
+    elif not datafile.instances:
+      yield (datafile.id, "(no meta)", datafile.tags, datafile)
+    else:
+      yield (first(datafile.instances).filename, "(no read)", datafile.tags, datafile)
+
+def _format_file_row(row, output_format, names_only=False):
+  name, msg, tags, datafile = row
+  if output_format == "jsonl":
+    return json.dumps({"path": name, "hash": datafile.id, "status": msg.strip("()") or "ok",
+                       "tags": sorted(tags)})
+  elif output_format == "tsv" and not names_only:
+    return "\t".join([name, datafile.id, msg.strip("()") or "ok", ",".join(sorted(tags))])
+  return name
+
+def _format_set_row(dataset, output_format):
+  if output_format == "jsonl":
+    return json.dumps({"id": dataset.id, "name": dataset.name, "files": len(dataset.files),
+                       "tags": sorted(dataset.tags)})
+  elif output_format == "tsv":
+    return "\t".join([dataset.id, dataset.name or "", str(len(dataset.files)), ",".join(sorted(dataset.tags))])
+  return "{} {}".format(dataset.id, dataset.name or "")
+
+def write_lines(lines, block_size=1000, interval=1.0):
+  """Write lines to stdout as they are generated, flushing them in blocks.
+
+  A block is written when it is full, or once interval seconds have passed,
+  so that a slow generator still shows progress. If the reader goes away
+  (e.g. piping to head), writing just stops. Returns False in that case."""
+  block = []
+  last_write = time.time()
+  try:
+    for line in lines:
+      block.append(line)
+      if len(block) >= block_size or time.time() - last_write > interval:
+        sys.stdout.write("\n".join(block) + "\n")
+        sys.stdout.flush()
+        block = []
+        last_write = time.time()
+    if block:
+      sys.stdout.write("\n".join(block) + "\n")
+      sys.stdout.flush()
+  except IOError as e:
+    if e.errno != errno.EPIPE:
+      raise
+    # Stop python complaining when it flushes stdout again at exit
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    return False
+  return True
+
 def main():
   "setup.py entry_points main"
   sys.exit(run_main(sys.argv))
@@ -99,47 +206,59 @@ def run_main(argv):
     globs = [glob.glob(x) or [x] for x in args.get(filearg, [])]
     args[filearg] = list(itertools.chain(*globs))
 
+  if not args["--format"] in ("text", "tsv", "jsonl"):
+    raise ArgumentError("Unknown output format {}".format(args["--format"]))
+
   # Find the data index file
   authority_name, index_name = find_sources(args["--authority"], args["--index"])
-  authority = LocalFileAuthority(authority_name)
-  index = LocalFileIndex(index_name)
+  processes = int(args["--processes"]) if args["--processes"] else None
+  authority = open_authority(authority_name, processes=processes)
+  if args["compact"]:
+    if not isinstance(authority, LocalFileAuthority):
+      raise ArgumentError("Only local authority files can be compacted")
+    # Must happen before merging the index, which is not part of the authority
+    archive = authority.compact(archive=args["--archive"])
+    if archive:
+      logger.info("Full history archived to {}".format(archive))
+    return 0
+  if args["segment"]:
+    if not isinstance(authority, LocalFileAuthority):
+      raise ArgumentError("Only local authority files can be segmented")
+    segment_size = parse_size(args["--segment-size"])
+    authority.segment(segment_size, args["--codec"])
+    LocalFileIndex(index_name, processes=processes).segment(segment_size, args["--codec"])
+    return 0
+  index = LocalFileIndex(index_name, processes=processes)
   authority.apply_index(index)
+  apply_staged(authority)
 
   if args["set"]:
     process_set(args, authority, index)
   elif args["index"]:
-    index.add_files(args["<file>"])
+    ingest_files(args, index)
   elif args["files"]:
     dataset = authority.fetch_dataset(args['<name-or-id>'])
     tagfilter = set(x.lower() for x in args["<tag>"])
-    entries = []
-    for datafile in dataset.files:
-      # Find the last instance that exists
-      valid = datafile.get_valid_instance()
-      # Check that this file contains all the tags passed in
-      if not tagfilter.issubset(set(x.lower() for x in datafile.tags)):
-        continue
-      if valid:
-        entries.append((valid.filename, "", datafile.tags))
-      elif not datafile.instances:
-        entries.append((datafile.id, "(no meta)", datafile.tags))
-      else:
-        entries.append((first(datafile.instances).filename, "(no read)", datafile.tags))
-    if entries:
-      if args["--wildcard"]:
+    if args["--stage"]:
+      StagingCache().stage([x for x in dataset.files if tagfilter.issubset(y.lower() for y in x.tags)],
+                           workers=int(args["--jobs"]) if args["--jobs"] else None)
+    rows = _file_rows(dataset, tagfilter)
+    if (args["--format"] != "text" or args["-1"]) and not args["--wildcard"]:
+      # Stream rows out as they are resolved, rather than lining them up
+      write_lines(_format_file_row(row, args["--format"], args["-1"]) for row in rows)
+    else:
+      entries = list(rows)
+      if entries and args["--wildcard"]:
         # Only use filenames, and reduce the list
-        reduced_entries = get_wildcards(x for x,_,_ in entries)
+        reduced_entries = get_wildcards(x for x,_,_,_ in entries)
         print ("\n".join(reduced_entries))
-      else:
+      elif entries:
         nameLen = max(len(x[0]) for x in entries)
-        for name, msg, tags in entries:
+        for name, msg, tags, _ in entries:
           tagtext = ""
-          if args["-1"]:
-            print (name)
-          else:
-            if tags:
-              tagtext = "Tags: " + ", ".join(tags)
-            print ("{} {}  {}".format(name.ljust(nameLen), msg.ljust(9), tagtext))
+          if tags:
+            tagtext = "Tags: " + ", ".join(tags)
+          print ("{} {}  {}".format(name.ljust(nameLen), msg.ljust(9), tagtext))
 
   elif args["search"]:
     sets = [authority.fetch_dataset(x) for x in authority.search(args["<tag>"])]
@@ -147,15 +266,28 @@ def run_main(argv):
     print_sets(sets)
 
   elif args["identify"]:
-    assert False
+    identify_files(args, authority, index)
   elif args["sets"]:
     sets = authority._data.datasets.values()
     if not args["--all"]:
-      sets = [x for x in sets if x.files]
-    print_sets(sets)
+      sets = (x for x in sets if x.files)
+    if args["--format"] != "text" or args["-1"]:
+      write_lines(_format_set_row(x, args["--format"]) for x in sets)
+    else:
+      print_sets(list(sets))
+  elif args["snapshot"]:
+    write_snapshot(authority, args["<output>"])
+  elif args["verify"]:
+    return verify_sets(args, authority)
+  elif args["sync"]:
+    if not isinstance(authority, LocalFileAuthority):
+      raise ArgumentError("Only local authority files can be synced")
+    applied = authority.sync(open_authority(args["<other-authority>"]))
+    logger.info("Applied {} changes from {}".format(len(applied), args["<other-authority>"]))
   elif args["tag"]:
     tagees = args["<name-or-id-or-file>"]
     tags = set(args["--tag"]).union(args["<tag>"])
+    tagee_ids = []
     for tageeName in tagees:
       tagee = first([x for x in authority._data.values() if x.id.startswith(tageeName)])
       if not tagee:
@@ -168,11 +300,13 @@ def run_main(argv):
       if not tagee:
         logger.error("Could not find entry from criteria '{}'".format(tageeName))
         return 1
+      tagee_ids.append(tagee.id)
 
-      if args["--delete"]:
-        authority.remove_tags(tagee.id, tags)
-      else:
-        authority.add_tags(tagee.id, tags)
+    # Tag everything at once, rather than writing a line per item
+    if args["--delete"]:
+      authority.remove_tags_many(tagee_ids, tags)
+    else:
+      authority.add_tags_many(tagee_ids, tags)
 
 
   # Write any changes to the index
@@ -180,18 +314,70 @@ def run_main(argv):
   index.write()
   return 0
 
+def ingest_files(args, index, authority=None, set_id=None):
+  """Index the files (and directories) given, adding them to a set if given"""
+  candidates = walk_files(args["<file>"], recursive=args["--recursive"],
+                          include=args["--include"], exclude=args["--exclude"])
+  jobs = int(args["--jobs"]) if args["--jobs"] else None
+  return ingest(index, candidates, authority=authority, set_id=set_id,
+                batch_size=int(args["--batch"]), workers=jobs)
+
+def identify_files(args, authority, index):
+  """Print the sets containing each file given, and summarise unknown files"""
+  candidates = walk_files(args["<file>"], recursive=args["--recursive"],
+                          include=args["--include"], exclude=args["--exclude"])
+  jobs = int(args["--jobs"]) if args["--jobs"] else None
+  counts = {"total": 0, "sets": 0, "known": 0, "unknown": 0}
+  unknown_size = 0
+  for result in Identifier(authority, index).identify(candidates, workers=jobs):
+    counts["total"] += 1
+    if result.datasets:
+      counts["sets"] += 1
+      message = ", ".join(x.name or x.id for x in result.datasets)
+    elif result.known:
+      counts["known"] += 1
+      message = "(in no set)"
+    else:
+      counts["unknown"] += 1
+      unknown_size += result.size
+      message = "(unknown)"
+    if args["-1"]:
+      for dataset in result.datasets:
+        print ("{} {}".format(result.filename, dataset.id))
+    else:
+      print ("{}  {}".format(result.filename, message))
+  summary = "{total} files: {sets} in sets, {known} known but in no set, {unknown} unknown".format(**counts)
+  if counts["unknown"]:
+    summary += " ({} bytes)".format(unknown_size)
+  # Keep the parseable output clean
+  print (summary, file=sys.stderr if args["-1"] else sys.stdout)
+
+def verify_sets(args, authority):
+  """Print a JSON line for each mismatched file instance in the sets"""
+  jobs = int(args["--jobs"]) if args["--jobs"] else None
+  bandwidth = parse_size(args["--bandwidth"]) if args["--bandwidth"] else None
+  count = 0
+  for mismatch in authority.verify(args["<set>"], full=args["--full"], workers=jobs,
+                                   bandwidth=bandwidth, state=args["--state"]):
+    count += 1
+    print (json.dumps(mismatch._asdict()))
+    sys.stdout.flush()
+  if count:
+    logger.warning("{} file instances did not match their records".format(count))
+    return 1
+  return 0
+
 def process_set(args, authority, index):
   if args["create"]:
     set_id = authority.create_set(name=args["--name"])
+    authority.write()
     if args["<file>"]:
       # Make sure these are added to the index
-      files = list(index.add_files(args["<file>"]))
-      authority.add_files(set_id, files)
+      ingest_files(args, index, authority, set_id)
     print (set_id)
   elif args["addfiles"]:
     dataset = authority.fetch_dataset(args['<name-or-id>'])
-    files = list(index.add_files(args["<file>"]))
-    authority.add_files(dataset.id, files)
+    ingest_files(args, index, authority, dataset.id)
   elif args["rmfiles"]:
     #   data [options] set rmfiles <name-or-id> <file-or-hash> [<file-or-hash>...]
     dataset = authority.fetch_dataset(args['<name-or-id>'])
@@ -227,5 +413,17 @@ def process_set(args, authority, index):
   elif args["rename"]:
     dataset = authority.fetch_dataset(args['<name-or-id>'])
     authority.rename_set(dataset.id, args["<name>"])
+  elif args["view"] or args["combine"]:
+    names = [args["<name-or-id>"]] if args["view"] else args["<set>"]
+    datasets = authority.fetch_datasets(names)
+    for name, dataset in zip(names, datasets):
+      if not dataset:
+        raise ArgumentError("Dataset {} does not exist!".format(name))
+    if args["view"]:
+      definition = {"op": "filter", "sets": [datasets[0].id], "tags": args["<tag>"]}
+    else:
+      op = first(x for x in ["union", "intersection", "difference"] if args["--" + x])
+      definition = {"op": op, "sets": [x.id for x in datasets]}
+    print (authority.create_view(definition, name=args["--name"]))
   else:
     raise RuntimeError("Unhandled set command!")
@@ -0,0 +1,152 @@
+# coding: utf-8
+
+"""Sidecar index of where each authority entry is changed in the log.
+
+The sidecar sits next to the authority file (as <authority>.offsets) and is
+appended to whenever the authority is written. Each record maps a log line,
+by byte offset and length, to the ids of the sets and files it changes, so a
+lazy authority can seek straight to the lines it needs. Set names are kept
+too, so that sets can be found by name without reading the log. Span
+records say which byte ranges of the log have been indexed, so that lines
+written without updating the sidecar are found and indexed later.
+
+Format, one record per line after a header naming the authority inode:
+
+  # datatool offsets <inode>
+  <offset> <length> <command> <id> [<id>...]
+  name <offset> <id> <json name>
+  span <start> <end>
+"""
+
+import os
+import json
+import collections
+import logging
+logger = logging.getLogger(__name__)
+
+from .handlers import SetPropertyCommand
+from .util import lock_file
+
+HEADER = "# datatool offsets"
+
+class OffsetIndex(object):
+  def __init__(self, authority_filename):
+    self.filename = authority_filename + ".offsets"
+    self._inode = None
+    self._rewrite = False
+    self.clear()
+
+  def clear(self):
+    self.offsets = collections.defaultdict(list)
+    self._created = set()
+    self._deleted = set()
+    self._names = {}
+    self._spans = []
+    self._pending = []
+
+  @classmethod
+  def exists(cls, authority_filename):
+    return os.path.isfile(authority_filename + ".offsets")
+
+  @property
+  def sets(self):
+    """The ids of all sets that have not been deleted"""
+    return self._created - self._deleted
+
+  @property
+  def names(self):
+    """Map of set id to current name"""
+    return {x: y for x, (_, y) in self._names.items()}
+
+  def matches(self, inode):
+    """Does the sidecar describe the authority file with this inode?
+
+    Only the header is read, so this is cheap enough to check before
+    appending records for a write."""
+    self._inode = inode
+    try:
+      with open(self.filename) as stream:
+        return stream.readline().split()[3:] == [str(inode)]
+    except IOError:
+      return False
+
+  def load(self, inode):
+    """Read the sidecar for the authority file with this inode.
+
+    If the sidecar is missing or describes a different file (e.g. before the
+    authority was compacted) it is left empty, to be rewritten on flush."""
+    self.clear()
+    self._inode = inode
+    try:
+      with open(self.filename) as stream:
+        header = stream.readline().split()
+        if header[3:] != [str(inode)]:
+          logger.info("Offsets sidecar {} is out of date; rebuilding".format(self.filename))
+          self._rewrite = True
+          return
+        for line in stream:
+          self._read_record(line.split(" ", 3))
+    except IOError:
+      self._rewrite = True
+
+  def _read_record(self, parts):
+    if parts[0] == "span":
+      self._spans.append((int(parts[1]), int(parts[2])))
+    elif parts[0] == "name":
+      self._set_name(int(parts[1]), parts[2], json.loads(parts[3]))
+    elif parts[0]:
+      ids = " ".join(parts[2:]).split()
+      self._add(int(parts[0]), int(parts[1]), ids[0], ids[1:])
+
+  def _set_name(self, offset, set_id, name):
+    if offset >= self._names.get(set_id, (-1, None))[0]:
+      self._names[set_id] = (offset, name)
+
+  def _add(self, offset, length, command, ids):
+    for entry in ids:
+      self.offsets[entry].append((offset, length))
+    if command in ("createset", "createview"):
+      self._created.update(ids)
+    elif command == "deleteset":
+      self._deleted.update(ids)
+
+  def record(self, offset, length, command):
+    """Record a command read from, or written to, the log at offset"""
+    ids = [str(x) for x in command.targets()]
+    self._add(offset, length, command.command, ids)
+    self._pending.append("{} {} {} {}\n".format(offset, length, command.command, " ".join(ids)))
+    if isinstance(command, SetPropertyCommand) and command.property == "name":
+      self._set_name(offset, str(command.id), command.value)
+      self._pending.append("name {} {} {}\n".format(offset, command.id, json.dumps(command.value)))
+
+  def span(self, start, end):
+    """Mark a byte range of the log as completely recorded"""
+    if end > start:
+      self._spans.append((start, end))
+      self._pending.append("span {} {}\n".format(start, end))
+
+  def gaps(self, size):
+    """Return the (start, end) ranges of the log that have not been recorded.
+
+    The last range runs to the end of the file, and has an end of None."""
+    gaps = []
+    position = 0
+    for start, end in sorted(self._spans):
+      if start > position:
+        gaps.append((position, start))
+      position = max(position, end)
+    if position < size:
+      gaps.append((position, None))
+    return gaps
+
+  def flush(self):
+    """Append any new records to the sidecar"""
+    if not self._pending and not self._rewrite:
+      return
+    with open(self.filename, "w" if self._rewrite else "a") as stream:
+      lock_file(stream)
+      if self._rewrite:
+        stream.write("{} {}\n".format(HEADER, self._inode))
+      stream.writelines(self._pending)
+    self._pending = []
+    self._rewrite = False
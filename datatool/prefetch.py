@@ -0,0 +1,203 @@
+# coding: utf-8
+
+"""Read dataset files ahead of an analysis job that uses them in order.
+
+A pool of threads reads the next few files into memory while the current
+one is being processed, so that the job isn't left waiting on I/O between
+files. The kernel is told which files are about to be read (with
+posix_fadvise, where available), and the memory held by files read ahead
+is capped. Files too large to fit within the cap are opened rather than
+read, and are read by the job as usual.
+
+The data can also be hashed as it is read, and checked against the hash
+recorded in the authority, without reading anything twice.
+"""
+
+import io
+import os
+import hashlib
+import collections
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+logger = logging.getLogger(__name__)
+
+from .datafile import MissingDatafileError
+
+BLOCK_SIZE = 1024*1024
+MAX_MEMORY = 256*1024*1024
+
+class HashMismatchError(IOError):
+  pass
+
+def _advise(stream):
+  if hasattr(os, "posix_fadvise"):
+    try:
+      os.posix_fadvise(stream.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+      pass
+
+class PrefetchedFile(io.BytesIO):
+  """The contents of a file read ahead into memory"""
+  def __init__(self, data, name, hashsum):
+    super(PrefetchedFile, self).__init__(data)
+    self.name = name
+    self.hashsum = hashsum
+
+class VerifyingFile(object):
+  """A file opened for reading, hashed as it is read.
+
+  Reading to the end, by any of the read methods or by iterating over its
+  lines, raises HashMismatchError if the contents don't match the recorded
+  hash. Seeking stops the check, as the data is then no longer read in
+  order."""
+  def __init__(self, name, hashsum, verify=True):
+    self.name = name
+    self.hashsum = hashsum
+    self._stream = open(name, "rb")
+    self._hasher = hashlib.sha1() if verify else None
+    _advise(self._stream)
+
+  def _check(self, data, end):
+    """Hash data as it is read, checking the hash once the end is reached"""
+    if self._hasher is None:
+      return
+    self._hasher.update(data)
+    if end:
+      hashsum, self._hasher = self._hasher.hexdigest(), None
+      if hashsum != self.hashsum:
+        raise HashMismatchError("File {} does not match its recorded hash {}".format(self.name, self.hashsum))
+
+  def read(self, size=-1):
+    data = self._stream.read(size)
+    self._check(data, size is None or size < 0 or (size and not data))
+    return data
+
+  def read1(self, size=-1):
+    data = self._stream.read1(size)
+    self._check(data, size != 0 and not data)
+    return data
+
+  def readinto(self, buffer):
+    count = self._stream.readinto(buffer)
+    self._check(memoryview(buffer)[:count], len(buffer) and not count)
+    return count
+
+  def readinto1(self, buffer):
+    count = self._stream.readinto1(buffer)
+    self._check(memoryview(buffer)[:count], len(buffer) and not count)
+    return count
+
+  def readline(self, size=-1):
+    data = self._stream.readline(size)
+    self._check(data, size != 0 and not data)
+    return data
+
+  def readlines(self, hint=-1):
+    lines, total = [], 0
+    for line in self:
+      lines.append(line)
+      total += len(line)
+      if hint is not None and 0 < hint <= total:
+        break
+    return lines
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    line = self.readline()
+    if not line:
+      raise StopIteration
+    return line
+  next = __next__
+
+  def seek(self, offset, whence=os.SEEK_SET):
+    self._hasher = None
+    return self._stream.seek(offset, whence)
+
+  def __getattr__(self, name):
+    return getattr(self._stream, name)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+def _read_file(filename, hashsum, block_size, verify):
+  """Read a whole file into a PrefetchedFile, optionally checking its hash"""
+  hasher = hashlib.sha1() if verify else None
+  blocks = []
+  with open(filename, "rb") as stream:
+    _advise(stream)
+    data = stream.read(block_size)
+    while data:
+      blocks.append(data)
+      if hasher is not None:
+        hasher.update(data)
+      data = stream.read(block_size)
+  if hasher is not None and hasher.hexdigest() != hashsum:
+    raise HashMismatchError("File {} does not match its recorded hash {}".format(filename, hashsum))
+  return PrefetchedFile(b"".join(blocks), filename, hashsum)
+
+def _resolve(datafiles):
+  """Find a readable instance of each file. Errors are yielded, to be raised in turn."""
+  for datafile in datafiles:
+    instance = datafile.get_valid_instance()
+    try:
+      if instance is None:
+        raise MissingDatafileError("Could not find a readable instance of file {}".format(datafile.id))
+      size = os.path.getsize(instance.filename)
+    except (IOError, OSError) as e:
+      yield datafile, None, 0, e
+      continue
+    yield datafile, instance.filename, size, None
+
+def _failed(error):
+  future = Future()
+  future.set_exception(error)
+  return future
+
+def open_iter(datafiles, prefetch=4, block_size=BLOCK_SIZE, max_memory=MAX_MEMORY, verify=False):
+  """Yield the data files opened for reading, in order, reading ahead of use.
+
+  Up to prefetch files past the one in use are read in a pool of threads,
+  as long as they fit within max_memory bytes along with it; the memory is freed as the
+  next file is asked for. Each is yielded as a PrefetchedFile, or, if it is
+  larger than max_memory, as an opened VerifyingFile. If verify is set, the
+  data is checked against the hash of the file, raising HashMismatchError
+  if it doesn't match. Errors reading a file ahead are only raised when the
+  files before it have been yielded."""
+  files = _resolve(datafiles)
+  pending = collections.deque()
+  upcoming = next(files, None)
+  used = 0
+  with ThreadPoolExecutor(max(1, prefetch)) as pool:
+    try:
+      while pending or upcoming is not None:
+        # Read ahead as far as the limits allow. The files are always read in
+        # order, so the next file to be used always gets its memory.
+        while upcoming is not None and len(pending) <= prefetch:
+          datafile, filename, size, error = upcoming
+          if error is not None:
+            future = _failed(error)
+          elif size > max_memory:
+            size = 0
+            future = pool.submit(VerifyingFile, filename, datafile.id, verify)
+          elif pending and used + size > max_memory:
+            break
+          else:
+            future = pool.submit(_read_file, filename, datafile.id, block_size, verify)
+          pending.append((future, size))
+          used += size
+          upcoming = next(files, None)
+        future, size = pending.popleft()
+        yield future.result()
+        used -= size
+    finally:
+      # If stopped early, don't start any more reads, and close what was opened
+      for future, _ in pending:
+        future.cancel()
+      for future, _ in pending:
+        if not future.cancelled() and future.exception() is None:
+          future.result().close()
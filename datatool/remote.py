@@ -0,0 +1,224 @@
+# coding: utf-8
+
+"""Keeps local cached copies of remote, append-only log files"""
+
+import os
+import re
+import json
+import hashlib
+import logging
+import contextlib
+logger = logging.getLogger(__name__)
+
+from six.moves.urllib.request import Request, urlopen, url2pathname
+from six.moves.urllib.parse import urlparse
+from six.moves.urllib.error import HTTPError
+
+from .util import lock_file
+
+# How much of the already-cached tail to re-fetch, to check it is unchanged
+VALIDATE_BYTES = 4096
+CHUNK_SIZE = 1024*1024
+
+reRemoteURL = re.compile(r'^(https?|file)://', re.IGNORECASE)
+reContentRange = re.compile(r'^bytes\s+(\d+)-(\d+)/(\d+|\*)$')
+
+def is_remote(location):
+  """Is this location a URL, rather than a local filename?"""
+  return bool(location and reRemoteURL.match(location))
+
+class RemoteLogError(IOError):
+  pass
+
+class _Response(object):
+  """The parts of a (possibly partial) fetch that the cache cares about"""
+  def __init__(self, stream, start, total=None, etag=None):
+    self.stream = stream
+    self.start = start
+    self.total = total
+    self.etag = etag
+
+  def read(self, size=-1):
+    return self.stream.read(size)
+
+  def close(self):
+    self.stream.close()
+
+class RemoteLogCache(object):
+  """A local copy of a remote log, updated by only fetching appended bytes.
+
+  Because the log is append-only, an update requests the range starting a
+  little before the end of the cached copy. The overlap is compared against
+  the cache to make sure the remote is still an extension of it; anything
+  else (shrinking, rewriting, a server ignoring the range) causes a full
+  refetch. Only complete lines are ever kept in the cache. Logs stored as
+  segments can't be cached, and raise RemoteLogError."""
+  def __init__(self, url, cache_dir=None):
+    self.url = url
+    cache_dir = os.path.expanduser(cache_dir or os.environ.get("DATA_CACHE") or "~/.data.cache")
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    key = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    self.filename = os.path.join(cache_dir, key + ".log")
+    self._meta_filename = os.path.join(cache_dir, key + ".json")
+    self._lock_filename = os.path.join(cache_dir, key + ".lock")
+
+  @contextlib.contextmanager
+  def _locked(self):
+    with open(self._lock_filename, "a") as lock:
+      lock_file(lock)
+      yield
+
+  def _read_meta(self):
+    try:
+      with open(self._meta_filename) as stream:
+        meta = json.load(stream)
+    except (IOError, ValueError):
+      return {}
+    if meta.get("url") != self.url or not os.path.isfile(self.filename) \
+        or os.path.getsize(self.filename) != meta.get("length"):
+      return {}
+    return meta
+
+  def _write_meta(self, meta):
+    temp_name = self._meta_filename + ".tmp"
+    with open(temp_name, "w") as stream:
+      json.dump(meta, stream)
+    os.rename(temp_name, self._meta_filename)
+
+  def _fetch(self, start, etag=None):
+    """Open the remote from a byte offset. Returns None if it is unchanged."""
+    parts = urlparse(self.url)
+    if parts.scheme.lower() == "file":
+      path = url2pathname(parts.path)
+      stats = os.stat(path)
+      file_etag = "{}-{}".format(stats.st_size, stats.st_mtime)
+      if etag == file_etag:
+        return None
+      if start > stats.st_size:
+        start = 0
+      stream = open(path, "rb")
+      stream.seek(start)
+      return _Response(stream, start, stats.st_size, file_etag)
+
+    request = Request(self.url)
+    if start:
+      request.add_header("Range", "bytes={}-".format(start))
+    if etag:
+      request.add_header("If-None-Match", etag)
+    try:
+      response = urlopen(request)
+    except HTTPError as e:
+      if e.code == 304:
+        return None
+      if e.code == 416:
+        # The remote is now shorter than our cache: it was not appended to
+        return self._fetch(0)
+      raise
+    total = None
+    if response.getcode() == 206:
+      match = reContentRange.match(response.headers.get("Content-Range", ""))
+      if not match:
+        raise RemoteLogError("Unreadable Content-Range from {}".format(self.url))
+      if int(match.group(1)) != start:
+        raise RemoteLogError("Remote {} returned the wrong range".format(self.url))
+      total = int(match.group(3)) if match.group(3) != "*" else None
+    else:
+      start = 0
+      length = response.headers.get("Content-Length")
+      total = int(length) if length else None
+    return _Response(response, start, total, response.headers.get("ETag"))
+
+  def _copy_lines(self, response, output):
+    """Copy a response to a stream. Returns the length of complete lines, and
+    whether that was everything in the response."""
+    written = 0
+    complete = 0
+    data = response.read(CHUNK_SIZE)
+    while data:
+      output.write(data)
+      newline = data.rfind(b"\n")
+      if newline >= 0:
+        complete = written + newline + 1
+      written += len(data)
+      data = response.read(CHUNK_SIZE)
+    return complete, complete == written
+
+  def _check_unsegmented(self):
+    """Refuse logs stored as segments (see segments.py), as only the head is at the URL"""
+    manifest_url = self.url + ".segments/manifest"
+    parts = urlparse(manifest_url)
+    if parts.scheme.lower() == "file":
+      segmented = os.path.isfile(url2pathname(parts.path))
+    else:
+      try:
+        urlopen(Request(manifest_url)).close()
+        segmented = True
+      except HTTPError:
+        segmented = False
+    if segmented:
+      raise RemoteLogError("Remote {} is stored as segments, which can't be read remotely".format(self.url))
+
+  def _refetch(self, response=None):
+    self._check_unsegmented()
+    if response is None or response.start != 0:
+      if response is not None:
+        response.close()
+      response = self._fetch(0)
+    temp_name = self.filename + ".tmp"
+    try:
+      with open(temp_name, "wb") as output:
+        length, complete = self._copy_lines(response, output)
+        output.truncate(length)
+    finally:
+      response.close()
+    os.rename(temp_name, self.filename)
+    # Only trust the etag if we kept everything; otherwise the tail is refetched
+    self._write_meta({"url": self.url, "etag": response.etag if complete else None, "length": length})
+    logger.debug("Fetched {} bytes of {}".format(length, self.url))
+    return length
+
+  def sync(self):
+    """Bring the cache up to date with the remote.
+
+    Returns (replaced, length) - whether the cache was rewritten rather than
+    extended, and the length of complete, cached data that may be read."""
+    with self._locked():
+      meta = self._read_meta()
+      length = meta.get("length", 0)
+      if not length:
+        return True, self._refetch()
+
+      start = max(0, length - VALIDATE_BYTES)
+      response = self._fetch(start, meta.get("etag"))
+      if response is None:
+        return False, length
+      if response.start != start or (response.total is not None and response.total < length):
+        logger.info("Remote {} was not appended to; fetching in full".format(self.url))
+        return True, self._refetch(response)
+
+      with open(self.filename, "rb") as cached:
+        cached.seek(start)
+        expected = cached.read(length - start)
+      overlap = b""
+      while len(overlap) < len(expected):
+        data = response.read(len(expected) - len(overlap))
+        if not data:
+          break
+        overlap += data
+      if overlap != expected:
+        logger.info("Remote {} does not match the cached copy; fetching in full".format(self.url))
+        response.close()
+        return True, self._refetch()
+
+      try:
+        with open(self.filename, "r+b") as output:
+          output.seek(length)
+          appended, complete = self._copy_lines(response, output)
+          output.truncate(length + appended)
+      finally:
+        response.close()
+      self._write_meta({"url": self.url, "etag": response.etag if complete else None,
+                        "length": length + appended})
+      logger.debug("Fetched {} new bytes of {}".format(appended, self.url))
+      return False, length + appended
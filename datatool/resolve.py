@@ -0,0 +1,117 @@
+# coding: utf-8
+
+"""Resolve many datasets into file locations at once"""
+
+import os
+import collections
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from .datafile import MissingDatafileError
+from .util import ordered_map
+
+class ResolvedFiles(object):
+  """Columnar results from resolving datasets, with one row per file per set.
+
+  The columns are parallel lists:
+    set_id    The id of the set the file was resolved from
+    hashsum   The file hash
+    path      The readable instance, or None if there is none
+    size      The size of the readable instance, or -1
+    tagmask   The file tags, as a bitmask over the tags attribute
+  """
+  columns = ("set_id", "hashsum", "path", "size", "tagmask")
+
+  def __init__(self, tags):
+    self.tags = list(tags)
+    for column in self.columns:
+      setattr(self, column, [])
+
+  def __len__(self):
+    return len(self.set_id)
+
+  def __iter__(self):
+    return iter(zip(*[getattr(self, x) for x in self.columns]))
+
+  def tag_bit(self, tag):
+    return 1 << self.tags.index(tag)
+
+  def to_array(self):
+    """Return the results as a numpy structured array"""
+    if numpy is None:
+      raise ImportError("numpy is required for array results")
+    width = lambda values: max([len(x) for x in values if x] or [1])
+    dtype = [("set_id", "U{}".format(width(self.set_id))),
+             ("hashsum", "U{}".format(width(self.hashsum))),
+             ("path", "U{}".format(width(self.path))),
+             ("size", "i8"),
+             ("tagmask", "u8" if len(self.tags) <= 64 else "O")]
+    rows = [(s, h, p or "", z, m) for s, h, p, z, m in self]
+    return numpy.array(rows, dtype=dtype)
+
+def _list_directory(task):
+  """List a directory once, returning the sizes of the wanted files found in it"""
+  dirname, names = task
+  found = {}
+  try:
+    for entry in os.scandir(dirname):
+      if entry.name in names and entry.is_file():
+        found[entry.name] = entry.stat().st_size
+  except OSError:
+    pass
+  return dirname, found
+
+def _list_directories(filenames, workers=None):
+  """Check which files exist, listing their directories in a pool of threads.
+
+  Returns {dirname: {filename: size}} for the files found."""
+  wanted = collections.defaultdict(set)
+  for filename in filenames:
+    dirname, name = os.path.split(filename)
+    wanted[dirname].add(name)
+  return dict(ordered_map(_list_directory, wanted.items(), workers))
+
+def resolve_datasets(authority, names_or_ids, tags=None, require_readable=False):
+  """Resolve the files of many datasets in a single pass.
+
+  Rather than checking every file instance separately, each directory that
+  holds an instance is listed once, in a pool of threads. If tags are
+  given, only files with all of them are included. If require_readable is
+  set, a MissingDatafileError is raised for any file without a readable
+  instance."""
+  tagfilter = set(x.lower() for x in tags or [])
+  datasets = authority.fetch_datasets(names_or_ids)
+
+  rows = []
+  for name, dataset in zip(names_or_ids, datasets):
+    if dataset is None:
+      raise IndexError("Could not find dataset entry for " + name)
+    for datafile in dataset.files:
+      if tagfilter.issubset(x.lower() for x in datafile.tags):
+        rows.append((dataset, datafile))
+
+  all_tags = sorted(set().union(*[x.tags for _, x in rows]))
+  bits = {x: 1 << i for i, x in enumerate(all_tags)}
+  listings = _list_directories(set(x.filename for _, f in rows for x in f.instances))
+  results = ResolvedFiles(all_tags)
+  for dataset, datafile in rows:
+    path, size = None, -1
+    for instance in reversed(datafile.instances):
+      dirname, filename = os.path.split(instance.filename)
+      if filename in listings[dirname]:
+        path, size = instance.filename, listings[dirname][filename]
+        break
+    if path is None and require_readable:
+      raise MissingDatafileError("Could not find instance of file {} in set {}".format(datafile.id, dataset.id))
+    results.set_id.append(dataset.id)
+    results.hashsum.append(datafile.id)
+    results.path.append(path)
+    results.size.append(size)
+    results.tagmask.append(sum(bits[x] for x in datafile.tags))
+  logger.debug("Resolved {} files from {} sets in {} directories".format(len(results), len(datasets), len(listings)))
+  return results
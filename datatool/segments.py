@@ -0,0 +1,252 @@
+# coding: utf-8
+
+"""Authority and index logs stored as rolling, compressed segments.
+
+A segmented log keeps most of its history in sealed segments, compressed
+with gzip (or zstd, if the zstandard package is installed), and only the
+latest lines in the log file itself, the head. Writers append to the head as
+usual, and once it reaches the segment size it is sealed: its lines are
+compressed into new segments, and it is replaced with a new file holding
+only any unfinished last line.
+Everything about a log's segments is kept in a directory next to it:
+
+  data.authority                            the uncompressed head
+  data.authority.segments/manifest          one JSON record per line
+  data.authority.segments/000001.gz         sealed segments, in order
+  data.authority.segments/checkpoint-000001.gz
+
+The manifest records are:
+
+  {"type": "settings", "segment_size": <bytes>, "codec": "gzip" or "zstd"}
+  {"type": "segment", "file": ..., "start": <offset>, "size": <bytes>, "inode": <head inode>}
+  {"type": "checkpoint", "file": ..., "end": <offset>}
+
+Offsets into a segmented log are logical: they count the uncompressed bytes
+of all the segments before the head, so that a reader's position stays
+valid when the head is sealed. Each segment records the inode of the head
+it was sealed from, so that a reader that was part way through that head
+can tell it was sealed, rather than replaced, and carry on from the segment.
+
+A checkpoint holds the compacted history of every segment before its end
+(see Authority.compacted_commands), so that loading an authority from
+scratch can start from the latest checkpoint, and skip those segments.
+"""
+
+import io
+import os
+import gzip
+import json
+import shutil
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+SEGMENT_SIZE = 64*1024*1024
+ZSTD_LEVEL = 3
+EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+class SegmentError(IOError):
+  pass
+
+def _check_codec(codec):
+  if not codec in EXTENSIONS:
+    raise SegmentError("Unknown segment compression {}".format(codec))
+  if codec == "zstd" and zstandard is None:
+    raise SegmentError("zstd compressed segments need the zstandard package")
+
+def compress(data, codec):
+  _check_codec(codec)
+  if codec == "zstd":
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+  return gzip.compress(data)
+
+def open_log(filename):
+  """Open a log, or a segment of one, to read bytes, decompressing as it is read"""
+  if filename.endswith(EXTENSIONS["gzip"]):
+    return gzip.open(filename, "rb")
+  if filename.endswith(EXTENSIONS["zstd"]):
+    _check_codec("zstd")
+    reader = zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), closefd=True)
+    return io.BufferedReader(reader)
+  return open(filename, "rb")
+
+def skip_to(stream, offset):
+  """Move a newly opened stream from open_log forward to an uncompressed offset"""
+  if stream.seekable():
+    stream.seek(offset)
+    return
+  while offset > 0:
+    data = stream.read(min(offset, 1024*1024))
+    if not data:
+      break
+    offset -= len(data)
+
+class SegmentManifest(object):
+  """The settings, sealed segments and checkpoints of a log file"""
+  def __init__(self, log_filename):
+    self.log_filename = log_filename
+    self.directory = log_filename + ".segments"
+    self.filename = os.path.join(self.directory, "manifest")
+    self.segment_size = None
+    self.codec = None
+    self.segments = []
+    self.checkpoints = []
+    self._read = 0
+
+  @classmethod
+  def exists(cls, log_filename):
+    return os.path.isfile(os.path.join(log_filename + ".segments", "manifest"))
+
+  @property
+  def end(self):
+    """The logical offset of the end of the sealed segments, where the head starts"""
+    if not self.segments:
+      return 0
+    return self.segments[-1]["start"] + self.segments[-1]["size"]
+
+  def path(self, record):
+    return os.path.join(self.directory, record["file"])
+
+  def load(self):
+    """Read any records appended to the manifest since it was last read"""
+    try:
+      stream = open(self.filename, "rb")
+    except (IOError, OSError):
+      return self
+    with stream:
+      stream.seek(self._read)
+      for line in stream:
+        if not line.endswith(b"\n"):
+          break
+        self._read += len(line)
+        record = json.loads(line.decode("utf-8"))
+        if record["type"] == "settings":
+          self.segment_size, self.codec = record["segment_size"], record["codec"]
+        elif record["type"] == "segment":
+          self.segments.append(record)
+        elif record["type"] == "checkpoint":
+          self.checkpoints.append(record)
+    return self
+
+  def append(self, records):
+    """Append records to the manifest. Only call while holding the writer lock."""
+    if not os.path.isdir(self.directory):
+      os.mkdir(self.directory)
+    with open(self.filename, "a") as stream:
+      stream.write("".join(json.dumps(x, sort_keys=True) + "\n" for x in records))
+      stream.flush()
+      os.fsync(stream.fileno())
+    self.load()
+
+  def checkpoint(self):
+    """The latest checkpoint, if there is one"""
+    return self.checkpoints[-1] if self.checkpoints else None
+
+  def sealed(self, inode):
+    """Was the head with this inode sealed, but not yet replaced with a new one?"""
+    return bool(self.segments) and self.segments[-1]["inode"] == inode
+
+  def sealed_size(self, inode):
+    """How many bytes of the head with this inode were sealed into segments"""
+    size = 0
+    # Inodes can be reused by later heads, so only count the latest seal
+    for segment in reversed(self.segments):
+      if segment["inode"] != inode:
+        break
+      size += segment["size"]
+    return size
+
+def _write(manifest, name, data):
+  """Compress data into a new file in the segments directory"""
+  path = os.path.join(manifest.directory, name)
+  temp_name = "{}.part{}".format(path, os.getpid())
+  with open(temp_name, "wb") as output:
+    output.write(compress(data, manifest.codec))
+    output.flush()
+    os.fsync(output.fileno())
+  os.rename(temp_name, path)
+
+def replace_head(log_filename, sealed):
+  """Replace a sealed head with a new file, holding anything after the sealed bytes"""
+  temp_name = "{}.seal{}".format(log_filename, os.getpid())
+  with open(log_filename, "rb") as head, open(temp_name, "wb") as output:
+    head.seek(sealed)
+    shutil.copyfileobj(head, output)
+  shutil.copymode(log_filename, temp_name)
+  os.rename(temp_name, log_filename)
+
+def seal(stream, manifest, force=False):
+  """Compress the head of a log into new segments, and start a new head.
+
+  stream is the head, opened by a writer holding its lock. The head is split
+  into segments of about the segment size, on line boundaries. An
+  unfinished last line isn't sealed, but left for the new head. It is only
+  sealed once it has reached the segment size, or if force is set and it
+  isn't empty. Returns whether it was sealed."""
+  manifest.load()
+  if manifest.codec is None:
+    # Not a segmented log
+    return False
+  stats = os.fstat(stream.fileno())
+  segment_size = manifest.segment_size
+  if not stats.st_size or not (force or stats.st_size >= segment_size):
+    return False
+  _check_codec(manifest.codec)
+  records = []
+  start = manifest.end
+  extension = EXTENSIONS[manifest.codec]
+
+  def _flush(lines):
+    data = b"".join(lines)
+    name = "{:06d}{}".format(len(manifest.segments) + len(records) + 1, extension)
+    _write(manifest, name, data)
+    records.append({"type": "segment", "file": name, "start": start + sum(x["size"] for x in records),
+                    "size": len(data), "inode": stats.st_ino})
+
+  with open(manifest.log_filename, "rb") as head:
+    lines, size, sealed = [], 0, 0
+    for line in head:
+      if not line.endswith(b"\n"):
+        # Segments only hold whole lines
+        break
+      lines.append(line)
+      size += len(line)
+      sealed += len(line)
+      if size >= segment_size:
+        _flush(lines)
+        lines, size = [], 0
+    if lines:
+      _flush(lines)
+  if not records:
+    return False
+  # Readers take the head to be sealed as soon as the manifest says so
+  manifest.append(records)
+  replace_head(manifest.log_filename, sealed)
+  logger.info("Sealed {} bytes of {} into {} segments".format(sealed, manifest.log_filename, len(records)))
+  return True
+
+def segment_log(stream, manifest, segment_size=SEGMENT_SIZE, codec="gzip"):
+  """Start storing a log as segments, or change the settings of a segmented one.
+
+  stream is the head, opened by a writer holding its lock. If the head is
+  already past the segment size, it is sealed straight away."""
+  _check_codec(codec)
+  manifest.load()
+  manifest.append([{"type": "settings", "segment_size": segment_size, "codec": codec}])
+  seal(stream, manifest)
+
+def write_checkpoint(manifest, data):
+  """Record that data, a compacted log, covers everything in the sealed segments.
+
+  Only call while holding the writer lock, with nothing in the head."""
+  manifest.load()
+  checkpoint = manifest.checkpoint()
+  if checkpoint is not None and checkpoint["end"] == manifest.end:
+    return
+  name = "checkpoint-{:06d}{}".format(len(manifest.segments), EXTENSIONS[manifest.codec])
+  _write(manifest, name, data)
+  manifest.append([{"type": "checkpoint", "file": name, "end": manifest.end}])
@@ -0,0 +1,334 @@
+# coding: utf-8
+
+"""Compact, memory-mappable binary snapshots of an authority.
+
+A snapshot is a read-only export of the authority state, meant for
+deployments where many processes on a node only need to look things up.
+Everything is stored in fixed-width tables so that lookups are binary
+searches straight out of the mapped file, and the pages are shared between
+all processes through the page cache.
+
+Layout (all integers little-endian):
+
+  header      magic, flags, counts and the offset of each section
+  digests     sorted file hashes, fixed width (packed binary if all hex)
+  files       one record per digest: path, size, mtime, tag refs
+  sets        one record per set, sorted by lowercased id
+  names       set indices, sorted by lowercased name (named sets only)
+  members     file indices for each set, in set order
+  tagrefs     tag indices referenced by file and set records
+  tags        sorted tag names, with file and set posting ranges
+  postings    file/set indices for each tag
+  strings     utf-8 blob referenced by (offset, length) pairs
+"""
+
+import os
+import mmap
+import struct
+import binascii
+import logging
+logger = logging.getLogger(__name__)
+
+from .authority import Authority, AuthorityFileError
+from .datafile import DataFile, FileInstance
+from .dataset import Dataset
+
+MAGIC = b"DTSNAP01"
+FLAG_HEX_DIGESTS = 0x1
+NO_STRING = 0xFFFFFFFF
+
+_Header = struct.Struct("<8sIIIIIIIII")
+_Sections = struct.Struct("<10Q")
+_FileRecord = struct.Struct("<IIqdII")
+_SetRecord = struct.Struct("<IIIIIIII")
+_TagRecord = struct.Struct("<IIIIII")
+_Index = struct.Struct("<I")
+
+class SnapshotFormatError(AuthorityFileError):
+  pass
+
+def is_snapshot(filename):
+  """Does the given file look like a binary authority snapshot?"""
+  try:
+    with open(filename, "rb") as stream:
+      return stream.read(len(MAGIC)) == MAGIC
+  except IOError:
+    return False
+
+def _is_hex(value):
+  try:
+    binascii.unhexlify(value)
+    return True
+  except (TypeError, ValueError, binascii.Error):
+    return False
+
+class _StringTable(object):
+  """Accumulates unique utf-8 strings into a single blob"""
+  def __init__(self):
+    self._blob = bytearray()
+    self._refs = {}
+
+  def add(self, value):
+    if value is None:
+      return (NO_STRING, 0)
+    if not value in self._refs:
+      data = value.encode("utf-8")
+      self._refs[value] = (len(self._blob), len(data))
+      self._blob.extend(data)
+    return self._refs[value]
+
+  def getvalue(self):
+    return bytes(self._blob)
+
+def write_snapshot(authority, filename):
+  """Export the current state of an authority to a binary snapshot.
+
+  The snapshot is written alongside the destination and moved into place, so
+  that processes which already have the old snapshot mapped are unaffected."""
+  data = authority._data
+  strings = _StringTable()
+
+  file_ids = sorted(data.files)
+  hex_digests = bool(file_ids) and len(set(len(x) for x in file_ids)) == 1 \
+                and len(file_ids[0]) % 2 == 0 and all(_is_hex(x) for x in file_ids)
+  if hex_digests:
+    digests = [binascii.unhexlify(x) for x in file_ids]
+  else:
+    digests = [x.encode("utf-8") for x in file_ids]
+  width = max([len(x) for x in digests] or [0])
+  file_index = {x: i for i, x in enumerate(file_ids)}
+
+  sets = sorted(data.datasets.values(), key=lambda x: x.id.lower())
+  tags = sorted(set().union(*([x.tags for x in data.files.values()] + [x.tags for x in sets])))
+  tag_index = {x: i for i, x in enumerate(tags)}
+  tag_files = [[] for _ in tags]
+  tag_sets = [[] for _ in tags]
+  tagrefs = []
+
+  file_records = []
+  for i, file_id in enumerate(file_ids):
+    datafile = data.files[file_id]
+    instance = datafile.instances[-1] if datafile.instances else None
+    path = strings.add(instance.filename if instance else None)
+    size = instance.size if instance and instance.size is not None else -1
+    mtime = instance.timestamp if instance and instance.timestamp is not None else float("nan")
+    file_tags = sorted(tag_index[x] for x in datafile.tags)
+    for tag in file_tags:
+      tag_files[tag].append(i)
+    file_records.append(_FileRecord.pack(path[0], path[1], size, mtime, len(tagrefs), len(file_tags)))
+    tagrefs.extend(file_tags)
+
+  set_records = []
+  members = []
+  for i, dataset in enumerate(sets):
+    set_id = strings.add(dataset.id)
+    name = strings.add(dataset.name)
+    set_files = [file_index[x.id] for x in dataset.files]
+    set_tags = sorted(tag_index[x] for x in dataset.tags)
+    for tag in set_tags:
+      tag_sets[tag].append(i)
+    set_records.append(_SetRecord.pack(set_id[0], set_id[1], name[0], name[1],
+      len(members), len(set_files), len(tagrefs), len(set_tags)))
+    members.extend(set_files)
+    tagrefs.extend(set_tags)
+
+  names = sorted((i for i, x in enumerate(sets) if x.name), key=lambda i: sets[i].name.lower())
+
+  tag_records = []
+  postings = []
+  for i, tag in enumerate(tags):
+    ref = strings.add(tag)
+    tag_records.append(_TagRecord.pack(ref[0], ref[1],
+      len(postings), len(tag_files[i]), len(postings) + len(tag_files[i]), len(tag_sets[i])))
+    postings.extend(tag_files[i])
+    postings.extend(tag_sets[i])
+
+  def _indices(values):
+    return struct.pack("<{}I".format(len(values)), *values)
+
+  sections = [
+    b"".join(x.ljust(width, b"\0") for x in digests),
+    b"".join(file_records),
+    b"".join(set_records),
+    _indices(names),
+    _indices(members),
+    _indices(tagrefs),
+    b"".join(tag_records),
+    _indices(postings),
+    strings.getvalue(),
+  ]
+  header = _Header.pack(MAGIC, FLAG_HEX_DIGESTS if hex_digests else 0, width,
+    len(file_ids), len(sets), len(names), len(tags), len(members), len(tagrefs), len(postings))
+  offsets = []
+  position = _Header.size + _Sections.size
+  for section in sections:
+    offsets.append(position)
+    position += len(section)
+  offsets.append(position)
+
+  temp_name = "{}.tmp{}".format(filename, os.getpid())
+  with open(temp_name, "wb") as stream:
+    stream.write(header)
+    stream.write(_Sections.pack(*offsets))
+    for section in sections:
+      stream.write(section)
+  os.rename(temp_name, filename)
+  logger.debug("Wrote snapshot of {} files, {} sets to {}".format(len(file_ids), len(sets), filename))
+
+class SnapshotAuthority(Authority):
+  """A read-only authority backed by a memory-mapped binary snapshot.
+
+  Nothing is parsed up front; datasets and files are materialised (and
+  cached) only as they are looked up."""
+  def __init__(self, filename):
+    super(SnapshotAuthority, self).__init__()
+    self.filename = filename
+    with open(filename, "rb") as stream:
+      self._map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, self._flags, self._width, self._nfiles, self._nsets, self._nnames, \
+      self._ntags, _, _, _ = _Header.unpack_from(self._map, 0)
+    if magic != MAGIC:
+      raise SnapshotFormatError("{} is not an authority snapshot".format(filename))
+    (self._digests, self._files, self._sets, self._names, self._members,
+     self._tagrefs, self._tags, self._postings, self._strings, _) = \
+      _Sections.unpack_from(self._map, _Header.size)
+
+  def _string(self, offset, length):
+    if offset == NO_STRING:
+      return None
+    start = self._strings + offset
+    return self._map[start:start+length].decode("utf-8")
+
+  def _index(self, section, position):
+    return _Index.unpack_from(self._map, section + _Index.size * position)[0]
+
+  def _indices(self, section, start, count):
+    return struct.unpack_from("<{}I".format(count), self._map, section + _Index.size * start)
+
+  def _bisect(self, count, key_for, key):
+    """Return the first position in a sorted table whose key is >= key"""
+    low, high = 0, count
+    while low < high:
+      mid = (low + high) // 2
+      if key_for(mid) < key:
+        low = mid + 1
+      else:
+        high = mid
+    return low
+
+  def _digest(self, position):
+    start = self._digests + self._width * position
+    return self._map[start:start+self._width]
+
+  def _set_record(self, position):
+    return _SetRecord.unpack_from(self._map, self._sets + _SetRecord.size * position)
+
+  def _set_id(self, position):
+    record = self._set_record(position)
+    return self._string(record[0], record[1])
+
+  def _set_name(self, position):
+    record = self._set_record(position)
+    return self._string(record[2], record[3])
+
+  def _tag_names(self, start, count):
+    names = []
+    for tag in self._indices(self._tagrefs, start, count):
+      record = _TagRecord.unpack_from(self._map, self._tags + _TagRecord.size * tag)
+      names.append(self._string(record[0], record[1]))
+    return set(names)
+
+  def _find_file(self, file_id):
+    if self._flags & FLAG_HEX_DIGESTS:
+      if not _is_hex(file_id):
+        return None
+      key = binascii.unhexlify(file_id)
+    else:
+      key = file_id.encode("utf-8")
+    key = key.ljust(self._width, b"\0")
+    position = self._bisect(self._nfiles, self._digest, key)
+    if position < self._nfiles and self._digest(position) == key:
+      return position
+    return None
+
+  def _load_file(self, position):
+    digest = self._digest(position)
+    if self._flags & FLAG_HEX_DIGESTS:
+      file_id = binascii.hexlify(digest).decode("ascii")
+    else:
+      file_id = digest.rstrip(b"\0").decode("utf-8")
+    if file_id in self._data.files:
+      return self._data.files[file_id]
+    path_off, path_len, size, mtime, tag_start, tag_count = \
+      _FileRecord.unpack_from(self._map, self._files + _FileRecord.size * position)
+    datafile = DataFile(file_id)
+    datafile.tags = self._tag_names(tag_start, tag_count)
+    path = self._string(path_off, path_len)
+    if path is not None:
+      datafile.instances.append(FileInstance(filename=path, hashsum=file_id,
+        size=size if size >= 0 else None, timestamp=mtime if mtime == mtime else None))
+    self._data[file_id] = datafile
+    return datafile
+
+  def _load_set(self, position):
+    id_off, id_len, name_off, name_len, member_start, member_count, tag_start, tag_count = \
+      self._set_record(position)
+    set_id = self._string(id_off, id_len)
+    if set_id in self._data.datasets:
+      return self._data.datasets[set_id]
+    dataset = Dataset(set_id)
+    name = self._string(name_off, name_len)
+    if name is not None:
+      dataset.attrs["name"] = name
+    dataset.tags = self._tag_names(tag_start, tag_count)
+    dataset.files = [self._load_file(x) for x in self._indices(self._members, member_start, member_count)]
+    self._data[set_id] = dataset
+    return dataset
+
+  def _apply_command(self, command):
+    raise AuthorityFileError("Snapshot authority {} is read-only".format(self.filename))
+
+  def fetch_dataset(self, name_or_id):
+    """Retrieve a single dataset from either the name, or a shortened (or complete) hash"""
+    key = name_or_id.lower()
+    results = set()
+    position = self._bisect(self._nsets, lambda i: self._set_id(i).lower(), key)
+    while position < self._nsets and self._set_id(position).lower().startswith(key):
+      results.add(position)
+      position += 1
+    name_at = lambda i: self._set_name(self._index(self._names, i)).lower()
+    position = self._bisect(self._nnames, name_at, key)
+    while position < self._nnames and name_at(position) == key:
+      results.add(self._index(self._names, position))
+      position += 1
+    assert len(results) <= 1
+    return self._load_set(results.pop()) if results else None
+
+  def fetch_datasets(self, names_or_ids):
+    return [self.fetch_dataset(x) for x in names_or_ids]
+
+  def __getitem__(self, id):
+    position = self._bisect(self._nsets, lambda i: self._set_id(i).lower(), id.lower())
+    while position < self._nsets and self._set_id(position).lower() == id.lower():
+      if self._set_id(position) == id:
+        return self._load_set(position)
+      position += 1
+    raise KeyError(id)
+
+  def search(self, tags):
+    """Retrieve a list of all datasets matching a particular set of tags"""
+    matches = set(range(self._nsets))
+    tag_at = lambda i: self._string(*_TagRecord.unpack_from(self._map, self._tags + _TagRecord.size * i)[:2])
+    for tag in set(tags):
+      position = self._bisect(self._ntags, tag_at, tag)
+      if position == self._ntags or tag_at(position) != tag:
+        return tuple()
+      record = _TagRecord.unpack_from(self._map, self._tags + _TagRecord.size * position)
+      matches.intersection_update(self._indices(self._postings, record[4], record[5]))
+    return tuple(self._set_id(x) for x in sorted(matches))
+
+  def get_file(self, fileid):
+    position = self._find_file(fileid)
+    if position is None:
+      raise KeyError(fileid)
+    return self._load_file(position)
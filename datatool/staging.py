@@ -0,0 +1,201 @@
+# coding: utf-8
+
+"""A node-local cache of dataset files, staged from slow filesystems.
+
+Staged files are content-addressed, stored as <root>/<hash[:2]>/<hash><ext>
+(keeping the extension, which many readers use to detect formats), so a
+file shared between sets is only staged once. Copies are made in parallel
+and hashed as they are copied, so a staged file is always verified against
+the authority. Staged copies are recorded in <root>/staging.index, an
+ordinary index file: applying it after the main index makes them the
+preferred instance of each file. When the cache grows beyond its size limit,
+the least recently used files are evicted, and removed from the index.
+
+Each group of files (by the first two characters of the hash) has a lock in
+<root>/locks. Staging a file takes it exclusively, and finding an already
+staged file takes it shared, so that a file can't be evicted between being
+found and its access time being updated.
+"""
+
+import os
+import time
+import shutil
+import hashlib
+import datetime
+import logging
+logger = logging.getLogger(__name__)
+
+from .authority import LazyFileAuthority
+from .datafile import FileInstance, MissingDatafileError
+from .index import LocalFileIndex, format_entry
+from .util import lock_file, open_locked, ordered_map, parse_size
+
+DEFAULT_SIZE = "100G"
+CHUNK_SIZE = 1024*1024
+
+class StagingError(IOError):
+  pass
+
+def find_staging():
+  """Returns the staging cache location, from the environment or the default"""
+  return os.path.expanduser(os.environ.get("DATA_STAGING") or "~/.data.staging")
+
+def apply_staged(authority, root=None):
+  """Add any staged copies of the authority's files as their preferred instances"""
+  index_filename = os.path.join(root or find_staging(), "staging.index")
+  if not os.path.isfile(index_filename):
+    return
+  staged = LocalFileIndex(index_filename)
+  if isinstance(authority, LazyFileAuthority):
+    # Files are loaded on demand, so attach the staged copies as they are
+    authority.staged = staged
+    authority._attach_instances(list(authority._data.files))
+    return
+  files = authority._data.files
+  for entry in staged._data.values():
+    if entry.hashsum in files:
+      files[entry.hashsum].instances.append(entry)
+
+class StagingCache(object):
+  def __init__(self, root=None, max_size=None):
+    self.root = root or find_staging()
+    self.max_size = parse_size(max_size or os.environ.get("DATA_STAGING_SIZE") or DEFAULT_SIZE)
+    for dirname in [self.root, os.path.join(self.root, "locks")]:
+      if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    self.index_filename = os.path.join(self.root, "staging.index")
+    if not os.path.isfile(self.index_filename):
+      open(self.index_filename, "a").close()
+
+  def path_for(self, hashsum, extension=""):
+    return os.path.join(self.root, hashsum[:2], hashsum + extension)
+
+  def _lock(self, name, shared=False):
+    stream = open(os.path.join(self.root, "locks", name + ".lock"), "a")
+    lock_file(stream, shared=shared)
+    return stream
+
+  def _instance(self, path, hashsum):
+    stats = os.stat(path)
+    return FileInstance(path, hashsum=hashsum, size=stats.st_size, timestamp=stats.st_mtime)
+
+  def _touch(self, path):
+    # The access time is the LRU clock; set it explicitly, as mounts may not
+    stats = os.stat(path)
+    os.utime(path, (time.time(), stats.st_mtime))
+
+  def _copy(self, source, target, hashsum):
+    """Copy a file, checking the hash of the data as it is copied"""
+    temp_name = "{}.part{}".format(target, os.getpid())
+    hasher = hashlib.sha1()
+    try:
+      with open(source, "rb") as instream, open(temp_name, "wb") as outstream:
+        data = instream.read(CHUNK_SIZE)
+        while data:
+          hasher.update(data)
+          outstream.write(data)
+          data = instream.read(CHUNK_SIZE)
+      if hasher.hexdigest() != hashsum:
+        raise StagingError("File {} does not match its recorded hash {}".format(source, hashsum))
+      shutil.copystat(source, temp_name)
+      os.rename(temp_name, target)
+    finally:
+      if os.path.exists(temp_name):
+        os.unlink(temp_name)
+
+  def _stage(self, datafile):
+    """Stage a single file, returning (instance, newly staged)"""
+    extension = ""
+    if datafile.instances:
+      extension = os.path.splitext(datafile.instances[-1].filename)[1]
+    target = self.path_for(datafile.id, extension)
+    with self._lock(datafile.id[:2], shared=True):
+      if os.path.isfile(target):
+        self._touch(target)
+        return self._instance(target, datafile.id), False
+    source = datafile.get_valid_instance()
+    if source is None:
+      raise MissingDatafileError("No readable instance of {} to stage".format(datafile.id))
+    if not os.path.isdir(os.path.dirname(target)):
+      try:
+        os.makedirs(os.path.dirname(target))
+      except OSError:
+        pass
+    # Lock so that other processes staging the same file wait, rather than copy
+    with self._lock(datafile.id[:2]):
+      if os.path.isfile(target):
+        return self._instance(target, datafile.id), False
+      logger.debug("Staging {} from {}".format(datafile.id, source.filename))
+      self._copy(source.filename, target, datafile.id)
+      self._touch(target)
+    return self._instance(target, datafile.id), True
+
+  def stage(self, datafiles, workers=None):
+    """Stage a list of files in parallel, returning their staged instances.
+
+    The staged instances are also added to the files, so that they become
+    the instances used."""
+    datafiles = list(datafiles)
+    results = list(ordered_map(self._stage, datafiles, workers))
+    new = [x for x, staged in results if staged]
+    if new:
+      index = LocalFileIndex(self.index_filename)
+      index._process_entries(new)
+      index.write()
+    for datafile, (instance, _) in zip(datafiles, results):
+      if not instance.filename in [x.filename for x in datafile.instances]:
+        datafile.instances.append(instance)
+    self.evict(keep=set(x.id for x in datafiles))
+    return [x for x, _ in results]
+
+  def _entries(self):
+    for dirname in os.listdir(self.root):
+      path = os.path.join(self.root, dirname)
+      if len(dirname) != 2 or not os.path.isdir(path):
+        continue
+      for entry in os.scandir(path):
+        if entry.is_file() and not ".part" in entry.name:
+          yield entry
+
+  def _forget(self, filenames):
+    """Rewrite the staging index without the entries for some files"""
+    with open_locked(self.index_filename):
+      index = LocalFileIndex(self.index_filename)
+      date = datetime.datetime.utcnow().isoformat()
+      temp_name = "{}.part{}".format(self.index_filename, os.getpid())
+      with open(temp_name, "w") as stream:
+        for entry in index._names.values():
+          if not entry.filename in filenames:
+            stream.write(format_entry(entry, date))
+      os.rename(temp_name, self.index_filename)
+
+  def _evict(self, atime, entry):
+    """Remove a staged file, unless it has been used since it was listed"""
+    with self._lock(entry.name[:2]):
+      try:
+        if os.stat(entry.path).st_atime != atime:
+          return False
+        os.unlink(entry.path)
+      except OSError:
+        return False
+    return True
+
+  def evict(self, keep=()):
+    """Remove the least recently used files until the cache is within its size"""
+    with self._lock("evict"):
+      entries = [(x.stat().st_atime, x.stat().st_size, x) for x in self._entries()]
+      total = sum(x[1] for x in entries)
+      evicted = set()
+      for atime, size, entry in sorted(entries, key=lambda x: x[0]):
+        if total <= self.max_size:
+          break
+        if os.path.splitext(entry.name)[0] in keep:
+          continue
+        logger.debug("Evicting staged file {}".format(entry.name))
+        if self._evict(atime, entry):
+          evicted.add(entry.path)
+          total -= size
+      if evicted:
+        self._forget(evicted)
+    if total > self.max_size:
+      logger.warning("Staging cache {} is over its size limit, with {} bytes in use".format(self.root, total))
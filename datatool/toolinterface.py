@@ -1,14 +1,24 @@
 import os
+import time
 import itertools
+import threading
 import logging
 logger = logging.getLogger("datatool.interface")
 
 from .index import find_index, LocalFileIndex
-from .authority import find_authority, LocalFileAuthority, RemoteDeploymentAuthority
+from .authority import find_authority, open_authority, RemoteDeploymentAuthority, \
+                       CachedRemoteAuthority
+from .snapshot import SnapshotAuthority, is_snapshot
+from .datafile import MissingDatafileError
+from .resolve import resolve_datasets
+from .staging import StagingCache, apply_staged
+from .prefetch import open_iter, BLOCK_SIZE, MAX_MEMORY
 from .util import first
 
-class MissingDatafileError(IOError):
-  pass
+try:
+  import inotify_simple
+except ImportError:
+  inotify_simple = None
 
 class SubsetError(IndexError):
   pass
@@ -83,11 +93,22 @@ class DataSetFileNavigator(object):
     return len(self._subset)
   def __iter__(self):
     return iter(self.all)
+  def open_iter(self, **kwargs):
+    """Iterate over the files opened for reading, as DatasetInterface.open_iter"""
+    return open_iter(self._subset, **kwargs)
 
 class DatasetInterface(object):
   """An interface to data sets, to be handed to the python user"""
-  def __init__(self, dataset):
-    self._dataset = dataset
+  def __init__(self, dataset, authority=None):
+    self._set = dataset
+    self._authority = authority
+
+  @property
+  def _dataset(self):
+    # Look the set up each time, so that refreshes of the authority are seen
+    if self._authority is not None:
+      self._set = self._authority[self._set.id]
+    return self._set
 
   @property
   def name(self):
@@ -113,30 +134,146 @@ class DatasetInterface(object):
     return str(self)
   def __iter__(self):
     return iter(self._filenames())
+
+  def open_iter(self, prefetch=4, block_size=BLOCK_SIZE, max_memory=MAX_MEMORY, verify=False):
+    """Iterate over the files opened for reading, reading ahead in the background.
+
+    See prefetch.open_iter for details."""
+    return open_iter(self._dataset.files, prefetch=prefetch, block_size=block_size,
+                     max_memory=max_memory, verify=verify)
+
   def __getattr__(self, name):
     """Access files via tag."""
     return getattr(DataSetFileNavigator(self, self._dataset.files), name)
 
 
+class _Watcher(threading.Thread):
+  """Refreshes a Datatool whenever its authority or index files change.
+
+  Changes are noticed by polling the files, but inotify is used to wake up
+  early if inotify_simple is installed. Remote sources are checked on every
+  poll."""
+  def __init__(self, datatool, filenames, interval, remote=False):
+    super(_Watcher, self).__init__()
+    self.daemon = True
+    self._datatool = datatool
+    self._filenames = [os.path.abspath(x) for x in filenames]
+    self._interval = interval
+    self._remote = remote
+    self._stopped = threading.Event()
+
+  def _state(self):
+    states = []
+    for filename in self._filenames:
+      try:
+        stats = os.stat(filename)
+        states.append((stats.st_ino, stats.st_size, stats.st_mtime))
+      except OSError:
+        states.append(None)
+    return states
+
+  def run(self):
+    notify = None
+    if inotify_simple is not None and self._filenames:
+      notify = inotify_simple.INotify()
+      flags = inotify_simple.flags
+      # Watch the directories, so that replaced files are noticed too
+      for dirname in set(os.path.dirname(x) for x in self._filenames):
+        notify.add_watch(dirname, flags.MODIFY | flags.MOVED_TO | flags.CREATE)
+    # Always refresh on the first poll, in case of changes before we started
+    state = None
+    while not self._stopped.is_set():
+      if notify:
+        notify.read(timeout=int(self._interval * 1000))
+      else:
+        self._stopped.wait(self._interval)
+      if self._stopped.is_set():
+        break
+      new_state = self._state()
+      if new_state != state or self._remote:
+        state = new_state
+        try:
+          self._datatool.refresh()
+        except Exception:
+          logger.exception("Could not refresh from data sources")
+    if notify:
+      notify.close()
+
+  def stop(self):
+    self._stopped.set()
+
 class Datatool(object):
-  def __init__(self, remote=None):
-    if remote is not None:
+  def __init__(self, remote=None, lazy=False, processes=None):
+    self._lock = threading.RLock()
+    self._index = None
+    self._watcher = None
+    if remote is not None and is_snapshot(remote):
+      self._authority = SnapshotAuthority(remote)
+    elif remote is not None:
       self._authority = RemoteDeploymentAuthority(remote)
     else:
-      self._authority = LocalFileAuthority(find_authority())
-      index = LocalFileIndex(find_index())
-      self._authority.apply_index(index)
+      self._authority = open_authority(find_authority(), lazy=lazy, processes=processes)
+      self._index = LocalFileIndex(find_index(), processes=processes)
+      self._authority.apply_index(self._index)
+      apply_staged(self._authority)
+
+  def refresh(self):
+    """Apply anything appended to the authority and index since loading.
+
+    Only the new lines are read, and existing DatasetInterface objects see
+    the changes."""
+    with self._lock:
+      reloaded = self._authority.refresh()
+      if self._index is None:
+        return
+      entries = self._index.refresh()
+      if reloaded:
+        self._authority.apply_index(self._index)
+        apply_staged(self._authority)
+      else:
+        self._authority.apply_index_entries(entries)
+
+  def watch(self, interval=5.0):
+    """Refresh automatically in a background thread whenever the sources change"""
+    with self._lock:
+      if self._watcher is None:
+        filenames = [self._index._filename] if self._index is not None else []
+        authority_file = getattr(self._authority, "filename", None)
+        if authority_file:
+          filenames.append(authority_file)
+        remote = isinstance(self._authority, CachedRemoteAuthority)
+        self._watcher = _Watcher(self, filenames, interval, remote)
+        self._watcher.start()
+
+  def stop_watching(self):
+    with self._lock:
+      if self._watcher is not None:
+        self._watcher.stop()
+        self._watcher.join()
+        self._watcher = None
 
-  def get_dataset(self, name_or_id):
-    """Retrieves a particular dataset"""
-    dset = self._authority.fetch_dataset(name_or_id)
+  def get_dataset(self, name_or_id, stage=False):
+    """Retrieves a particular dataset.
+
+    If stage is set, the files are first copied into the local staging
+    cache (see StagingCache), and the staged copies are used."""
+    with self._lock:
+      dset = self._authority.fetch_dataset(name_or_id)
     if not dset:
       raise IndexError("Could not find dataset entry for " + name_or_id)
-    return DatasetInterface(dset)
+    if stage:
+      StagingCache().stage(dset.files)
+    return DatasetInterface(dset, self._authority)
+
+  def resolve(self, names_or_ids, tags=None, require_readable=False):
+    """Resolve the files of many datasets at once, into a ResolvedFiles table"""
+    with self._lock:
+      return resolve_datasets(self._authority, names_or_ids, tags=tags, require_readable=require_readable)
 
   def get_file(self, name_or_id):
     """Retrieves the single file from a named dataset"""
-    dset = self._authority.fetch_dataset(name_or_id)
+    with self._lock:
+      dset = self._authority.fetch_dataset(name_or_id)
     if len(dset.files) > 1:
       raise IndexError("More than one file in dataset '{}'".format(name_or_id))
     elif len(dset.files) == 0:
@@ -3,10 +3,236 @@
 import glob
 import os
 import collections
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+from .segments import SegmentManifest, open_log, replace_head, skip_to
 
 def first(it):
   return next(iter(it),None)
 
+def read_lines(filename, start=0, end=None):
+  """Yield the decoded lines from a byte range of a file, or of a compressed segment"""
+  with open_log(filename) as stream:
+    skip_to(stream, start)
+    position = start
+    for line in stream:
+      if end is not None and position >= end:
+        break
+      position += len(line)
+      yield line.decode("utf-8")
+
+def parse_size(size):
+  """Parse a size in bytes, with an optional K, M, G or T suffix"""
+  size = str(size).strip().upper().rstrip("B")
+  multipliers = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+  if size and size[-1] in multipliers:
+    return int(float(size[:-1]) * multipliers[size[-1]])
+  return int(size)
+
+def default_workers():
+  """A sensible number of threads for I/O-bound work"""
+  return min(32, (os.cpu_count() or 1) + 4)
+
+def ordered_map(func, items, workers=None, executor=ThreadPoolExecutor):
+  """Map a function over items in a pool of threads, yielding in input order.
+
+  Only a few items per worker are in flight at once, so items can be a
+  long-running generator without being consumed all up front. A process pool
+  can be used instead by passing executor=ProcessPoolExecutor, in which case
+  func must be picklable."""
+  workers = workers or default_workers()
+  pending = collections.deque()
+  with executor(workers) as pool:
+    for item in items:
+      pending.append(pool.submit(func, item))
+      if len(pending) >= workers * 4:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
+
+class LogReader(object):
+  """Reads an append-only log file incrementally, remembering how far it got.
+
+  Logs stored as compressed segments (see segments.py) are read through the
+  segments and then the head, and the offsets are logical ones, counting the
+  bytes of the segments before the head. If checkpoints is set, reading from
+  the start begins at the latest checkpoint, skipping the segments it covers."""
+  def __init__(self, filename, checkpoints=False):
+    self.filename = filename
+    self.offset = 0
+    self._inode = None
+    self._base = 0
+    self._checkpoints = checkpoints
+    self.manifest = SegmentManifest(filename)
+
+  @property
+  def base(self):
+    """The logical offset of the start of the head file"""
+    return self._base
+
+  def mark(self, offset, inode):
+    """Record that the file with this inode has been consumed up to offset"""
+    self.offset = offset
+    self._inode = inode
+
+  def reset(self):
+    self.mark(0, None)
+    self._base = 0
+    self.manifest = SegmentManifest(self.filename)
+
+  def size(self):
+    """The logical size of the whole log"""
+    return self.manifest.load().end + os.path.getsize(self.filename)
+
+  def replaced(self):
+    """Has the file been replaced or truncated since it was last read?"""
+    try:
+      stats = os.stat(self.filename)
+    except OSError:
+      return True
+    if self._inode is None:
+      return False
+    if stats.st_ino == self._inode:
+      return stats.st_size < self.offset - self._base
+    # A head sealed into segments has only moved, and reading carries on from them
+    self.manifest.load()
+    return not any(x["inode"] == self._inode and x["start"] == self._base for x in self.manifest.segments)
+
+  def lines(self, partial=False):
+    """Yield the lines appended since the last read.
+
+    An unterminated last line is only consumed if partial is set; otherwise
+    it is left for a later read, as it may still be being written."""
+    checkpoint = self._start_checkpoint()
+    if checkpoint is not None:
+      with open_log(self.manifest.path(checkpoint)) as stream:
+        for line in stream:
+          yield line.decode("utf-8")
+      self.offset = checkpoint["end"]
+    for _, _, line in self.lines_with_offsets(partial):
+      yield line
+
+  def _start_checkpoint(self):
+    if self._checkpoints and self.offset == 0:
+      return self.manifest.load().checkpoint()
+    return None
+
+  def _open_head(self):
+    """Open the head, along with the manifest as it was then.
+
+    Anything sealed after the head is opened is still in the open head, so
+    the two always agree."""
+    head = open(self.filename, "rb")
+    inode = os.fstat(head.fileno()).st_ino
+    self.manifest.load()
+    return head, inode
+
+  def _unread_segments(self):
+    for segment in self.manifest.segments:
+      if segment["start"] + segment["size"] > self.offset:
+        yield segment
+
+  def _enter_head(self, inode):
+    """Move on to the head after the segments. False if it is already sealed."""
+    self._base = self.manifest.end
+    if self.manifest.sealed(inode):
+      # It will be replaced by a new head, which is where to carry on
+      self._inode = None
+      return False
+    self._inode = inode
+    return True
+
+  def chunks(self, chunk_size):
+    """Split everything appended since the last read into independent pieces.
+
+    Each (filename, start, end) can be read with read_lines. Any checkpoint
+    and sealed segments to read are whole pieces, and the head is split into
+    ranges of about chunk_size, ending on line boundaries. They run to the
+    end of the head, as lines(partial=True) would, and are marked as read."""
+    chunks = []
+    checkpoint = self._start_checkpoint()
+    if checkpoint is not None:
+      chunks.append((self.manifest.path(checkpoint), 0, None))
+      self.offset = checkpoint["end"]
+    head, inode = self._open_head()
+    with head:
+      for segment in self._unread_segments():
+        chunks.append((self.manifest.path(segment), self.offset - segment["start"], None))
+        self.offset = segment["start"] + segment["size"]
+      if not self._enter_head(inode):
+        return chunks
+      size = os.fstat(head.fileno()).st_size
+      start = self.offset - self._base
+      while start < size:
+        head.seek(min(start + chunk_size, size))
+        head.readline()
+        end = min(head.tell(), size)
+        chunks.append((self.filename, start, end))
+        start = end
+      self.mark(self._base + max(start, self.offset - self._base), inode)
+    return chunks
+
+  def lines_with_offsets(self, partial=False):
+    """Yield (offset, length, line) for the lines appended since the last read"""
+    head, inode = self._open_head()
+    with head:
+      for segment in self._unread_segments():
+        with open_log(self.manifest.path(segment)) as stream:
+          skip_to(stream, self.offset - segment["start"])
+          for line in stream:
+            offset = self.offset
+            self.offset += len(line)
+            yield offset, len(line), line.decode("utf-8")
+      if not self._enter_head(inode):
+        return
+      head.seek(self.offset - self._base)
+      for line in head:
+        if not line.endswith(b"\n") and not partial:
+          break
+        offset = self.offset
+        self.offset += len(line)
+        yield offset, len(line), line.decode("utf-8")
+
+def lock_file(stream, blocking=True, shared=False):
+  """Take an advisory lock on an open file, held until it is closed.
+
+  The lock is exclusive, unless shared is set. Raises IOError if
+  non-blocking and another process holds the lock. On platforms without
+  fcntl this does nothing."""
+  if fcntl is None:
+    return
+  flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+  if not blocking:
+    flags |= fcntl.LOCK_NB
+  fcntl.flock(stream.fileno(), flags)
+
+def open_locked(filename, blocking=True):
+  """Open a log file for appending, holding the writer lock.
+
+  If the file was replaced (e.g. compacted, or sealed into segments) while
+  waiting for the lock, the new one is opened instead. If not blocking,
+  raises IOError if another process holds the lock."""
+  while True:
+    stream = open(filename, "a")
+    try:
+      lock_file(stream, blocking)
+    except (IOError, OSError):
+      stream.close()
+      raise
+    inode = os.fstat(stream.fileno()).st_ino
+    if inode == os.stat(filename).st_ino:
+      manifest = SegmentManifest(filename)
+      if not SegmentManifest.exists(filename) or not manifest.load().sealed(inode):
+        return stream
+      # A writer was stopped part way through sealing the head; finish it
+      replace_head(filename, manifest.sealed_size(inode))
+    stream.close()
+
 def get_wildcards(file_list):
   """Turns a list of files into a wildcard/list of wildcards."""
   wildcards = []
@@ -0,0 +1,196 @@
+# coding: utf-8
+
+"""Verify the instances of dataset files against their recorded metadata.
+
+Every instance is checked for existence, size and modification time, and
+in full mode is also rehashed. Hashing runs in a pool of threads, and can be
+limited to a total read bandwidth so that verifying a large collection does
+not starve other users of the filesystem.
+
+Progress can be checkpointed to a state file, with one JSON record per
+verified instance, so that an interrupted verification resumes where it
+stopped. Results already in the state file are reported again without
+rechecking; remove the state file to start a verification afresh.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import namedtuple
+import logging
+logger = logging.getLogger(__name__)
+
+from tqdm import tqdm
+
+from .util import lock_file, ordered_map
+
+CHUNK_SIZE = 1024*1024
+
+Mismatch = namedtuple("Mismatch", ["set_id", "hashsum", "filename", "problem", "expected", "actual"])
+
+class Throttle(object):
+  """Limits the combined rate of reads, in bytes per second, across threads"""
+  def __init__(self, rate):
+    self.rate = float(rate)
+    self._lock = threading.Lock()
+    self._next = time.time()
+
+  def consume(self, size):
+    with self._lock:
+      now = time.time()
+      start = max(self._next, now)
+      self._next = start + size / self.rate
+    if start > now:
+      time.sleep(start - now)
+
+def _hash_throttled(filename, throttle=None):
+  hasher = hashlib.sha1()
+  with open(filename, "rb") as ofile:
+    data = ofile.read(CHUNK_SIZE)
+    while data:
+      hasher.update(data)
+      if throttle is not None:
+        throttle.consume(len(data))
+      data = ofile.read(CHUNK_SIZE)
+  return hasher.hexdigest()
+
+def check_instance(datafile, instance, full=False, throttle=None):
+  """Check a single file instance, returning (problem, expected, actual) or None"""
+  try:
+    stats = os.stat(instance.filename)
+  except OSError:
+    return ("missing", instance.filename, None)
+  expected_size = instance.size if instance.size is not None else datafile.size
+  if expected_size is not None and stats.st_size != expected_size:
+    return ("size", expected_size, stats.st_size)
+  if full:
+    hashsum = _hash_throttled(instance.filename, throttle)
+    if hashsum != datafile.id:
+      return ("hash", datafile.id, hashsum)
+  if instance.timestamp is not None and str(stats.st_mtime) != str(instance.timestamp):
+    return ("timestamp", instance.timestamp, stats.st_mtime)
+  return None
+
+class _State(object):
+  """Checkpointed verification results, appended to a JSON-lines file.
+
+  Each result is written and flushed as a single line, so an interrupted
+  run leaves at most an unfinished last line, which is ignored on loading
+  and cut off before anything more is appended."""
+  def __init__(self, filename):
+    self.filename = filename
+    self.results = {}
+    self._stream = None
+    if filename and os.path.isfile(filename):
+      with open(filename) as stream:
+        for line in stream:
+          if not line.endswith("\n"):
+            break
+          if not line.strip():
+            continue
+          try:
+            record = json.loads(line)
+          except ValueError:
+            logger.warning("Ignoring unreadable line in verification state {}".format(filename))
+            continue
+          self.results[(record["hashsum"], record["filename"])] = record
+
+  def done(self, hashsum, filename, full):
+    """Return the earlier result for an instance, if it was checked as fully"""
+    record = self.results.get((hashsum, filename))
+    if record is not None and (record["full"] or not full):
+      return record
+    return None
+
+  def _open(self):
+    stream = open(self.filename, "ab")
+    lock_file(stream)
+    # Cut off anything left part way through a line by an interrupted run
+    with open(self.filename, "rb") as existing:
+      end = os.fstat(existing.fileno()).st_size
+      while end > 0:
+        start = max(0, end - 65536)
+        existing.seek(start)
+        data = existing.read(end - start)
+        if b"\n" in data:
+          end = start + data.rfind(b"\n") + 1
+          break
+        end = start
+    if end != os.fstat(stream.fileno()).st_size:
+      stream.truncate(end)
+    return stream
+
+  def record(self, record):
+    if not self.filename:
+      return
+    if self._stream is None:
+      self._stream = self._open()
+    self._stream.write((json.dumps(record) + "\n").encode("utf-8"))
+    self._stream.flush()
+
+  def close(self):
+    if self._stream is not None:
+      self._stream.close()
+      self._stream = None
+
+def _mismatch(record):
+  if record["problem"] is None:
+    return None
+  return Mismatch(*[record[x] for x in Mismatch._fields])
+
+def verify_datasets(authority, names_or_ids, full=False, workers=None, bandwidth=None, state=None):
+  """Verify every instance of the files in the given datasets.
+
+  Yields a Mismatch for each instance that does not match its record. Files
+  in more than one of the sets are only checked once. If bandwidth is given,
+  hashing is limited to that many bytes per second in total. If state is
+  a filename, progress is checkpointed there and resumed from."""
+  datasets = authority.fetch_datasets(names_or_ids)
+  for name, dataset in zip(names_or_ids, datasets):
+    if dataset is None:
+      raise IndexError("Could not find dataset entry for " + name)
+
+  checkpoint = _State(state)
+  throttle = Throttle(bandwidth) if bandwidth else None
+  seen = set()
+  tasks = []
+  for dataset in datasets:
+    for datafile in dataset.files:
+      if not datafile.instances:
+        tasks.append((dataset.id, datafile, None))
+      for instance in datafile.instances:
+        if not instance.filename in seen:
+          seen.add(instance.filename)
+          tasks.append((dataset.id, datafile, instance))
+
+  def _check(task):
+    set_id, datafile, instance = task
+    filename = instance.filename if instance is not None else None
+    previous = checkpoint.done(datafile.id, filename, full)
+    if previous is not None:
+      return previous, False
+    if instance is None:
+      result = ("missing", datafile.id, None)
+    else:
+      result = check_instance(datafile, instance, full, throttle)
+    problem, expected, actual = result or (None, None, None)
+    return {"set_id": set_id, "hashsum": datafile.id, "filename": filename, "full": full,
+            "problem": problem, "expected": expected, "actual": actual}, True
+
+  count = 0
+  progress = tqdm(total=len(tasks), unit="files", leave=False)
+  try:
+    for record, new in ordered_map(_check, tasks, workers):
+      if new:
+        checkpoint.record(record)
+      progress.update(1)
+      mismatch = _mismatch(record)
+      if mismatch is not None:
+        count += 1
+        yield mismatch
+  finally:
+    progress.close()
+    checkpoint.close()
+  logger.debug("Verified {} instances, with {} mismatches".format(len(tasks), count))
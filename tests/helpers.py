@@ -0,0 +1,59 @@
+# coding: utf-8
+
+"""A local HTTP server standing in for a remote authority, shared by the tests"""
+
+import os
+import re
+import threading
+
+from six.moves import BaseHTTPServer
+
+class LogHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves a single file (and its segment manifest), with Range and ETag support, recording requests"""
+  def do_GET(self):
+    filename = self.server.filename
+    if self.path.endswith(".segments/manifest"):
+      filename += ".segments/manifest"
+    if not os.path.isfile(filename):
+      self.send_response(404)
+      self.end_headers()
+      return
+    with open(filename, "rb") as stream:
+      data = stream.read()
+    etag = '"{}"'.format(len(data))
+    self.server.requests.append(self.headers.get("Range"))
+    if self.headers.get("If-None-Match") == etag:
+      self.send_response(304)
+      self.end_headers()
+      return
+    start = 0
+    match = re.match(r"bytes=(\d+)-", self.headers.get("Range") or "")
+    if match:
+      start = int(match.group(1))
+      if start >= len(data):
+        self.send_response(416)
+        self.end_headers()
+        return
+      self.send_response(206)
+      self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(data)-1, len(data)))
+    else:
+      self.send_response(200)
+    self.send_header("ETag", etag)
+    self.send_header("Content-Length", str(len(data) - start))
+    self.end_headers()
+    self.server.sent += len(data) - start
+    self.wfile.write(data[start:])
+
+  def log_message(self, *args):
+    pass
+
+def serve(filename):
+  """Serve a file on a local port, in a background thread"""
+  server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), LogHandler)
+  server.filename = filename
+  server.requests = []
+  server.sent = 0
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+  return server
@@ -0,0 +1,125 @@
+# coding: utf-8
+
+import time
+import asyncio
+import threading
+
+from datatool import aio
+from datatool.aio import AsyncDatatool
+from datatool.authority import LocalFileAuthority
+
+def _setup(tmpdir, monkeypatch):
+  auth_file, index_file = tmpdir.join("data.authority"), tmpdir.join("data.index")
+  auth_file.write("")
+  index_file.write("")
+  monkeypatch.setenv("DATA_AUTHORITY", str(auth_file))
+  monkeypatch.setenv("DATA_INDEX", str(index_file))
+  files = []
+  for name in ["a", "b", "c"]:
+    files.append(tmpdir.join(name + ".data"))
+    files[-1].write(name)
+  return str(auth_file), [str(x) for x in files]
+
+def testWrites(tmpdir, monkeypatch):
+  auth_file, files = _setup(tmpdir, monkeypatch)
+
+  async def run():
+    async with (await AsyncDatatool.load(workers=2)) as datatool:
+      # Queued together, but applied in order
+      set_id, _, _ = await asyncio.gather(datatool.create_set("sample"),
+                                          datatool.create_set("other"),
+                                          datatool.create_set("third"))
+      await datatool.add_files(set_id, files[:2])
+      await datatool.add_tags([set_id], ["tagged"])
+      assert await datatool.files("sample") == files[:2]
+      assert [x.id for x in await datatool.search(["tagged"])] == [set_id]
+      resolved = await datatool.resolve(["sample"])
+      assert list(resolved.path) == files[:2]
+      return set_id
+  set_id = asyncio.run(run())
+
+  # Everything was written out
+  authority = LocalFileAuthority(auth_file)
+  assert sorted(x.name for x in authority._data.datasets.values()) == ["other", "sample", "third"]
+  assert authority.fetch_dataset("sample").id == set_id
+  assert authority.fetch_dataset("sample").tags == {"tagged"}
+  assert len(authority.fetch_dataset("sample").files) == 2
+
+def testWriteErrors(tmpdir, monkeypatch):
+  _setup(tmpdir, monkeypatch)
+
+  async def run():
+    async with (await AsyncDatatool.load()) as datatool:
+      await datatool.create_set("sample")
+      try:
+        await datatool.create_set("sample")
+        assert False, "Duplicate set name accepted"
+      except IOError:
+        pass
+      # The writer carries on afterwards
+      await datatool.create_set("other")
+      assert len(await datatool.search([])) == 2
+  asyncio.run(run())
+
+def testFailedWritesAreNotWritten(tmpdir, monkeypatch):
+  auth_file, files = _setup(tmpdir, monkeypatch)
+
+  async def run():
+    async with (await AsyncDatatool.load()) as datatool:
+      set_id = await datatool.create_set("sample")
+      written = open(auth_file).read()
+      try:
+        # The first file is indexed before the missing one fails
+        await datatool.add_files(set_id, [files[0], str(tmpdir.join("missing.data"))])
+        assert False, "Missing file accepted"
+      except OSError:
+        pass
+      assert open(auth_file).read() == written
+      assert tmpdir.join("data.index").read() == ""
+      # Nor is it written along with the next change
+      await datatool.create_set("other")
+      assert tmpdir.join("data.index").read() == ""
+      assert len(LocalFileAuthority(auth_file)._commands) == len(written.splitlines()) + 2
+  asyncio.run(run())
+
+def testLoadUsesWorkers(tmpdir, monkeypatch):
+  _setup(tmpdir, monkeypatch)
+  loaded = []
+  real_datatool = aio.Datatool
+  def _datatool(*args, **kwargs):
+    loaded.append(threading.current_thread())
+    return real_datatool(*args, **kwargs)
+  monkeypatch.setattr(aio, "Datatool", _datatool)
+
+  async def run():
+    async with (await AsyncDatatool.load(workers=1)) as datatool:
+      assert loaded[0] in datatool._executor._threads
+  asyncio.run(run())
+
+def testLookupsCoalesce(tmpdir, monkeypatch):
+  auth_file, files = _setup(tmpdir, monkeypatch)
+  calls = []
+
+  async def run():
+    async with (await AsyncDatatool.load()) as datatool:
+      set_id = await datatool.create_set("sample")
+      await datatool.add_files(set_id, files)
+      get_dataset = datatool.datatool.get_dataset
+      def slow_get_dataset(*args, **kwargs):
+        calls.append(threading.current_thread())
+        time.sleep(0.1)
+        return get_dataset(*args, **kwargs)
+      monkeypatch.setattr(datatool.datatool, "get_dataset", slow_get_dataset)
+
+      results = await asyncio.gather(*[datatool.files("sample") for _ in range(10)])
+      assert all(x == files for x in results)
+      assert len(calls) == 1
+      # Once finished, a lookup is run again
+      await datatool.files("sample")
+      assert len(calls) == 2
+      # And different lookups run separately
+      await asyncio.gather(datatool.get_dataset("sample"), datatool.files("sample"))
+      assert len(calls) == 4
+      # None of this ran on the event loop
+      assert not threading.main_thread() in calls
+  asyncio.run(run())
@@ -0,0 +1,48 @@
+# coding: utf-8
+
+from datatool.authority import LocalFileAuthority, format_command, _authority_state
+from datatool.datafile import FileInstance
+from datatool.handlers import CreateFileCommand, AddTagsCommand
+
+def _files(count):
+  return [FileInstance("/data/{}".format(x), "{:040x}".format(x), 10, 1.0) for x in range(count)]
+
+def testBatchedCommands(tmpdir):
+  filename = str(tmpdir.join("data.authority"))
+  open(filename, "w").close()
+  authority = LocalFileAuthority(filename)
+  files = _files(100)
+  set_id = authority.create_set("many")
+  authority.add_files(set_id, files)
+  authority.add_tags_many([x.hashsum for x in files[:50]], ["low"])
+  authority.remove_tags_many([x.hashsum for x in files], ["low", "absent"])
+  authority.add_tags_many([x.hashsum for x in files[:3]] + [set_id], ["mixed"])
+  authority.write()
+
+  # createset, name, createfiles, addfilestoset, 3 tag lines
+  commands = [x.split()[1] for x in open(filename)]
+  assert commands == ["createset", "setproperty", "createfiles", "addfilestoset",
+                      "addtagsmany", "removetagsmany", "addtagsmany"]
+  reloaded = LocalFileAuthority(filename)
+  assert _authority_state(reloaded._data) == _authority_state(authority._data)
+  assert len(reloaded[set_id].files) == 100
+  assert reloaded._data[files[0].hashsum].tags == {"mixed"}
+  assert reloaded[set_id].tags == {"mixed"}
+
+def testSingleItemCommandsReadable(tmpdir):
+  filename = str(tmpdir.join("data.authority"))
+  files = _files(2)
+  with open(filename, "w") as stream:
+    created = [CreateFileCommand(x) for x in files]
+    for command in created:
+      command.timestamp = created[0].timestamp
+      stream.write(format_command(command))
+    stream.write(format_command(AddTagsCommand(files[1].hashsum, ["old"])))
+  authority = LocalFileAuthority(filename)
+  assert set(authority._data.files) == set(x.hashsum for x in files)
+  assert authority._data[files[1].hashsum].tags == {"old"}
+
+  # Compacting batches files created at the same time
+  authority.compact()
+  assert [x.split()[1] for x in open(filename)] == ["createfiles", "addtags"]
+  assert _authority_state(LocalFileAuthority(filename)._data) == _authority_state(authority._data)
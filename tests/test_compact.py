@@ -0,0 +1,47 @@
+# coding: utf-8
+
+import os
+
+from datatool.authority import LocalFileAuthority, AuthorityFileError, _authority_state
+from datatool.datafile import FileInstance
+from datatool.util import lock_file
+
+import pytest
+
+def _churned_authority(tmpdir):
+  auth_file = tmpdir.join("data.authority")
+  auth_file.write("")
+  authority = LocalFileAuthority(str(auth_file))
+  keep = authority.create_set("keep")
+  gone = authority.create_set("gone")
+  files = [FileInstance("/data/{}".format(x), "{:040x}".format(x), 10, 1.0) for x in range(4)]
+  authority.add_files(keep, files)
+  authority.add_files(gone, files[:2])
+  authority.remove_files(keep, [files[3].hashsum])
+  authority.rename_set(keep, "kept")
+  authority.add_tags(keep, ["a", "b"])
+  authority.remove_tags(keep, ["b"])
+  authority.add_tags(files[0].hashsum, ["first"])
+  authority.delete_set(gone)
+  authority.write()
+  return authority, str(auth_file)
+
+def testCompactKeepsState(tmpdir):
+  authority, filename = _churned_authority(tmpdir)
+  before = _authority_state(LocalFileAuthority(filename)._data)
+  original_lines = len(open(filename).readlines())
+  archive = authority.compact(archive=True)
+  assert _authority_state(LocalFileAuthority(filename)._data) == before
+  assert len(open(filename).readlines()) < original_lines
+  assert len(open(archive).readlines()) == original_lines
+  # Further changes still append after compaction
+  authority.add_tags(authority.fetch_dataset("kept").id, ["c"])
+  authority.write()
+  assert LocalFileAuthority(filename).fetch_dataset("kept").tags == {"a", "c"}
+
+def testCompactRefusesWhileLocked(tmpdir):
+  authority, filename = _churned_authority(tmpdir)
+  with open(filename, "a") as writer:
+    lock_file(writer)
+    with pytest.raises(AuthorityFileError):
+      authority.compact()
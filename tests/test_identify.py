@@ -0,0 +1,31 @@
+# coding: utf-8
+
+from datatool import identify as identify_module
+from datatool.authority import LocalFileAuthority
+from datatool.index import LocalFileIndex
+from datatool.ingest import walk_files
+
+def testIdentify(tmpdir, monkeypatch):
+  tmpdir.join("data.authority").write("")
+  tmpdir.join("data.index").write("")
+  authority = LocalFileAuthority(str(tmpdir.join("data.authority")))
+  index = LocalFileIndex(str(tmpdir.join("data.index")))
+  for name in ["a", "b"]:
+    tmpdir.join(name + ".data").write(name)
+  set_id = authority.create_set("letters")
+  authority.add_files(set_id, index.add_files([str(tmpdir.join("a.data")), str(tmpdir.join("b.data"))]))
+
+  tmpdir.join("copy.data").write("a")
+  tmpdir.join("same_size.data").write("z")
+  tmpdir.join("other_size.data").write("longer")
+  hashed = []
+  real_hashfile = identify_module.hashfile
+  monkeypatch.setattr(identify_module, "hashfile", lambda x: hashed.append(x) or real_hashfile(x))
+
+  names = ["a.data", "copy.data", "same_size.data", "other_size.data"]
+  results = list(identify_module.Identifier(authority, index).identify(
+    walk_files([str(tmpdir.join(x)) for x in names])))
+  assert [[y.name for y in x.datasets] for x in results] == [["letters"], ["letters"], [], []]
+  assert [x.known for x in results] == [True, True, False, False]
+  # Indexed files reuse their hash, and files of unknown sizes are not hashed
+  assert sorted(hashed) == [str(tmpdir.join("copy.data")), str(tmpdir.join("same_size.data"))]
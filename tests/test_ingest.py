@@ -0,0 +1,39 @@
+# coding: utf-8
+
+from datatool import ingest as ingest_module
+from datatool.authority import LocalFileAuthority
+from datatool.index import LocalFileIndex
+from datatool.ingest import walk_files, ingest
+
+def _tree(tmpdir):
+  for path in ["a.data", "sub/b.data", "sub/c.txt", "skip/d.data"]:
+    tmpdir.join("tree", path).write(path, ensure=True)
+  return str(tmpdir.join("tree"))
+
+def testWalkFiles(tmpdir):
+  root = _tree(tmpdir)
+  names = lambda candidates: [x.filename[len(root)+1:] for x in candidates]
+  assert names(walk_files([root])) == []
+  assert names(walk_files([root], recursive=True)) == ["a.data", "skip/d.data", "sub/b.data", "sub/c.txt"]
+  assert names(walk_files([root], recursive=True, include=["*.data"], exclude=["skip"])) == ["a.data", "sub/b.data"]
+
+def testIngestResumes(tmpdir, monkeypatch):
+  root = _tree(tmpdir)
+  tmpdir.join("data.authority").write("")
+  tmpdir.join("data.index").write("")
+  authority = LocalFileAuthority(str(tmpdir.join("data.authority")))
+  index = LocalFileIndex(str(tmpdir.join("data.index")))
+  set_id = authority.create_set("tree")
+
+  # Pretend we were interrupted after the first batch
+  ingest(index, list(walk_files([root], recursive=True))[:2], authority, set_id, batch_size=2)
+
+  hashed = []
+  real_hashfile = ingest_module.hashfile
+  monkeypatch.setattr(ingest_module, "hashfile", lambda x: hashed.append(x) or real_hashfile(x))
+  index = LocalFileIndex(str(tmpdir.join("data.index")))
+  authority = LocalFileAuthority(str(tmpdir.join("data.authority")))
+  assert ingest(index, walk_files([root], recursive=True), authority, set_id, batch_size=2) == 4
+  assert len(hashed) == 2
+  assert len(LocalFileAuthority(str(tmpdir.join("data.authority")))[set_id].files) == 4
+  assert len(LocalFileIndex(str(tmpdir.join("data.index")))._data) == 4
@@ -0,0 +1,100 @@
+# coding: utf-8
+
+import os
+
+from datatool.authority import LocalFileAuthority, LazyFileAuthority, format_command, _authority_state
+from datatool.datafile import FileInstance
+from datatool.handlers import CreateSetCommand, SetPropertyCommand
+from datatool.offsets import OffsetIndex
+
+def _files(prefix, count):
+  return [FileInstance("/data/{}{}".format(prefix, x), "{}{:039x}".format(prefix, x), 1, 1.0) for x in range(count)]
+
+def _authority(tmpdir):
+  filename = str(tmpdir.join("data.authority"))
+  open(filename, "w").close()
+  authority = LocalFileAuthority(filename)
+  for name in "abcd":
+    set_id = authority.create_set("set_" + name)
+    authority.add_files(set_id, _files(name, 5))
+    authority.add_tags(set_id, [name])
+  authority.write()
+  return authority, filename
+
+def testLazyLoadsOnlyWhatIsUsed(tmpdir):
+  authority, filename = _authority(tmpdir)
+  lazy = LazyFileAuthority(filename)
+  assert OffsetIndex.exists(filename)
+  assert not lazy._commands
+
+  dataset = lazy.fetch_dataset("set_b")
+  assert [x.id for x in dataset.files] == [x.hashsum for x in _files("b", 5)]
+  assert dataset.tags == {"b"}
+  # createset, name, createfiles, addfilestoset, addtags
+  assert len(lazy._commands) == 5
+  assert lazy.search(["c"]) == (lazy.fetch_dataset("set_c").id,)
+  assert _authority_state(lazy._data) == _authority_state(authority._data)
+
+def testSidecarKeptCurrent(tmpdir):
+  authority, filename = _authority(tmpdir)
+  lazy = LazyFileAuthority(filename)
+  dataset = lazy.fetch_dataset("set_a")
+
+  # Writers append to the sidecar, and a lazy refresh sees their changes
+  authority.add_files(dataset.id, _files("e", 2))
+  authority.rename_set(dataset.id, "renamed")
+  authority.write()
+  offsets = OffsetIndex(filename)
+  offsets.load(os.stat(filename).st_ino)
+  assert offsets.gaps(os.path.getsize(filename)) == []
+  lazy.refresh()
+  assert len(dataset.files) == 7
+  assert dataset.name == "renamed"
+
+  # Lines written without updating the sidecar are found on the next load
+  with open(filename, "a") as stream:
+    create = CreateSetCommand()
+    stream.write(format_command(create))
+    stream.write(format_command(SetPropertyCommand(create.id, "name", "unindexed")))
+  assert LazyFileAuthority(filename).fetch_dataset("unindexed").id == create.id
+  assert LazyFileAuthority(filename).fetch_dataset("renamed").id == dataset.id
+
+def testRefreshDoesNotDuplicateSidecar(tmpdir):
+  authority, filename = _authority(tmpdir)
+  lazy = LazyFileAuthority(filename)
+  dataset = lazy.fetch_dataset("set_a")
+  authority.add_tags(dataset.id, ["new"])
+  authority.write()
+  size = os.path.getsize(filename + ".offsets")
+  for _ in range(3):
+    lazy.refresh()
+  assert os.path.getsize(filename + ".offsets") == size
+  assert dataset.tags == {"a", "new"}
+
+def testBatchedLinesOnlyLoadWhatIsUsed(tmpdir):
+  filename = str(tmpdir.join("data.authority"))
+  open(filename, "w").close()
+  authority = LocalFileAuthority(filename)
+  files = {name: _files(name, 3) for name in "abcd"}
+  # One line creating the files of every set, and tags across every set and file
+  authority._create_files([x for name in "abcd" for x in files[name]])
+  set_ids = {}
+  for name in "abcd":
+    set_ids[name] = authority.create_set("set_" + name)
+    authority.add_files(set_ids[name], files[name])
+  authority.add_tags_many(list(set_ids.values()), ["shared"])
+  authority.add_tags_many([x.hashsum for name in "abcd" for x in files[name]], ["file"])
+  authority.write()
+
+  lazy = LazyFileAuthority(filename)
+  dataset = lazy.fetch_dataset("set_b")
+  assert set(lazy._data.datasets) == {set_ids["b"]}
+  assert set(lazy._data.files) == {x.hashsum for x in files["b"]}
+  assert dataset.tags == {"shared"}
+  assert all(x.tags == {"file"} for x in dataset.files)
+
+  # The same lines are applied again for sets loaded later
+  other = lazy.fetch_dataset("set_c")
+  assert other.tags == {"shared"}
+  assert all(x.tags == {"file"} for x in other.files)
+  assert set(lazy._data.datasets) == {set_ids["b"], set_ids["c"]}
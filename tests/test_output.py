@@ -0,0 +1,47 @@
+# coding: utf-8
+
+import os
+import sys
+import json
+import subprocess
+
+from datatool.authority import LocalFileAuthority
+from datatool.index import LocalFileIndex
+from datatool.main import run_main
+
+def testStreamingFormats(tmpdir, capsys):
+  tmpdir.join("data.authority").write("")
+  tmpdir.join("data.index").write("")
+  authority = LocalFileAuthority(str(tmpdir.join("data.authority")))
+  index = LocalFileIndex(str(tmpdir.join("data.index")))
+  names = []
+  for name in "abc":
+    tmpdir.join(name + ".data").write(name)
+    names.append(str(tmpdir.join(name + ".data")))
+  set_id = authority.create_set("letters")
+  authority.add_files(set_id, index.add_files(names))
+  authority.add_tags(index.fetch_file(names[0]).hashsum, ["first"])
+  authority.write()
+  index.write()
+  capsys.readouterr()
+
+  sources = ["--authority=" + str(tmpdir.join("data.authority")), "--index=" + str(tmpdir.join("data.index"))]
+  run_main(["data"] + sources + ["files", "--format=jsonl", "letters"])
+  rows = [json.loads(x) for x in capsys.readouterr().out.splitlines()]
+  assert [x["path"] for x in rows] == names
+  assert rows[0]["tags"] == ["first"] and rows[0]["status"] == "ok"
+  run_main(["data"] + sources + ["files", "-1", "letters", "first"])
+  assert capsys.readouterr().out.splitlines() == names[:1]
+  run_main(["data"] + sources + ["sets", "--format=tsv"])
+  assert capsys.readouterr().out.splitlines() == ["\t".join([set_id, "letters", "3", ""])]
+
+def testClosedPipe():
+  # Stopping reading early (e.g. through head) ends the output quietly
+  process = subprocess.Popen([sys.executable, "-c",
+    "from datatool.main import write_lines; write_lines(str(x) for x in range(10**7))"],
+    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+    cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+  assert process.stdout.readline() == b"0\n"
+  process.stdout.close()
+  assert process.wait() == 0
+  assert process.stderr.read() == b""
@@ -0,0 +1,51 @@
+# coding: utf-8
+
+from datatool import authority as authority_module
+from datatool import index as index_module
+from datatool.authority import LocalFileAuthority, _authority_state
+from datatool.index import LocalFileIndex
+from datatool.util import LogReader
+
+def _populate(tmpdir, count):
+  tmpdir.join("data.authority").write("")
+  tmpdir.join("data.index").write("")
+  authority = LocalFileAuthority(str(tmpdir.join("data.authority")))
+  index = LocalFileIndex(str(tmpdir.join("data.index")))
+  for i in range(count):
+    tmpdir.join("{}.data".format(i)).write(str(i))
+  files = index.add_files([str(tmpdir.join("{}.data".format(i))) for i in range(count)])
+  for i in range(0, count, 5):
+    set_id = authority.create_set("set{}".format(i))
+    authority.add_files(set_id, files[i:i+5])
+    authority.add_tags(set_id, ["tag{}".format(i % 3)])
+  authority.write()
+  index.write()
+
+def testChunks(tmpdir):
+  tmpdir.join("log").write("".join("line {}\n".format(i) for i in range(100)) + "partial")
+  reader = LogReader(str(tmpdir.join("log")))
+  chunks = reader.chunks(50)
+  assert all(x == str(tmpdir.join("log")) for x, _, _ in chunks)
+  ranges = [(start, end) for _, start, end in chunks]
+  assert len(ranges) > 1
+  assert all(x[1] == y[0] for x, y in zip(ranges, ranges[1:]))
+  data = open(str(tmpdir.join("log")), "rb").read()
+  assert all(data[end-1:end] == b"\n" for _, end in ranges[:-1])
+  assert reader.offset == len(data) == ranges[-1][1]
+
+def testParallelParse(tmpdir, monkeypatch):
+  _populate(tmpdir, 40)
+  monkeypatch.setattr(authority_module, "PARSE_CHUNK_SIZE", 200)
+  monkeypatch.setattr(index_module, "PARSE_CHUNK_SIZE", 200)
+
+  serial = LocalFileAuthority(str(tmpdir.join("data.authority")))
+  parallel = LocalFileAuthority(str(tmpdir.join("data.authority")), processes=2)
+  assert _authority_state(parallel._data) == _authority_state(serial._data)
+  assert [str(x) for x in parallel._commands] == [str(x) for x in serial._commands]
+  assert parallel._reader.offset == serial._reader.offset
+
+  serial_index = LocalFileIndex(str(tmpdir.join("data.index")))
+  parallel_index = LocalFileIndex(str(tmpdir.join("data.index")), processes=2)
+  assert sorted(x.to_data().items() for x in parallel_index._data.values()) == \
+         sorted(x.to_data().items() for x in serial_index._data.values())
+  assert parallel_index._reader.offset == serial_index._reader.offset
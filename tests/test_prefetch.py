@@ -0,0 +1,112 @@
+# coding: utf-8
+
+import os
+import itertools
+import threading
+
+import pytest
+
+from datatool import prefetch as prefetch_module
+from datatool.authority import LocalFileAuthority
+from datatool.datafile import MissingDatafileError
+from datatool.index import LocalFileIndex
+from datatool.prefetch import HashMismatchError, PrefetchedFile, VerifyingFile
+from datatool.toolinterface import DatasetInterface
+
+def _dataset(tmpdir, contents):
+  tmpdir.join("data.authority").write("")
+  tmpdir.join("data.index").write("")
+  authority = LocalFileAuthority(str(tmpdir.join("data.authority")))
+  index = LocalFileIndex(str(tmpdir.join("data.index")))
+  names = []
+  for i, content in enumerate(contents):
+    tmpdir.join("file{}.data".format(i)).write(content)
+    names.append(str(tmpdir.join("file{}.data".format(i))))
+  set_id = authority.create_set("prefetched")
+  authority.add_files(set_id, index.add_files(names))
+  authority.apply_index(index)
+  return DatasetInterface(authority[set_id], authority), names
+
+def testOpenIter(tmpdir, monkeypatch):
+  contents = ["x" * (10 * (i + 1)) for i in range(8)]
+  dataset, names = _dataset(tmpdir, contents)
+  reading = []
+  started = threading.Semaphore(0)
+  real_read = prefetch_module._read_file
+  def _read_file(filename, *args):
+    reading.append(filename)
+    started.release()
+    return real_read(filename, *args)
+  monkeypatch.setattr(prefetch_module, "_read_file", _read_file)
+
+  # Files are read ahead, but only as far as the memory limit allows
+  results = dataset.open_iter(prefetch=4, max_memory=70, verify=True)
+  first = next(results)
+  assert isinstance(first, PrefetchedFile) and first.name == names[0]
+  # Nothing more is read until the next file is asked for
+  for _ in range(3):
+    assert started.acquire(timeout=5)
+  assert len(reading) == 3
+  data = [first.read()] + [x.read() for x in results]
+  assert data == [x.encode() for x in contents]
+
+  # Files larger than the limit are opened instead
+  opened = list(dataset.open_iter(max_memory=50))
+  assert [isinstance(x, VerifyingFile) for x in opened] == [False] * 5 + [True] * 3
+  assert opened[-1].read() == contents[-1].encode()
+
+def testOpenIterVerifies(tmpdir):
+  small, _ = _dataset(tmpdir.mkdir("small"), ["small"])
+  tmpdir.join("small", "file0.data").write("SMALL")
+  with pytest.raises(HashMismatchError):
+    next(small.open_iter(verify=True))
+
+  # Opened files are checked when they have been read to the end
+  large, _ = _dataset(tmpdir.mkdir("large"), ["large" * 20])
+  tmpdir.join("large", "file0.data").write("LARGE" * 20)
+  opened = next(large.open_iter(max_memory=50, verify=True))
+  assert opened.read(10) == b"LARGELARGE"
+  with pytest.raises(HashMismatchError):
+    opened.read()
+
+def testOpenIterVerifiesLines(tmpdir):
+  dataset, _ = _dataset(tmpdir, ["line\n" * 20])
+  tmpdir.join("file0.data").write("LINE\n" * 20)
+  with pytest.raises(HashMismatchError):
+    list(next(dataset.open_iter(max_memory=50, verify=True)))
+  opened = next(dataset.open_iter(max_memory=50, verify=True))
+  buffer = bytearray(30)
+  with pytest.raises(HashMismatchError):
+    while opened.readinto(buffer):
+      pass
+
+def testOpenIterRaisesErrorsInOrder(tmpdir):
+  dataset, names = _dataset(tmpdir, ["a", "b", "c"])
+  os.unlink(names[2])
+  tmpdir.join("file1.data").write("B")
+  results = dataset.open_iter(verify=True)
+  assert next(results).read() == b"a"
+  with pytest.raises(HashMismatchError):
+    next(results)
+
+  results = dataset.open_iter()
+  assert [x.read() for x in itertools.islice(results, 2)] == [b"a", b"B"]
+  with pytest.raises(MissingDatafileError):
+    next(results)
+
+def testOpenIterStoppedEarly(tmpdir, monkeypatch):
+  dataset, names = _dataset(tmpdir, ["x" * 100 for _ in range(6)])
+  opened = []
+  class _VerifyingFile(VerifyingFile):
+    def __init__(self, *args):
+      super(_VerifyingFile, self).__init__(*args)
+      opened.append(self)
+  monkeypatch.setattr(prefetch_module, "VerifyingFile", _VerifyingFile)
+
+  results = dataset.open_iter(prefetch=2, max_memory=50)
+  with next(results) as first:
+    assert first.read() == b"x" * 100
+  results.close()
+  # Files opened ahead (or cancelled before they were), but never used, are closed too
+  assert 1 <= len(opened) <= 3
+  assert all(x.closed for x in opened)
@@ -0,0 +1,83 @@
+# coding: utf-8
+
+import time
+
+from datatool import Datatool
+from datatool.authority import LocalFileAuthority
+from datatool.index import LocalFileIndex
+
+def _setup(tmpdir, monkeypatch):
+  auth_file, index_file = tmpdir.join("data.authority"), tmpdir.join("data.index")
+  auth_file.write("")
+  index_file.write("")
+  monkeypatch.setenv("DATA_AUTHORITY", str(auth_file))
+  monkeypatch.setenv("DATA_INDEX", str(index_file))
+  return str(auth_file), str(index_file)
+
+def _add_files(auth_file, index_file, set_name, files, create=False):
+  """Add files to a set, as a separate writer would"""
+  authority = LocalFileAuthority(auth_file)
+  index = LocalFileIndex(index_file)
+  set_id = authority.create_set(set_name) if create else authority.fetch_dataset(set_name).id
+  authority.add_files(set_id, index.add_files(files))
+  index.write()
+  authority.write()
+  return authority
+
+def testRefreshSeesAppendedLines(tmpdir, monkeypatch):
+  auth_file, index_file = _setup(tmpdir, monkeypatch)
+  files = []
+  for name in ["a", "b", "c"]:
+    files.append(tmpdir.join(name + ".data"))
+    files[-1].write(name)
+  _add_files(auth_file, index_file, "sample", [str(files[0])], create=True)
+
+  datatool = Datatool()
+  sample = datatool.get_dataset("sample")
+  assert list(sample) == [str(files[0])]
+
+  writer = _add_files(auth_file, index_file, "sample", [str(files[1])])
+  datatool.refresh()
+  assert list(sample) == [str(files[0]), str(files[1])]
+  # Our own writes are not read back in twice
+  assert len(datatool._authority._commands) == len(LocalFileAuthority(auth_file)._commands)
+
+  # Replacing the file (e.g. compaction) reloads, and existing interfaces follow
+  writer.compact()
+  _add_files(auth_file, index_file, "sample", [str(files[2])])
+  datatool.refresh()
+  assert list(sample) == [str(x) for x in files]
+
+def testWatch(tmpdir, monkeypatch):
+  auth_file, index_file = _setup(tmpdir, monkeypatch)
+  data = tmpdir.join("a.data")
+  data.write("a")
+  datatool = Datatool()
+  datatool.watch(interval=0.05)
+  try:
+    _add_files(auth_file, index_file, "watched", [str(data)], create=True)
+    for _ in range(100):
+      try:
+        assert list(datatool.get_dataset("watched")) == [str(data)]
+        break
+      except IndexError:
+        time.sleep(0.05)
+    else:
+      assert False, "Watcher never refreshed"
+  finally:
+    datatool.stop_watching()
+
+def testTwoIndexWriters(tmpdir, monkeypatch):
+  auth_file, index_file = _setup(tmpdir, monkeypatch)
+  for name in ["a", "b"]:
+    tmpdir.join(name + ".data").write(name)
+  first, second = LocalFileIndex(index_file), LocalFileIndex(index_file)
+  first.add_files([str(tmpdir.join("a.data"))])
+  first.write()
+  second.add_files([str(tmpdir.join("b.data"))])
+  second.write()
+  first.refresh()
+  assert not first._pending
+  first.write()
+  lines = [x.split()[-1] for x in open(index_file).read().splitlines()]
+  assert sorted(lines) == sorted(str(tmpdir.join(x + ".data")) for x in ["a", "b"])
@@ -0,0 +1,62 @@
+# coding: utf-8
+
+import os
+
+from datatool.authority import LocalFileAuthority, CachedRemoteAuthority, format_command
+from datatool.handlers import CreateSetCommand, SetPropertyCommand
+
+from helpers import serve
+
+def _append_sets(filename, names):
+  with open(filename, "a") as stream:
+    for name in names:
+      create = CreateSetCommand()
+      stream.write(format_command(create))
+      stream.write(format_command(SetPropertyCommand(create.id, "name", name)))
+
+def testRemoteTailFetch(tmpdir):
+  filename = str(tmpdir.join("data.authority"))
+  _append_sets(filename, ["set{}".format(x) for x in range(200)])
+  server = serve(filename)
+  url = "http://127.0.0.1:{}/data.authority".format(server.server_port)
+  try:
+    cache_dir = str(tmpdir.join("cache"))
+    remote = CachedRemoteAuthority(url, cache_dir=cache_dir)
+    assert remote.fetch_dataset("set199")
+    full_size = os.path.getsize(filename)
+    assert server.sent == full_size
+
+    # Appending only fetches the validation overlap and the new lines
+    _append_sets(filename, ["new"])
+    server.sent = 0
+    remote.refresh()
+    assert remote.fetch_dataset("new")
+    assert len(remote._data.datasets) == 201
+    assert server.sent < full_size / 2
+
+    # Unchanged remotes are not transferred at all
+    server.sent = 0
+    remote.refresh()
+    assert server.sent == 0
+
+    # A fresh process reuses the cache
+    server.sent = 0
+    assert CachedRemoteAuthority(url, cache_dir=cache_dir).fetch_dataset("new")
+    assert server.sent == 0
+
+    # Rewriting the remote causes a full refetch
+    os.unlink(filename)
+    _append_sets(filename, ["rewritten"])
+    remote.refresh()
+    assert list(x.name for x in remote._data.datasets.values()) == ["rewritten"]
+  finally:
+    server.shutdown()
+
+def testFileURL(tmpdir):
+  filename = str(tmpdir.join("data.authority"))
+  _append_sets(filename, ["first"])
+  remote = CachedRemoteAuthority("file://" + filename, cache_dir=str(tmpdir.join("cache")))
+  _append_sets(filename, ["second"])
+  remote.refresh()
+  assert remote.fetch_dataset("first") and remote.fetch_dataset("second")
+  assert len(remote._commands) == len(LocalFileAuthority(filename)._commands)
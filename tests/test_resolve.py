@@ -0,0 +1,71 @@
+# coding: utf-8
+
+import os
+
+from datatool.authority import LocalFileAuthority
+from datatool.datafile import FileInstance, MissingDatafileError
+from datatool.resolve import resolve_datasets
+
+import pytest
+
+def testResolveMany(tmpdir):
+  auth_file = tmpdir.join("data.authority")
+  auth_file.write("")
+  authority = LocalFileAuthority(str(auth_file))
+  entries = []
+  for name in ["a", "bb", "ccc"]:
+    data = tmpdir.join(name + ".data")
+    data.write(name)
+    entries.append(FileInstance.from_file(str(data)))
+  missing = FileInstance(str(tmpdir.join("gone.data")), "0"*40, 1, 1.0)
+  first = authority.create_set("first")
+  second = authority.create_set("second")
+  authority.add_files(first, entries[:2])
+  authority.add_files(second, entries[1:] + [missing])
+  for entry in entries + [missing]:
+    authority._data.files[entry.hashsum].instances.append(entry)
+  authority.add_tags(entries[1].hashsum, ["middle"])
+  authority.add_tags(entries[2].hashsum, ["last"])
+
+  results = resolve_datasets(authority, ["first", second[:8]])
+  assert len(results) == 5
+  assert results.set_id == [first, first, second, second, second]
+  assert results.path == [x.filename for x in entries[:2]] + [x.filename for x in entries[1:]] + [None]
+  assert results.size == [1, 2, 2, 3, -1]
+  assert results.tagmask[1] == results.tag_bit("middle")
+  assert results.tagmask[3] == results.tag_bit("last")
+
+  tagged = resolve_datasets(authority, ["first", "second"], tags=["MIDDLE"])
+  assert tagged.hashsum == [entries[1].hashsum, entries[1].hashsum]
+
+  with pytest.raises(MissingDatafileError):
+    resolve_datasets(authority, ["second"], require_readable=True)
+  with pytest.raises(IndexError):
+    resolve_datasets(authority, ["third"])
+
+def testResolveListsDirectoriesOnce(tmpdir, monkeypatch):
+  auth_file = tmpdir.join("data.authority")
+  auth_file.write("")
+  authority = LocalFileAuthority(str(auth_file))
+  entries = []
+  for dirname in ["one", "two"]:
+    tmpdir.mkdir(dirname)
+    for name in ["a", "b", "c"]:
+      data = tmpdir.join(dirname, name)
+      data.write(dirname + name)
+      entries.append(FileInstance.from_file(str(data)))
+  set_id = authority.create_set("sample")
+  authority.add_files(set_id, entries)
+  for entry in entries:
+    authority._data.files[entry.hashsum].instances.append(entry)
+
+  listed = []
+  scandir = os.scandir
+  def _scandir(path):
+    listed.append(path)
+    return scandir(path)
+  monkeypatch.setattr(os, "scandir", _scandir)
+  monkeypatch.setattr(os.path, "isfile", lambda path: pytest.fail("Checked {} separately".format(path)))
+  results = resolve_datasets(authority, ["sample"], require_readable=True)
+  assert results.path == [x.filename for x in entries]
+  assert sorted(listed) == sorted(str(tmpdir.join(x)) for x in ["one", "two"])
@@ -0,0 +1,169 @@
+# coding: utf-8
+
+import os
+import pytest
+
+from datatool import authority as authority_module
+from datatool import segments
+from datatool import util as util_module
+from datatool.authority import LocalFileAuthority, CachedRemoteAuthority, _authority_state, \
+                               format_command, open_authority
+from datatool.handlers import CreateSetCommand
+from datatool.index import LocalFileIndex
+from datatool.remote import RemoteLogError
+from datatool.segments import SegmentManifest
+
+from helpers import serve
+
+def _setup(tmpdir, segment_size=512, codec="gzip"):
+  tmpdir.join("data.authority").write("")
+  tmpdir.join("data.index").write("")
+  authority = LocalFileAuthority(str(tmpdir.join("data.authority")))
+  index = LocalFileIndex(str(tmpdir.join("data.index")))
+  authority.segment(segment_size, codec)
+  index.segment(segment_size, codec)
+  return authority, index
+
+def _add_sets(tmpdir, authority, index, start, count):
+  for i in range(start, start + count):
+    tmpdir.join("{}.data".format(i)).write(str(i))
+    set_id = authority.create_set("set{}".format(i))
+    authority.add_files(set_id, index.add_files([str(tmpdir.join("{}.data".format(i)))]))
+    authority.add_tags(set_id, ["tag{}".format(i % 3)])
+    index.write()
+    authority.write()
+
+def testSealing(tmpdir):
+  authority, index = _setup(tmpdir)
+  reader = LocalFileAuthority(str(tmpdir.join("data.authority")))
+  _add_sets(tmpdir, authority, index, 0, 20)
+
+  manifest = SegmentManifest(str(tmpdir.join("data.authority"))).load()
+  assert len(manifest.segments) > 1
+  assert os.path.getsize(str(tmpdir.join("data.authority"))) < 512
+  assert len(SegmentManifest(str(tmpdir.join("data.index"))).load().segments) > 1
+  assert all(x["start"] + x["size"] == y["start"] for x, y in zip(manifest.segments, manifest.segments[1:]))
+
+  loaded = LocalFileAuthority(str(tmpdir.join("data.authority")))
+  assert _authority_state(loaded._data) == _authority_state(authority._data)
+  assert len(loaded._commands) == len(authority._commands)
+  loaded_index = LocalFileIndex(str(tmpdir.join("data.index")))
+  assert sorted(loaded_index._data) == sorted(index._data)
+
+  # A reader loaded before the seals carries on through the segments
+  assert not reader.refresh()
+  assert _authority_state(reader._data) == _authority_state(authority._data)
+  assert len(reader._commands) == len(authority._commands)
+
+def testParallelParse(tmpdir, monkeypatch):
+  authority, index = _setup(tmpdir)
+  _add_sets(tmpdir, authority, index, 0, 20)
+  monkeypatch.setattr(authority_module, "PARSE_CHUNK_SIZE", 200)
+  parallel = LocalFileAuthority(str(tmpdir.join("data.authority")), processes=2)
+  assert _authority_state(parallel._data) == _authority_state(authority._data)
+  assert [str(x) for x in parallel._commands] == [str(x) for x in authority._commands]
+  assert parallel._reader.offset == authority._reader.offset
+
+def testCheckpoint(tmpdir, monkeypatch):
+  authority, index = _setup(tmpdir)
+  _add_sets(tmpdir, authority, index, 0, 10)
+  for i in range(0, 10, 2):
+    authority.delete_set(authority.fetch_dataset("set{}".format(i)).id)
+  authority.write()
+  history = len(authority._commands)
+  assert authority.compact() is None
+  assert len(authority._commands) < history
+  _add_sets(tmpdir, authority, index, 10, 5)
+
+  manifest = SegmentManifest(str(tmpdir.join("data.authority"))).load()
+  checkpoint = manifest.checkpoint()
+  covered = [manifest.path(x) for x in manifest.segments if x["start"] < checkpoint["end"]]
+  opened = []
+  open_log = segments.open_log
+  def _open_log(filename):
+    opened.append(filename)
+    return open_log(filename)
+  monkeypatch.setattr(util_module, "open_log", _open_log)
+
+  loaded = LocalFileAuthority(str(tmpdir.join("data.authority")))
+  assert _authority_state(loaded._data) == _authority_state(authority._data)
+  assert len(loaded._commands) == len(authority._commands)
+  # The segments covered by the checkpoint were skipped
+  assert manifest.path(checkpoint) in opened
+  assert not set(covered) & set(opened)
+
+def testInterruptedSeal(tmpdir, monkeypatch):
+  authority, index = _setup(tmpdir, segment_size=1024*1024)
+  _add_sets(tmpdir, authority, index, 0, 3)
+  head = str(tmpdir.join("data.authority"))
+  # Seal, as if the writer stopped before replacing the head
+  with monkeypatch.context() as patch:
+    patch.setattr(segments, "replace_head", lambda *args: None)
+    with open(head, "a") as stream:
+      segments.seal(stream, SegmentManifest(head), force=True)
+  assert os.path.getsize(head) > 0
+
+  # The head isn't read twice, and the next writer finishes the seal
+  loaded = LocalFileAuthority(head)
+  assert _authority_state(loaded._data) == _authority_state(authority._data)
+  _add_sets(tmpdir, loaded, index, 3, 1)
+  assert len(LocalFileAuthority(head)._commands) == len(loaded._commands)
+
+def testUnsegmented(tmpdir):
+  tmpdir.join("data.authority").write("")
+  authority = LocalFileAuthority(str(tmpdir.join("data.authority")))
+  with open(str(tmpdir.join("data.authority")), "a") as stream:
+    stream.write("# padding\n" * 100)
+  authority.create_set("sample")
+  authority.write()
+  with open(str(tmpdir.join("data.authority"))) as stream:
+    assert not segments.seal(stream, SegmentManifest(str(tmpdir.join("data.authority"))), force=True)
+  assert not os.path.exists(str(tmpdir.join("data.authority.segments")))
+
+def testLazyFallsBack(tmpdir):
+  authority, index = _setup(tmpdir)
+  _add_sets(tmpdir, authority, index, 0, 5)
+  loaded = open_authority(str(tmpdir.join("data.authority")), lazy=True)
+  assert type(loaded) is LocalFileAuthority
+  assert _authority_state(loaded._data) == _authority_state(authority._data)
+
+def testZstd(tmpdir):
+  pytest.importorskip("zstandard")
+  authority, index = _setup(tmpdir, codec="zstd")
+  _add_sets(tmpdir, authority, index, 0, 10)
+  manifest = SegmentManifest(str(tmpdir.join("data.authority"))).load()
+  assert manifest.segments and all(x["file"].endswith(".zst") for x in manifest.segments)
+  loaded = LocalFileAuthority(str(tmpdir.join("data.authority")))
+  assert _authority_state(loaded._data) == _authority_state(authority._data)
+
+def testSealKeepsPartialLine(tmpdir):
+  authority, index = _setup(tmpdir, segment_size=1024*1024)
+  _add_sets(tmpdir, authority, index, 0, 3)
+  head = str(tmpdir.join("data.authority"))
+  # As if a writer was part way through a line
+  partial = format_command(CreateSetCommand()).rstrip("\n")
+  with open(head, "a") as stream:
+    stream.write(partial)
+  with open(head, "a") as stream:
+    assert segments.seal(stream, SegmentManifest(head), force=True)
+  # Only whole lines were sealed, and the rest is left in the new head
+  manifest = SegmentManifest(head).load()
+  with segments.open_log(manifest.path(manifest.segments[-1])) as stream:
+    assert stream.read().endswith(b"\n")
+  assert open(head).read() == partial
+  loaded = LocalFileAuthority(head)
+  assert len(loaded._data.datasets) == len(authority._data.datasets) + 1
+
+def testSegmentedRemote(tmpdir):
+  authority, index = _setup(tmpdir)
+  _add_sets(tmpdir, authority, index, 0, 5)
+  filename = str(tmpdir.join("data.authority"))
+  with pytest.raises(RemoteLogError):
+    CachedRemoteAuthority("file://" + filename, cache_dir=str(tmpdir.join("cache")))
+  server = serve(filename)
+  try:
+    url = "http://127.0.0.1:{}/data.authority".format(server.server_port)
+    with pytest.raises(RemoteLogError):
+      CachedRemoteAuthority(url, cache_dir=str(tmpdir.join("cache")))
+  finally:
+    server.shutdown()
@@ -0,0 +1,62 @@
+# coding: utf-8
+
+import hashlib
+
+from datatool.authority import LocalFileAuthority, AuthorityFileError
+from datatool.datafile import FileInstance
+from datatool.snapshot import SnapshotAuthority, write_snapshot, is_snapshot
+
+import pytest
+
+def _instance(name):
+  return FileInstance(filename="/data/" + name, hashsum=hashlib.sha1(name.encode()).hexdigest(),
+                      size=len(name), timestamp=1.5)
+
+def _authority(tmpdir):
+  auth_file = tmpdir.join("data.authority")
+  auth_file.write("")
+  authority = LocalFileAuthority(str(auth_file))
+  first = authority.create_set("First")
+  second = authority.create_set("second")
+  files = [_instance(x) for x in ["a.data", "b.data", "c.altdata"]]
+  for entry in files:
+    entry_copy = FileInstance(entry.filename, entry.hashsum, entry.size, entry.timestamp)
+    authority.add_files(first, [entry])
+    authority._data.files[entry.hashsum].instances.append(entry_copy)
+  authority.add_files(second, files[1:])
+  authority.add_tags(first, ["sample", "big"])
+  authority.add_tags(second, ["sample"])
+  authority.add_tags(files[0].hashsum, ["alpha"])
+  return authority, first, second, files
+
+def testSnapshotRoundTrip(tmpdir):
+  authority, first, second, files = _authority(tmpdir)
+  snapfile = str(tmpdir.join("data.snapshot"))
+  write_snapshot(authority, snapfile)
+  assert is_snapshot(snapfile)
+
+  snap = SnapshotAuthority(snapfile)
+  dataset = snap.fetch_dataset("first")
+  assert dataset.id == first
+  assert [x.id for x in dataset.files] == [x.hashsum for x in files]
+  assert dataset.tags == {"sample", "big"}
+  assert dataset.files[0].tags == {"alpha"}
+  assert dataset.files[0].instances[0].filename == "/data/a.data"
+  assert dataset.files[0].instances[0].size == len("a.data")
+  assert snap.fetch_dataset(second[:6]).name == "second"
+  assert snap.fetch_dataset("nothere") is None
+  assert snap[second].name == "second"
+  assert set(snap.search(["sample"])) == {first, second}
+  assert snap.search(["big"]) == (first,)
+  assert snap.search(["missing"]) == ()
+  assert snap.get_file(files[2].hashsum).id == files[2].hashsum
+  # Files shared between sets are materialised once
+  assert snap[second].files[0] is dataset.files[1]
+
+def testSnapshotIsReadOnly(tmpdir):
+  authority, first, _, _ = _authority(tmpdir)
+  snapfile = str(tmpdir.join("data.snapshot"))
+  write_snapshot(authority, snapfile)
+  snap = SnapshotAuthority(snapfile)
+  with pytest.raises(AuthorityFileError):
+    snap.add_tags(snap.fetch_dataset("First").id, ["new"])
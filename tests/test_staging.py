@@ -0,0 +1,79 @@
+# coding: utf-8
+
+import os
+
+import pytest
+
+from datatool.authority import LocalFileAuthority, LazyFileAuthority
+from datatool.index import LocalFileIndex
+from datatool.staging import StagingCache, StagingError, apply_staged
+
+def _authority_with_files(tmpdir, contents):
+  tmpdir.join("data.authority").write("")
+  tmpdir.join("data.index").write("")
+  authority = LocalFileAuthority(str(tmpdir.join("data.authority")))
+  index = LocalFileIndex(str(tmpdir.join("data.index")))
+  names = []
+  for i, content in enumerate(contents):
+    tmpdir.join("file{}.data".format(i)).write(content)
+    names.append(str(tmpdir.join("file{}.data".format(i))))
+  set_id = authority.create_set("staged")
+  authority.add_files(set_id, index.add_files(names))
+  authority.apply_index(index)
+  index.write()
+  return authority, authority[set_id]
+
+def testStaging(tmpdir):
+  authority, dataset = _authority_with_files(tmpdir, ["a"*100, "b"*100, "c"*100])
+  cache = StagingCache(str(tmpdir.join("staging")), max_size=250)
+  staged = cache.stage(dataset.files[:2])
+  assert all(os.path.isfile(x.filename) and x.filename.endswith(".data") for x in staged)
+  # Staged copies are preferred, and recorded in the staging index
+  assert [x.get_valid_instance().filename for x in dataset.files[:2]] == [x.filename for x in staged]
+  assert set(x.filename for x in LocalFileIndex(cache.index_filename)._data.values()) == set(x.filename for x in staged)
+
+  # Staging a third file evicts the least recently used
+  os.utime(staged[1].filename, (0, 0))
+  cache.stage(dataset.files[2:])
+  assert os.path.isfile(staged[0].filename)
+  assert not os.path.isfile(staged[1].filename)
+  # Which falls back to the original
+  assert dataset.files[1].get_valid_instance().filename == str(tmpdir.join("file1.data"))
+
+def testStagingVerifiesHash(tmpdir):
+  authority, dataset = _authority_with_files(tmpdir, ["original"])
+  tmpdir.join("file0.data").write("modified")
+  cache = StagingCache(str(tmpdir.join("staging")))
+  with pytest.raises(StagingError):
+    cache.stage(dataset.files)
+  assert not os.path.exists(cache.path_for(dataset.files[0].id, ".data"))
+
+def testEvictionUpdatesIndex(tmpdir):
+  authority, dataset = _authority_with_files(tmpdir, ["a"*100, "b"*100])
+  cache = StagingCache(str(tmpdir.join("staging")), max_size=150)
+  first = cache.stage(dataset.files[:1])[0]
+  os.utime(first.filename, (0, 0))
+  second = cache.stage(dataset.files[1:])[0]
+  assert not os.path.isfile(first.filename)
+  assert [x.filename for x in LocalFileIndex(cache.index_filename)._data.values()] == [second.filename]
+
+  # Files used since the cache was listed are not evicted
+  staged = cache.stage(dataset.files[:1])[0]
+  entry = [x for x in cache._entries() if x.path == staged.filename][0]
+  atime = entry.stat().st_atime
+  os.utime(staged.filename, (atime + 10, atime + 10))
+  assert not cache._evict(atime, entry)
+  assert os.path.isfile(staged.filename)
+
+def testStagedLazyAuthority(tmpdir):
+  authority, dataset = _authority_with_files(tmpdir, ["a"*100, "b"*100])
+  authority.write()
+  cache = StagingCache(str(tmpdir.join("staging")))
+  staged = cache.stage(dataset.files[:1])
+  lazy = LazyFileAuthority(str(tmpdir.join("data.authority")))
+  lazy.apply_index(LocalFileIndex(str(tmpdir.join("data.index"))))
+  apply_staged(lazy, cache.root)
+  files = lazy.fetch_dataset("staged").files
+  assert files[0].get_valid_instance().filename == staged[0].filename
+  assert files[1].get_valid_instance().filename == str(tmpdir.join("file1.data"))
+  assert len(files[0].instances) == 2
@@ -0,0 +1,146 @@
+# coding: utf-8
+
+import shutil
+
+import pytest
+
+from datatool.authority import LocalFileAuthority, CachedRemoteAuthority, AuthorityFileError, _authority_state
+from datatool.datafile import FileInstance
+from datatool.digest import DigestTree
+
+from helpers import serve
+
+def _files(prefix, count):
+  return [FileInstance("/data/{}{}".format(prefix, x), "{}{:039x}".format(prefix, x), 1, 1.0) for x in range(count)]
+
+def testDigestTree():
+  first, second = DigestTree(), DigestTree()
+  for i in range(200):
+    first["{:032x}".format(i * 7919)] = str(i)
+    second["{:032x}".format(i * 7919)] = str(i)
+  assert first.digest() == second.digest()
+  second["{:032x}".format(7919)] = "changed"
+  second["{:032x}".format(999999)] = "new"
+  first.discard("{:032x}".format(0))
+  assert first.differing(second) == sorted(["{:032x}".format(x) for x in [0, 7919, 999999]])
+  second.discard("{:032x}".format(999999))
+  second["{:032x}".format(7919)] = "1"
+  first["{:032x}".format(0)] = "0"
+  assert first.digest() == second.digest()
+
+class _CountingTree(DigestTree):
+  read = []
+  def children(self, prefix=""):
+    self.read.append(prefix)
+    return super(_CountingTree, self).children(prefix)
+
+def testDigestTreeOnlyReadsDifferences():
+  first, second = DigestTree(), _CountingTree()
+  for i in range(500):
+    first["{:032x}".format(i * 7919)] = str(i)
+    second["{:032x}".format(i * 7919)] = str(i)
+  second.digest()
+  second.read = []
+  first["{:032x}".format(7919)] = "changed"
+  assert first.differing(second) == ["{:032x}".format(7919)]
+  # Just the branch from the root down to the changed set
+  assert [x for x in second.read if x in "{:032x}".format(7919)] == second.read
+
+def testIncrementalDigests(tmpdir):
+  tmpdir.join("data.authority").write("")
+  authority = LocalFileAuthority(str(tmpdir.join("data.authority")))
+  set_id = authority.create_set("a")
+  authority.add_files(set_id, _files("a", 3))
+  before = authority._data.digests().digest()
+  authority.add_tags(set_id, ["new"])
+  changed = authority._data.digests().digest()
+  assert changed != before
+  authority.remove_tags(set_id, ["new"])
+  assert authority._data.digests().digest() == before
+
+def _sites(tmpdir):
+  filename = str(tmpdir.join("site1.authority"))
+  open(filename, "w").close()
+  site1 = LocalFileAuthority(filename)
+  for name in "abc":
+    set_id = site1.create_set("set_" + name)
+    site1.add_files(set_id, _files(name, 3))
+  site1.write()
+  shutil.copy(filename, str(tmpdir.join("site2.authority")))
+  site2 = LocalFileAuthority(str(tmpdir.join("site2.authority")))
+
+  # Site 1 carries on changing
+  set_b = site1.fetch_dataset("set_b").id
+  site1.add_files(set_b, _files("d", 2))
+  site1.add_tags_many([x.hashsum for x in _files("d", 2)], ["fresh"])
+  site1.rename_set(site1.fetch_dataset("set_c").id, "renamed")
+  site1.add_files(site1.create_set("set_e"), _files("e", 2))
+  site1.write()
+  return site1, site2, filename
+
+def testSync(tmpdir):
+  site1, site2, filename = _sites(tmpdir)
+  lines = len(open(str(tmpdir.join("site2.authority"))).readlines())
+  applied = site2.sync(LocalFileAuthority(filename))
+  site2.write()
+  assert _authority_state(site2._data) == _authority_state(site1._data)
+  assert len(open(str(tmpdir.join("site2.authority"))).readlines()) == lines + len(applied)
+  # Everything is already there the second time
+  assert site2.sync(LocalFileAuthority(filename)) == []
+
+def testSyncOverHTTP(tmpdir):
+  site1, site2, filename = _sites(tmpdir)
+  server = serve(filename)
+  try:
+    url = "http://127.0.0.1:{}/authority".format(server.server_address[1])
+    site2.sync(CachedRemoteAuthority(url, cache_dir=str(tmpdir.join("cache"))))
+    assert _authority_state(site2._data) == _authority_state(site1._data)
+  finally:
+    server.shutdown()
+
+def testSyncIgnoresRewrittenHistory(tmpdir):
+  site1, site2, filename = _sites(tmpdir)
+  site2.sync(LocalFileAuthority(filename))
+  site2.write()
+  LocalFileAuthority(filename).compact()
+  compacted = LocalFileAuthority(filename)
+  compacted.add_tags(compacted.fetch_dataset("set_a").id, ["later"])
+  compacted.write()
+  # Only the new change is applied, not the compacted history of the set
+  applied = site2.sync(LocalFileAuthority(filename))
+  assert [str(x) for x in applied] == [str(compacted._commands[-1])]
+
+def testSyncNameConflict(tmpdir):
+  site1, site2, filename = _sites(tmpdir)
+  site2.create_set("renamed")
+  commands = len(site2._commands)
+  with pytest.raises(AuthorityFileError):
+    site2.sync(LocalFileAuthority(filename))
+  assert len(site2._commands) == commands
+
+def testSyncBothWays(tmpdir):
+  site1, site2, filename = _sites(tmpdir)
+  site2.sync(LocalFileAuthority(filename))
+  site2.write()
+  site1.add_tags(site1.fetch_dataset("set_b").id, ["bad"])
+  site1.write()
+  site2.sync(LocalFileAuthority(filename))
+  site2.write()
+
+  # Deletions and removals are carried over, and not undone by syncing back
+  site1.delete_set(site1.fetch_dataset("set_a").id)
+  site1.remove_tags(site1.fetch_dataset("set_b").id, ["bad"])
+  site1.write()
+  site2.sync(LocalFileAuthority(filename))
+  site2.write()
+  assert site2.fetch_dataset("set_a") is None
+  assert not "bad" in site2.fetch_dataset("set_b").tags
+  assert site1.sync(LocalFileAuthority(str(tmpdir.join("site2.authority")))) == []
+  assert _authority_state(site2._data) == _authority_state(site1._data)
+
+def testSyncKeepsDeletions(tmpdir):
+  site1, site2, filename = _sites(tmpdir)
+  site2.delete_set(site2.fetch_dataset("set_b").id)
+  site2.sync(LocalFileAuthority(filename))
+  assert site2.fetch_dataset("set_b") is None
+  assert site2.fetch_dataset("set_e") is not None
@@ -0,0 +1,67 @@
+# coding: utf-8
+
+import os
+import json
+
+from datatool import verify as verify_module
+from datatool.authority import LocalFileAuthority
+from datatool.index import LocalFileIndex
+
+def _authority_with_files(tmpdir, contents):
+  tmpdir.join("data.authority").write("")
+  tmpdir.join("data.index").write("")
+  authority = LocalFileAuthority(str(tmpdir.join("data.authority")))
+  index = LocalFileIndex(str(tmpdir.join("data.index")))
+  names = []
+  for i, content in enumerate(contents):
+    tmpdir.join("file{}.data".format(i)).write(content)
+    names.append(str(tmpdir.join("file{}.data".format(i))))
+  set_id = authority.create_set("checked")
+  authority.add_files(set_id, index.add_files(names))
+  authority.apply_index(index)
+  return authority, names
+
+def testVerify(tmpdir):
+  authority, names = _authority_with_files(tmpdir, ["a", "b", "c", "d"])
+  stats = os.stat(names[2])
+  tmpdir.join("file1.data").write("longer")
+  tmpdir.join("file2.data").write("C")
+  os.utime(names[2], (stats.st_atime, stats.st_mtime))
+  os.unlink(names[3])
+
+  # Same-size changes with the timestamp restored are only found by rehashing
+  problems = {x.filename: x.problem for x in authority.verify(["checked"])}
+  assert problems == {names[1]: "size", names[3]: "missing"}
+  problems = {x.filename: x.problem for x in authority.verify(["checked"], full=True, bandwidth=1e6)}
+  assert problems == {names[1]: "size", names[2]: "hash", names[3]: "missing"}
+
+def testVerifyResumes(tmpdir, monkeypatch):
+  authority, names = _authority_with_files(tmpdir, ["a", "b", "c"])
+  tmpdir.join("file0.data").write("changed")
+  state = str(tmpdir.join("verify.state"))
+  list(authority.verify(["checked"], state=state))
+  assert len(open(state).readlines()) == 3
+
+  # Resuming reports earlier results without checking again
+  checked = []
+  real_check = verify_module.check_instance
+  monkeypatch.setattr(verify_module, "check_instance",
+                      lambda *args, **kwargs: checked.append(args[1].filename) or real_check(*args, **kwargs))
+  assert [x.filename for x in authority.verify(["checked"], state=state)] == [names[0]]
+  assert checked == []
+  # But a full verification needs to hash everything
+  assert [x.problem for x in authority.verify(["checked"], full=True, state=state)] == ["size"]
+  assert sorted(checked) == sorted(names)
+  assert all(json.loads(x)["full"] for x in open(state).readlines()[3:])
+
+def testVerifyResumesAfterPartialLine(tmpdir):
+  authority, names = _authority_with_files(tmpdir, ["a", "b", "c"])
+  state = str(tmpdir.join("verify.state"))
+  list(authority.verify(["checked"], state=state))
+  lines = open(state).readlines()
+  # As if killed part way through writing the last result
+  with open(state, "w") as stream:
+    stream.write("".join(lines[:2]) + lines[2][:20])
+  assert list(authority.verify(["checked"], state=state)) == []
+  lines = open(state).readlines()
+  assert len(lines) == 3 and all(json.loads(x) for x in lines)
@@ -0,0 +1,55 @@
+# coding: utf-8
+
+import pytest
+
+from datatool.authority import LocalFileAuthority, LazyFileAuthority, AuthorityFileError, _authority_state
+from datatool.datafile import FileInstance
+from datatool.toolinterface import DatasetInterface
+
+def _files(prefix, count):
+  return [FileInstance("/data/{}{}".format(prefix, x), "{}{:039x}".format(prefix, x), 1, 1.0) for x in range(count)]
+
+def _authority(tmpdir):
+  filename = str(tmpdir.join("data.authority"))
+  open(filename, "w").close()
+  authority = LocalFileAuthority(filename)
+  files = _files("a", 6)
+  first = authority.create_set("first")
+  authority.add_files(first, files[:4])
+  second = authority.create_set("second")
+  authority.add_files(second, files[2:])
+  authority.add_tags_many([x.hashsum for x in files[::2]], ["even"])
+  return authority, filename, files, first, second
+
+def testVirtualSets(tmpdir):
+  authority, filename, files, first, second = _authority(tmpdir)
+  ids = lambda name: [x.id for x in authority.fetch_dataset(name).files]
+  authority.create_view({"op": "filter", "sets": [first], "tags": ["Even"]}, name="evens")
+  authority.create_view({"op": "union", "sets": [first, second]}, name="union")
+  authority.create_view({"op": "intersection", "sets": [first, second]}, name="both")
+  authority.create_view({"op": "difference", "sets": [first, second]}, name="only_first")
+  hashes = [x.hashsum for x in files]
+  assert ids("evens") == [hashes[0], hashes[2]]
+  assert ids("union") == hashes
+  assert ids("both") == hashes[2:4]
+  assert ids("only_first") == hashes[:2]
+
+  # Views of views follow changes to the sets they are made from
+  authority.create_view({"op": "filter", "sets": [authority.fetch_dataset("union").id], "tags": ["even"]}, name="all_evens")
+  assert ids("all_evens") == hashes[::2]
+  authority.remove_files(second, [hashes[4]])
+  authority.add_tags(hashes[1], ["even"])
+  assert ids("all_evens") == hashes[:3]
+  assert ids("both") == [hashes[2], hashes[3]]
+  with pytest.raises(AuthorityFileError):
+    authority.add_files(authority.fetch_dataset("union").id, files[:1])
+
+  # Only the definition is written, and it survives reloading and compaction
+  authority.write()
+  assert [x.split()[1] for x in open(filename)].count("addfilestoset") == 2
+  interface = DatasetInterface(LocalFileAuthority(filename).fetch_dataset("all_evens"))
+  assert len(interface._dataset.files) == 3
+  assert LazyFileAuthority(filename).fetch_dataset("all_evens").files[2].id == hashes[2]
+  state = _authority_state(authority._data)
+  authority.compact()
+  assert _authority_state(LocalFileAuthority(filename)._data) == state